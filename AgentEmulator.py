@@ -0,0 +1,494 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import random
+import socket
+import time
+
+import numpy as np
+
+from ChunkStorage import load_chunk_file
+from LoadGenerator import RECORD_PERIOD_US, RECORDS_PER_PACKET, build_log_packet, synth_agent_log
+from PacketDecoder import LOG_BUFFER_SIZE, MICROS24_MASK
+
+# ---------------------------
+# 仮想エージェント（Pico ファームウェアの通信手順をそのまま真似る）
+#   warmUpUDP → HELLO/READY → REQUEST_PARAMS → (START 待ち or ボタン相当の自動開始)
+#   → 記録 → STOP で sendLogBuffer（パケットごとに HELLO/READY、送信、waitForAck、失敗したら再送）
+#   1台ごとに自分の UDP ソケットを持つので、サーバーからは別々の実機に見える。
+#   micros() は台ごとにばらばらの起動時刻から途切れずに進み（再生データの時刻は記録開始時の micros() に合わせてずらす）、
+#   予約コマンド（SYNC / START_AT / STOP_AT、ScheduledControl.py）にもファームウェアと同じく返事をする。
+#   merged_chunks のセッションを speed 倍速で再生でき、送受信の両方向に
+#   損失・ジッタ・順序入れ替え（遅延させて後のパケットに追い越させる）を入れられる。
+# ---------------------------
+HELLO_TIMEOUT = 1.0  # isServerReady の timeoutMs
+NOT_READY_DELAY = 0.5  # サーバーが応答しないときの delay(500)
+PARAM_TIMEOUT = 2.0  # requestParametersFromServer の待ち時間
+PARAM_INTERVAL = 10.0  # ポーズ中のパラメータ再要求の間隔
+ACK_TIMEOUT = 1.0  # waitForAck(..., 1000)
+RETRY_DELAY = 0.1  # ACK が来なかったときの delay(100)
+MAX_RETRIES = 100  # sendLogBuffer の maxRetries
+REORDER_DELAY = 0.05  # 入れ替え対象のパケットを遅らせる時間
+IMU_AGENT_ID = 99
+PERCENTILES = (50, 90, 99)
+
+
+class NetworkImpairment:
+    """
+    1方向分の損失・ジッタ・順序入れ替え。deliver(fn) で遅延させて fn を呼ぶ（捨てたら False）。
+    wake > 0 なら WiFi の省電力のように、届いたデータグラムを次の起床（wake 秒ごと、台ごとに位相が違う）まで待たせる。
+    """
+
+    def __init__(self, loss=0.0, jitter=0.0, reorder=0.0, reorder_delay=REORDER_DELAY, seed=None, wake=0.0):
+        self.loss = loss
+        self.jitter = jitter
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.rng = random.Random(seed)
+        self.wake = wake
+        self.wake_phase = self.rng.uniform(0.0, wake) if wake else 0.0
+
+    def deliver(self, loop, fn):
+        if self.loss and self.rng.random() < self.loss:
+            return False
+        delay = self.rng.uniform(0.0, self.jitter) if self.jitter else 0.0
+        if self.reorder and self.rng.random() < self.reorder:
+            delay += self.reorder_delay
+        if self.wake:
+            delay += (self.wake_phase - (loop.time() + delay)) % self.wake
+        if delay > 0:
+            loop.call_later(delay, fn)
+        else:
+            fn()
+        return True
+
+
+class EmulatorStats:
+    def __init__(self):
+        self.sent_packets = 0
+        self.retransmits = 0
+        self.acked_packets = 0
+        self.acked_records = 0
+        self.lost_out = 0  # 送信側で捨てたパケット
+        self.lost_in = 0  # 受信側で捨てたパケット（ACK など）
+        self.ack_mismatch = 0
+        self.aborted_packets = 0  # MAX_RETRIES を使い切ったパケット
+        self.hello_failures = 0
+        self.param_replies = 0
+        self.commands = {}
+        self.transitions = []  # (agent_id, "START"/"STOP", 何回目の記録か, 切り替えた PC 時刻)
+        self.ack_latency = []
+        self.first_send = None
+        self.last_ack = None
+
+    def command(self, name):
+        self.commands[name] = self.commands.get(name, 0) + 1
+
+    def transition(self, agent_id, name, round_index):
+        self.transitions.append((agent_id, name, round_index, time.time()))
+
+    def summary(self):
+        out = {
+            "sent": self.sent_packets, "retransmits": self.retransmits, "acked": self.acked_packets,
+            "records": self.acked_records, "lost_out": self.lost_out, "lost_in": self.lost_in,
+            "mismatch": self.ack_mismatch, "aborted": self.aborted_packets, "hello_fail": self.hello_failures,
+        }
+        span = (self.last_ack - self.first_send) if self.first_send and self.last_ack else 0.0
+        out["upload_sec"] = span
+        out["records_per_sec"] = self.acked_records / span if span else 0.0
+        out["packets_per_sec"] = self.acked_packets / span if span else 0.0
+        if self.ack_latency:
+            lat = np.array(self.ack_latency) * 1e3
+            for p, v in zip(PERCENTILES, np.percentile(lat, PERCENTILES)):
+                out[f"ack_p{p}_ms"] = float(v)
+            out["ack_max_ms"] = float(lat.max())
+        return out
+
+
+class _AgentProtocol(asyncio.DatagramProtocol):
+    def __init__(self, agent):
+        self.agent = agent
+
+    def datagram_received(self, data, addr):
+        agent = self.agent
+        if not agent.inbound.deliver(agent.loop, lambda: agent.on_datagram(data)):
+            agent.stats.lost_in += 1
+
+
+class VirtualAgent:
+    """
+    1台分の仮想 Pico。chunks は [(micros24, micros_raw, a0, a1, a2), ...]（1要素 = 1回の記録）。
+    """
+
+    def __init__(self, agent_id, chunks, server, stats, speed=1.0, auto=False, outbound=None, inbound=None):
+        self.agent_id = agent_id
+        self.chunks = chunks
+        self.server = server
+        self.stats = stats
+        self.speed = speed
+        self.auto = auto  # True: ボタンを押したのと同じく、自分で記録開始/停止する
+        self.outbound = outbound or NetworkImpairment()
+        self.inbound = inbound or NetworkImpairment()
+        self.loop = None
+        self.transport = None
+        self.inbox = None
+        self.paused = True
+        self.busy = None  # "upload"（sendLogBuffer）/ "params"（requestParametersFromServer）: parsePacket を返事待ちが使っている
+        self.control = None  # START/STOP を待つ Queue
+        self.clock_base = random.Random(agent_id).randrange(1 << 32)  # wall_base の時点での micros()
+        self.wall_base = 0.0
+        self.scheduled = {}  # "START"/"STOP" -> 予約の TimerHandle
+        self.round = 0
+
+    # ---------------------------
+    # 送受信
+    # ---------------------------
+    async def open(self):
+        self.loop = asyncio.get_running_loop()
+        self.wall_base = self.loop.time()
+        self.inbox = asyncio.Queue()
+        self.control = asyncio.Queue()
+        self.transport, _ = await self.loop.create_datagram_endpoint(lambda: _AgentProtocol(self),
+                                                                     local_addr=("0.0.0.0", 0))
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def send(self, data):
+        if not self.outbound.deliver(self.loop, lambda: self.transport.sendto(data, self.server)):
+            self.stats.lost_out += 1
+
+    def on_datagram(self, data):
+        if self.busy and (data in (b"START", b"STOP", b"CALIBRATE")
+                          or data.startswith((b"SYNC:", b"START_AT:", b"STOP_AT:"))):
+            # 返事待ちのループがコマンドを読んで捨てる。パラメータ要求は最初に届いた1個を返事とみなして待ちを終える
+            self.stats.command("DISCARDED")
+            if self.busy == "params":
+                self.inbox.put_nowait(data)
+            return
+        # checkControlCommand の strcmp(buf, "START") と同じく完全一致だけをコマンドとみなす
+        if data in (b"START", b"STOP", b"CALIBRATE"):
+            name = data.decode()
+            self.stats.command(name)
+            if name != "CALIBRATE":
+                self._cancel_scheduled(name)
+                self.control.put_nowait(name)
+            return
+        if data.startswith((b"SYNC:", b"START_AT:", b"STOP_AT:")):
+            self.on_scheduled_command(data)
+            return
+        self.inbox.put_nowait(data)
+
+    def on_scheduled_command(self, data):
+        rx_micros = self.micros()
+        kind, _, value = data.decode(errors="ignore").partition(":")
+        if not value.isdigit():
+            return
+        self.stats.command(kind)
+        if kind == "SYNC":
+            self.send(f"SYNC:{self.agent_id}:{value}:{rx_micros}".encode())
+            return
+        target = int(value)
+        self.send(f"ACK:{kind}:{self.agent_id}:{target}:{rx_micros}".encode())
+        name = kind[:-3]
+        if (name == "START") != self.paused:
+            return  # ファームウェアも記録中の START_AT・ポーズ中の STOP_AT は予約しない
+        self._cancel_scheduled(name)
+        delay = ((target - rx_micros + (1 << 31)) % (1 << 32) - (1 << 31)) / 1e6 / self.speed
+        self.scheduled[name] = self.loop.call_later(max(delay, 0.0), self._fire_scheduled, name)
+
+    def _fire_scheduled(self, name):
+        del self.scheduled[name]
+        self.control.put_nowait(name)
+
+    def _cancel_scheduled(self, name):
+        handle = self.scheduled.pop(name, None)
+        if handle is not None:
+            handle.cancel()
+
+    async def receive(self, timeout, accept):
+        """
+        accept(data) が True を返すデータグラムを timeout 秒まで待つ。来なければ None。
+        """
+        deadline = self.loop.time() + timeout
+        while True:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                return None
+            try:
+                data = await asyncio.wait_for(self.inbox.get(), remaining)
+            except asyncio.TimeoutError:
+                return None
+            if accept(data):
+                return data
+
+    def micros(self):
+        return int(self.clock_base + (self.loop.time() - self.wall_base) * 1e6 * self.speed) & 0xFFFFFFFF
+
+    # ---------------------------
+    # ファームウェアの手順
+    # ---------------------------
+    async def server_ready(self):
+        self.send(b"HELLO")
+        reply = await self.receive(HELLO_TIMEOUT, lambda d: d == b"READY")
+        return reply is not None
+
+    async def wait_ready(self):
+        while not await self.server_ready():
+            self.stats.hello_failures += 1
+            await asyncio.sleep(NOT_READY_DELAY)
+
+    async def request_params(self):
+        self.busy = "params"
+        try:
+            await self._request_params()
+        finally:
+            self.busy = None
+
+    async def _request_params(self):
+        analog26 = 2048 + self.agent_id
+        self.send(f"REQUEST_PARAMS,id:{self.agent_id},analog26:{analog26}".encode())
+        # ファームウェアは最初に届いたデータグラムを返事として読む（パースできなければ前の値のまま）
+        reply = await self.receive(PARAM_TIMEOUT, lambda d: True)
+        if reply is not None and reply.startswith(b"omega:"):
+            self.stats.param_replies += 1
+
+    async def wait_ack(self, expected_micros24):
+        def accept(data):
+            if len(data) < 4 or data[0] != self.agent_id:
+                return False
+            got = data[1] | (data[2] << 8) | (data[3] << 16)
+            if got != expected_micros24:
+                self.stats.ack_mismatch += 1
+                return False
+            return True
+        return await self.receive(ACK_TIMEOUT, accept) is not None
+
+    async def send_log_buffer(self, micros24, a0, a1, a2):
+        self.busy = "upload"
+        try:
+            await self._send_log_buffer(micros24, a0, a1, a2)
+        finally:
+            self.busy = None
+
+    async def _send_log_buffer(self, micros24, a0, a1, a2):
+        stats = self.stats
+        for i in range(0, len(micros24), RECORDS_PER_PACKET):
+            j = min(i + RECORDS_PER_PACKET, len(micros24))
+            last = int(micros24[j - 1])
+            for retry in range(MAX_RETRIES):
+                await self.wait_ready()
+                packet = build_log_packet(self.agent_id, self.micros(), micros24[i:j], a0[i:j], a1[i:j], a2[i:j])
+                t_send = self.loop.time()
+                if stats.first_send is None:
+                    stats.first_send = time.perf_counter()
+                self.send(packet)
+                stats.sent_packets += 1
+                if retry:
+                    stats.retransmits += 1
+                if await self.wait_ack(last):
+                    stats.ack_latency.append(self.loop.time() - t_send)
+                    stats.acked_packets += 1
+                    stats.acked_records += j - i
+                    stats.last_ack = time.perf_counter()
+                    break
+                await asyncio.sleep(RETRY_DELAY)
+            else:
+                stats.aborted_packets += 1
+
+    async def record(self, chunk):
+        """
+        記録中の状態。auto なら再生時間（speed 倍速）が過ぎたら、そうでなければ STOP で止まり、
+        その時点までのレコード（最大 LOG_BUFFER_SIZE 件）を返す。
+        """
+        _, raw, a0, a1, a2 = chunk
+        rel = (raw - raw[0]) / 1e6
+        # 再生データの時刻を記録開始時の micros() からに付け替える（logSensorData の micros24 = micros() >> 8）
+        raw = raw - raw[0] + self.micros()
+        micros24 = ((raw >> 8) & MICROS24_MASK).astype(np.uint32)
+        started = self.loop.time()
+        if self.auto:
+            await asyncio.sleep(rel[-1] / self.speed)
+            n = len(raw)
+        else:
+            while await self.control.get() != "STOP":
+                pass
+            self.stats.transition(self.agent_id, "STOP", self.round)
+            elapsed = (self.loop.time() - started) * self.speed
+            n = int(np.searchsorted(rel, elapsed, side="right"))
+        n = min(n, LOG_BUFFER_SIZE)
+        return micros24[:n], a0[:n], a1[:n], a2[:n]
+
+    async def wait_start(self):
+        # ポーズ中は START を待ちながら PARAM_INTERVAL ごとにパラメータを取り直す
+        while True:
+            try:
+                if await asyncio.wait_for(self.control.get(), PARAM_INTERVAL) == "START":
+                    self.stats.transition(self.agent_id, "START", self.round)
+                    return
+            except asyncio.TimeoutError:
+                if "START" not in self.scheduled:  # START を予約中はパラメータを取り直さない（ファームウェアと同じ）
+                    await self.request_params()
+
+    async def run(self):
+        await self.open()
+        try:
+            self.send(b"\x00")  # warmUpUDP
+            await self.wait_ready()
+            await self.request_params()
+            for self.round, chunk in enumerate(self.chunks):
+                if not self.auto:
+                    await self.wait_start()
+                self.paused = False
+                micros24, a0, a1, a2 = await self.record(chunk)
+                self.paused = True
+                await self.send_log_buffer(micros24, a0, a1, a2)
+                if self.auto:
+                    await self.request_params()
+        finally:
+            self.close()
+
+
+# ---------------------------
+# 再生データ
+# ---------------------------
+def load_replay(path):
+    """
+    マージ済みファイルをエージェントごと・チャンクごとの記録に分ける。
+    戻り値: {agent_id: [(micros24, micros_raw, a0, a1, a2), ...]}（チャンクは時刻順）
+    """
+    df = load_chunk_file(path, columns=["agent_id", "chunk_id", "time_pc_sec_abs", "micros32", "micros32_raw",
+                                        "a0", "a1", "a2"])
+    out = {}
+    starts = df.groupby(["agent_id", "chunk_id"], observed=True)["time_pc_sec_abs"].min().sort_values()
+    grouped = df.groupby(["agent_id", "chunk_id"], observed=True)
+    for agent_id, chunk_id in starts.index:
+        sub = grouped.get_group((agent_id, chunk_id))
+        raw = sub["micros32_raw"].to_numpy().astype(np.int64)
+        out.setdefault(int(agent_id), []).append((
+            (sub["micros32"].to_numpy().astype(np.int64) & MICROS24_MASK).astype(np.uint32),
+            raw,
+            sub["a0"].to_numpy().astype(np.uint8), sub["a1"].to_numpy().astype(np.uint8),
+            sub["a2"].to_numpy().astype(np.uint8),
+        ))
+    return out
+
+
+def synthetic_replay(num_agents, records=LOG_BUFFER_SIZE, chunks=1):
+    out = {}
+    for agent_id in range(1, num_agents + 1):
+        out[agent_id] = []
+        for c in range(chunks):
+            start = c * records * RECORD_PERIOD_US + agent_id * 1000
+            micros24, a0, a1, a2 = synth_agent_log(agent_id, records, start)
+            raw = start + np.arange(records, dtype=np.int64) * RECORD_PERIOD_US
+            out[agent_id].append((micros24, raw, a0, a1, a2))
+    return out
+
+
+def assign_agents(replay, num_agents=None):
+    """
+    num_agents 台に再生データを割り当てる（元の台数より多ければ使い回し、agent_id は 1.. で振り直す）。
+    agent_id は1バイトなので最大255台。
+    """
+    ids = sorted(replay)
+    if not num_agents:
+        return {a: replay[a] for a in ids}
+    if num_agents > 255:
+        raise ValueError("agent_id is one byte; at most 255 virtual agents")
+    return {k + 1: replay[ids[k % len(ids)]] for k in range(num_agents)}
+
+
+# ---------------------------
+# 実行
+# ---------------------------
+async def run_agents(server, replay, speed=1.0, auto=True, loss=0.0, jitter=0.0, reorder=0.0, seed=0, stats=None,
+                     wake=0.0):
+    stats = stats if stats is not None else EmulatorStats()
+    agents = [VirtualAgent(agent_id, chunks, server, stats, speed, auto,
+                           NetworkImpairment(loss, jitter, reorder, seed=seed * 1000 + agent_id),
+                           NetworkImpairment(loss, jitter, reorder, seed=seed * 1000 + agent_id + 500, wake=wake))
+              for agent_id, chunks in replay.items()]
+    t0 = time.perf_counter()
+    await asyncio.gather(*(agent.run() for agent in agents))
+    result = stats.summary()
+    result["agents"] = len(agents)
+    result["wall_sec"] = time.perf_counter() - t0
+    result["commands"] = dict(stats.commands)
+    return result
+
+
+def _start_server():
+    """
+    同一プロセス内でパイプラインサーバーをループバックに立てる（チャンクは保存せず件数だけ数える）。
+    """
+    from BatchReceiver import BatchReceiver, configure_socket
+    from ServerPipeline import ServerPipeline
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    configure_socket(sock)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(0.2)
+    stored = []
+    pipeline = ServerPipeline(sock, {}, chunk_timeout=60.0, receiver=BatchReceiver(sock, timeout=0.2),
+                              chunk_sink=lambda agent_id, columns, *_: stored.append(len(columns["micros24"])))
+    pipeline.start()
+    return sock, pipeline, stored
+
+
+def self_test(replay, speed, loss, jitter, reorder, seed, wake=0.0):
+    sock, pipeline, stored = _start_server()
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):  # サーバーの HELLO ごとの [INFO] を捨てる
+            result = asyncio.run(run_agents(sock.getsockname(), replay, speed, True, loss, jitter, reorder, seed,
+                                            wake=wake))
+            pipeline.flush_all()
+    finally:
+        with contextlib.redirect_stdout(log):
+            pipeline.stop()
+        sock.close()
+    result["records_stored"] = sum(stored)
+    print(pipeline.status_line())
+    return result
+
+
+def format_result(result):
+    return "[RESULT] " + " ".join(f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}" for k, v in result.items())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Emulate Pico agents over UDP (full protocol) for load testing.")
+    parser.add_argument("replay", nargs="?", default=None, help="merged file to replay (default: synthetic logs)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--agents", type=int, default=None, help="number of virtual agents (default: as recorded, or 10)")
+    parser.add_argument("--records", type=int, default=LOG_BUFFER_SIZE, help="synthetic: records per chunk")
+    parser.add_argument("--chunks", type=int, default=1, help="synthetic: chunks per agent")
+    parser.add_argument("--speed", type=float, default=10.0, help="replay speed factor")
+    parser.add_argument("--wait-start", action="store_true",
+                        help="wait for START/STOP from the server instead of starting/stopping on their own")
+    parser.add_argument("--loss", type=float, default=0.0, help="drop probability per datagram, each direction")
+    parser.add_argument("--jitter", type=float, default=0.0, help="max extra delay per datagram (s)")
+    parser.add_argument("--reorder", type=float, default=0.0, help="probability to delay a datagram past later ones")
+    parser.add_argument("--wake", type=float, default=0.0,
+                        help="hold datagrams to the agent until its next power-save wake-up, every WAKE s")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--self-test", action="store_true", help="start an in-process pipeline server on loopback")
+    args = parser.parse_args()
+
+    if args.replay:
+        replay = assign_agents(load_replay(args.replay), args.agents)
+    else:
+        replay = synthetic_replay(args.agents or 10, args.records, args.chunks)
+    total = sum(len(c[0]) for chunks in replay.values() for c in chunks)
+    print(f"[INFO] {len(replay)} virtual agents, {total} records, speed x{args.speed:g}")
+
+    if args.self_test:
+        result = self_test(replay, args.speed, args.loss, args.jitter, args.reorder, args.seed, args.wake)
+    else:
+        result = asyncio.run(run_agents((args.host, args.port), replay, args.speed, not args.wait_start,
+                                        args.loss, args.jitter, args.reorder, args.seed, wake=args.wake))
+    print(format_result(result))
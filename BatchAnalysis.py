@@ -0,0 +1,172 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
+matplotlib.use("Agg")  # ヘッドレス専用（図はファイルにだけ書く）
+
+import matplotlib.pyplot as plt
+import pandas as pd
+
+from ChunkStorage import list_data_files
+from Plotter import draw_relative_phase, prepare_session_times
+from SessionAnalysis import RESAMPLE_HZ, resample_phases, session_metrics
+from SessionLoader import load_session_files
+from TimeAnomalies import anomalous_groups, scan_time_anomalies
+
+# ---------------------------
+# merged_chunks 全体のバッチ解析
+#   読み込み → オーバーフロー補正 → 100Hz 再サンプル → 同期指標 をプロセスプールで並列に回し、
+#   1つの要約表 (exports/batch_summary.csv) にまとめる。
+#   結果はファイル内容のハッシュごとにキャッシュし、再実行では新しいセッションだけを処理する。
+# ---------------------------
+MERGED_FOLDER = "merged_chunks"
+EXPORT_FOLDER = "exports"
+CACHE_FOLDER = os.path.join(EXPORT_FOLDER, "batch_cache")
+SUMMARY_NAME = "batch_summary.csv"
+ANALYSIS_VERSION = 1  # 指標の定義を変えたら上げる（キャッシュが無効になる）
+HASH_BLOCK = 1 << 20
+
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _cache_path(digest, rate):
+    return os.path.join(CACHE_FOLDER, f"{digest}_v{ANALYSIS_VERSION}_{rate:g}hz.json")
+
+
+def _figure_path(path, figure_dir):
+    return os.path.join(figure_dir, os.path.splitext(os.path.basename(path))[0] + "_relphase.png")
+
+
+def analyze_file(path, rate=RESAMPLE_HZ, figure_dir=None):
+    """
+    1セッション分の解析（ワーカープロセスで実行）。結果は JSON にできる辞書。
+    途中の [FIX] などの出力は捨て、補正の件数だけ残す。
+    """
+    t0 = time.perf_counter()
+    result = {"file": os.path.basename(path), "status": "ok"}
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            df = load_session_files([path])
+            if df is None:
+                result["status"] = "empty"
+                return result
+            df = prepare_session_times(df, verbose=False)
+            anomalies = scan_time_anomalies(df)
+            resampled = resample_phases(df, rate)
+
+        result["rows"] = int(len(df))
+        result["chunks"] = int(len(anomalies))
+        result["agent_ids"] = " ".join(str(a) for a in sorted(df["agent_id"].unique()))
+        result["start"] = float(anomalies["start"].min())
+        result["anomalous_chunks"] = int(len(anomalous_groups(anomalies)))
+        result["time_fixes"] = log.getvalue().count("[FIX]")
+        if resampled is None:
+            result["status"] = "no_overlap"
+            return result
+
+        new_time_series, min_time, phases = resampled
+        result.update(session_metrics(new_time_series, phases, rate))
+        if figure_dir:
+            # Agent 99 しか無いセッションは相対位相の図を作らない（空文字で記録）
+            result["figure"] = _figure_path(path, figure_dir) if phases else ""
+            if phases:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    fig = draw_relative_phase(new_time_series, min_time, phases, df[df["agent_id"] == 99])
+                    fig.savefig(result["figure"])
+                plt.close(fig)
+    except Exception as e:
+        result["status"] = f"error: {e}"
+    finally:
+        result["elapsed_sec"] = time.perf_counter() - t0
+    return result
+
+
+def _load_cached(cache_file, figure_dir):
+    if not os.path.isfile(cache_file):
+        return None
+    with open(cache_file, encoding="utf-8") as f:
+        result = json.load(f)
+    # 図が要るのに無ければ計算し直す
+    if figure_dir and result.get("status") == "ok":
+        figure = result.get("figure")
+        if figure is None or (figure and not os.path.isfile(figure)):
+            return None
+    return result
+
+
+def run_batch(directory=MERGED_FOLDER, workers=None, figures=False, rate=RESAMPLE_HZ, limit=None, force=False):
+    """
+    ディレクトリ内のセッションを解析して要約表（DataFrame）を返し、exports/ に CSV で保存する。
+    """
+    paths = sorted(p for p in list_data_files(directory) if os.path.getsize(p) > 1)
+    if limit:
+        paths = paths[-limit:]
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+    figure_dir = os.path.join(EXPORT_FOLDER, "figures") if figures else None
+    if figure_dir:
+        os.makedirs(figure_dir, exist_ok=True)
+
+    t0 = time.perf_counter()
+    results = []
+    todo = []
+    for path in paths:
+        digest = file_digest(path)
+        cache_file = _cache_path(digest, rate)
+        cached = None if force else _load_cached(cache_file, figure_dir)
+        if cached is not None:
+            cached["file"] = os.path.basename(path)  # 同じ内容で名前だけ違う場合
+            results.append(cached)
+        else:
+            todo.append((path, digest, cache_file))
+    print(f"[INFO] {len(paths)} sessions: {len(paths) - len(todo)} cached, {len(todo)} to analyze "
+          f"({workers or os.cpu_count()} workers)")
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(analyze_file, path, rate, figure_dir): (path, digest, cache_file)
+                   for path, digest, cache_file in todo}
+        for done, future in enumerate(as_completed(futures), 1):
+            path, digest, cache_file = futures[future]
+            result = future.result()
+            result["digest"] = digest
+            results.append(result)
+            if not result["status"].startswith("error"):
+                with open(cache_file, "w", encoding="utf-8") as f:
+                    json.dump(result, f)
+            print(f"[INFO] ({done}/{len(todo)}) {result['file']}: {result['status']}, "
+                  f"R={result.get('order_mean', float('nan')):.3f}, {result['elapsed_sec']:.2f}s")
+
+    summary = pd.DataFrame(results).sort_values("file").reset_index(drop=True)
+    out = os.path.join(EXPORT_FOLDER, SUMMARY_NAME)
+    summary.to_csv(out, index=False)
+    print(f"[INFO] Summary of {len(summary)} sessions written to {out} in {time.perf_counter() - t0:.1f} s")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless synchronization analysis over merged sessions.")
+    parser.add_argument("directory", nargs="?", default=MERGED_FOLDER)
+    parser.add_argument("--workers", type=int, default=None, help="process pool size (default: CPU count)")
+    parser.add_argument("--figures", action="store_true", help="also render relative-phase PNGs to exports/figures")
+    parser.add_argument("--rate", type=float, default=RESAMPLE_HZ, help="resampling rate in Hz")
+    parser.add_argument("--limit", type=int, default=None, help="only the newest N files")
+    parser.add_argument("--force", action="store_true", help="ignore the cache")
+    args = parser.parse_args()
+    summary = run_batch(args.directory, args.workers, args.figures, args.rate, args.limit, args.force)
+    columns = [c for c in ["file", "status", "agents", "duration_sec", "order_mean", "order_final",
+                           "lock_longest_sec", "drift_mean", "freq_spread"] if c in summary.columns]
+    print(summary[columns].tail(20).to_string(index=False, float_format=lambda x: f"{x:.3f}"))
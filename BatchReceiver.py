@@ -0,0 +1,241 @@
+import ctypes
+import errno
+import os
+import select
+import socket
+import struct
+
+# ---------------------------
+# 受信バッチ化の設定
+# ---------------------------
+SOCKET_RCVBUF = 8 * 1024 * 1024  # 8 MB（Linuxでは net.core.rmem_max で上限がかかる）
+BATCH_SIZE = 64                 # 1回のシステムコールで取り出す最大データグラム数
+SLOT_SIZE = 2048                # リングの1スロット（Picoのパケットは最大512バイト）
+
+SOL_SOCKET = getattr(socket, "SOL_SOCKET", 1)
+SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", 40)  # Linux のみ
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0x40)
+_CONTROL_SIZE = 32  # CMSG_SPACE(4) = 24 に余裕を持たせる
+
+
+def configure_socket(sock, rcvbuf=SOCKET_RCVBUF):
+    """
+    SO_RCVBUF を拡張し、可能なら SO_RXQ_OVFL（カーネルの破棄数通知）を有効にする。
+    実際に確保された受信バッファサイズを返す。
+    """
+    try:
+        sock.setsockopt(SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    except OSError as e:
+        print(f"[WARN] Could not set SO_RCVBUF={rcvbuf}: {e}")
+    actual = sock.getsockopt(SOL_SOCKET, socket.SO_RCVBUF)
+    # Linux はカーネル内部で2倍の値を返す
+    if actual < rcvbuf:
+        print(f"[WARN] SO_RCVBUF limited to {actual} bytes (requested {rcvbuf}). "
+              f"Raise net.core.rmem_max to allow more.")
+    if os.name != "nt":
+        try:
+            sock.setsockopt(SOL_SOCKET, SO_RXQ_OVFL, 1)
+        except OSError:
+            pass
+    return actual
+
+
+def read_proc_udp_drops(port):
+    """
+    /proc/net/udp(6) からローカルポートに対応するソケットの drops 列を合計する。
+    取得できない環境では None。
+    """
+    total = None
+    for path in ("/proc/net/udp", "/proc/net/udp6"):
+        try:
+            with open(path) as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    local_port = int(fields[1].rsplit(":", 1)[1], 16)
+                    if local_port == port:
+                        total = (total or 0) + int(fields[-1])
+        except (OSError, ValueError, IndexError, StopIteration):
+            continue
+    return total
+
+
+# ---------------------------
+# recvmmsg (ctypes) の構造体定義
+# ---------------------------
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+def _load_recvmmsg():
+    if not hasattr(socket, "AF_INET") or os.name == "nt":
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fn = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    fn.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    fn.restype = ctypes.c_int
+    return fn
+
+
+_recvmmsg = _load_recvmmsg()
+_CMSG_HDR = struct.Struct("@NiI")  # cmsg_len, cmsg_level, cmsg_type（+ データは8バイト境界）
+
+
+class BatchReceiver:
+    """
+    1回のシステムコールで複数のデータグラムを再利用リングへ受信する。
+    Linux では recvmmsg(2)、それ以外では recvmsg_into / recvfrom で同じインターフェースを提供する。
+    """
+
+    def __init__(self, sock, batch_size=BATCH_SIZE, slot_size=SLOT_SIZE, timeout=1.0):
+        self.sock = sock
+        self.batch_size = batch_size
+        self.slot_size = slot_size
+        self.timeout = timeout
+        self.kernel_drops = 0  # SO_RXQ_OVFL で通知された累積破棄数
+        self.syscalls = 0
+        self.datagrams = 0
+
+        self._port = sock.getsockname()[1]
+        self._ring = bytearray(batch_size * slot_size)
+        self._view = memoryview(self._ring)
+
+        if _recvmmsg is not None:
+            self.mode = "recvmmsg"
+            self._setup_recvmmsg()
+        elif hasattr(sock, "recvmsg_into"):
+            self.mode = "recvmsg_into"
+        else:
+            self.mode = "recvfrom"
+
+    def _setup_recvmmsg(self):
+        n = self.batch_size
+        self._ring_c = (ctypes.c_char * len(self._ring)).from_buffer(self._ring)
+        base = ctypes.addressof(self._ring_c)
+        self._iov = (_IOVec * n)()
+        self._names = ctypes.create_string_buffer(16 * n)  # sockaddr_in
+        self._control = ctypes.create_string_buffer(_CONTROL_SIZE * n)
+        self._msgs = (_MMsgHdr * n)()
+        names = ctypes.addressof(self._names)
+        control = ctypes.addressof(self._control)
+        for i in range(n):
+            self._iov[i].iov_base = base + i * self.slot_size
+            self._iov[i].iov_len = self.slot_size
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = names + 16 * i
+            hdr.msg_iov = ctypes.pointer(self._iov[i])
+            hdr.msg_iovlen = 1
+            hdr.msg_control = control + _CONTROL_SIZE * i
+
+    def _wait_readable(self):
+        ready, _, _ = select.select([self.sock], [], [], self.timeout)
+        return bool(ready)
+
+    def recv_batch(self):
+        """
+        受信可能になるまで最大 timeout 秒待ち、取り出せるだけ取り出す。
+        [(data: bytes, addr), ...] を返す（タイムアウト時は空リスト）。
+        """
+        if not self._wait_readable():
+            return []
+        if self.mode == "recvmmsg":
+            return self._recv_recvmmsg()
+        if self.mode == "recvmsg_into":
+            return self._recv_recvmsg_into()
+        return self._recv_recvfrom()
+
+    def _recv_recvmmsg(self):
+        n = self.batch_size
+        for i in range(n):
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_namelen = 16
+            hdr.msg_controllen = _CONTROL_SIZE
+            hdr.msg_flags = 0
+        count = _recvmmsg(self.sock.fileno(), self._msgs, n, MSG_DONTWAIT, None)
+        self.syscalls += 1
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(err, os.strerror(err))
+
+        out = []
+        names = self._names.raw
+        for i in range(count):
+            length = self._msgs[i].msg_len
+            start = i * self.slot_size
+            raw = names[16 * i:16 * i + 16]
+            addr = (socket.inet_ntoa(raw[4:8]), int.from_bytes(raw[2:4], "big"))
+            out.append((bytes(self._view[start:start + length]), addr))
+            if self._msgs[i].msg_hdr.msg_controllen:
+                self._parse_control(i)
+        self.datagrams += count
+        return out
+
+    def _parse_control(self, i):
+        offset = i * _CONTROL_SIZE
+        cmsg_len, level, kind = _CMSG_HDR.unpack_from(self._control, offset)
+        if level == SOL_SOCKET and kind == SO_RXQ_OVFL and cmsg_len >= _CMSG_HDR.size + 4:
+            data_offset = offset + ((_CMSG_HDR.size + 7) & ~7)
+            self.kernel_drops = max(self.kernel_drops, struct.unpack_from("@I", self._control, data_offset)[0])
+
+    def _recv_recvmsg_into(self):
+        out = []
+        for i in range(self.batch_size):
+            slot = self._view[i * self.slot_size:(i + 1) * self.slot_size]
+            try:
+                nbytes, ancdata, _, addr = self.sock.recvmsg_into([slot], _CONTROL_SIZE, MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                break
+            self.syscalls += 1
+            for level, kind, cdata in ancdata:
+                if level == SOL_SOCKET and kind == SO_RXQ_OVFL and len(cdata) >= 4:
+                    self.kernel_drops = max(self.kernel_drops, struct.unpack_from("@I", cdata)[0])
+            out.append((bytes(slot[:nbytes]), addr))
+        self.datagrams += len(out)
+        return out
+
+    def _recv_recvfrom(self):
+        out = []
+        self.sock.setblocking(False)
+        try:
+            for _ in range(self.batch_size):
+                try:
+                    out.append(self.sock.recvfrom(self.slot_size))
+                except (BlockingIOError, InterruptedError):
+                    break
+                self.syscalls += 1
+        finally:
+            self.sock.settimeout(self.timeout)
+        self.datagrams += len(out)
+        return out
+
+    def drop_summary(self):
+        try:
+            self._port = self.sock.getsockname()[1]
+        except OSError:
+            pass  # クローズ後は最後に分かっているポートを使う
+        proc = read_proc_udp_drops(self._port) if self._port else None
+        per_call = self.datagrams / self.syscalls if self.syscalls else 0.0
+        return (f"[STATS] recv mode={self.mode} datagrams={self.datagrams} syscalls={self.syscalls} "
+                f"({per_call:.1f}/call) kernel_drops(SO_RXQ_OVFL)={self.kernel_drops} "
+                f"proc_drops={proc if proc is not None else 'n/a'}")
@@ -0,0 +1,264 @@
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from ChunkStorage import EXTENSIONS, HAS_PYARROW, SAVE_COLUMNS, check_format, format_for_path, load_chunk_file, save_chunk_frame, to_narrow
+
+if HAS_PYARROW:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+# ---------------------------
+# チャンクファイルのマージ
+#   ファイルを1つずつ（大きなファイルはブロックごとに）読み、出力へ順に書き出す。
+#   pd.concat をループ内で繰り返さないので、チャンク数に対して線形時間。
+#   sort_by_time=True のときは time_pc_sec_abs で k-way マージする。
+# ---------------------------
+BLOCK_ROWS = 65536
+SORT_KEY = "time_pc_sec_abs"
+
+
+def iter_file_blocks(path, block_rows=BLOCK_ROWS):
+    """
+    ファイルを最大 block_rows 行ずつの DataFrame として順に返す。
+    CSV はストリーミングで読み、バイナリ形式は読み込み後にスライスする。
+    """
+    if format_for_path(path) == "csv":
+        try:
+            for block in pd.read_csv(path, chunksize=block_rows):
+                yield block
+        except pd.errors.EmptyDataError:
+            return
+        return
+    df = load_chunk_file(path)
+    for start in range(0, len(df), block_rows):
+        yield df.iloc[start:start + block_rows]
+
+
+def _sorted_blocks(path, block_rows):
+    """
+    ファイルを時刻順のブロック列として返す。バイナリ形式はファイル全体を、
+    CSV はブロックごとに並べ替える（ブロックをまたぐ逆行は警告だけ出す）。
+    """
+    if format_for_path(path) != "csv":
+        df = load_chunk_file(path)
+        if len(df) > 1:
+            df = df.iloc[np.argsort(df[SORT_KEY].to_numpy(), kind="stable")]
+        for start in range(0, len(df), block_rows):
+            yield df.iloc[start:start + block_rows]
+        return
+
+    prev_last = -np.inf
+    reversed_rows = 0
+    for block in iter_file_blocks(path, block_rows):
+        key = block[SORT_KEY].to_numpy()
+        if len(key) > 1 and (np.diff(key) < 0).any():
+            block = block.iloc[np.argsort(key, kind="stable")]
+            key = block[SORT_KEY].to_numpy()
+        if len(key):
+            reversed_rows += int(np.count_nonzero(key < prev_last))
+            prev_last = key[-1]
+        yield block
+    if reversed_rows:
+        print(f"[WARN] {reversed_rows} rows in {path} go back in time across blocks; "
+              f"merged output is not strictly sorted there.")
+
+
+def kway_merge(paths, block_rows=BLOCK_ROWS):
+    """
+    各ファイル（時刻順）を time_pc_sec_abs で k-way マージし、ブロック単位で返す。
+    全ソースの現在ブロックの末尾時刻の最小値までを一括で並べ替えて出力するので、
+    行ごとのヒープ操作は行わない。保持するのは各ソース1ブロック分だけ。
+    """
+    sources = []
+    for path in paths:
+        it = _sorted_blocks(path, block_rows)
+        block = next(it, None)
+        if block is not None and len(block):
+            sources.append([it, block])
+
+    while sources:
+        threshold = min(block[SORT_KEY].iat[-1] for _, block in sources)
+        parts = []
+        remaining = []
+        for src in sources:
+            it, block = src
+            key = block[SORT_KEY].to_numpy()
+            n = np.searchsorted(key, threshold, side="right")
+            if n:
+                parts.append(block.iloc[:n])
+            block = block.iloc[n:]
+            while block is not None and not len(block):
+                block = next(it, None)
+            if block is not None:
+                src[1] = block
+                remaining.append(src)
+        sources = remaining
+
+        out = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0].reset_index(drop=True)
+        order = np.argsort(out[SORT_KEY].to_numpy(), kind="stable")
+        yield out.iloc[order]
+
+
+def _concat_blocks(paths, block_rows):
+    for path in paths:
+        yield from iter_file_blocks(path, block_rows)
+
+
+class _MergeWriter:
+    """
+    ブロックを受け取り出力ファイルへ書く。csv と parquet は追記でストリーミング、
+    npz / feather は最後に1回だけ結合して保存する。
+    """
+
+    def __init__(self, path_no_ext, fmt):
+        self.fmt = check_format(fmt)
+        self.path = path_no_ext + EXTENSIONS[self.fmt]
+        self.rows = 0
+        self._blocks = []
+        self._file = None
+        self._parquet = None
+
+    def write(self, block):
+        columns = [c for c in SAVE_COLUMNS if c in block.columns]
+        block = block[columns]
+        if self.fmt == "csv":
+            if self._file is None:
+                self._file = open(self.path, "w", newline="")
+                block.to_csv(self._file, index=False)
+            else:
+                block.to_csv(self._file, index=False, header=False)
+        elif self.fmt == "parquet":
+            narrow = to_narrow(block)
+            narrow["chunk_id"] = narrow["chunk_id"].astype(str)
+            table = pa.Table.from_pandas(narrow, preserve_index=False)
+            if self._parquet is None:
+                self._parquet = pq.ParquetWriter(self.path, table.schema)
+            self._parquet.write_table(table)
+        else:
+            self._blocks.append(block)
+        self.rows += len(block)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        elif self._parquet is not None:
+            self._parquet.close()
+        elif self.fmt in ("npz", "feather") and self._blocks:
+            merged = pd.concat(self._blocks, ignore_index=True)
+            self._blocks = []
+            save_chunk_frame(merged, os.path.splitext(self.path)[0], self.fmt)
+        elif self.rows == 0:
+            return None
+        return self.path
+
+
+def stream_merge(chunk_files, path_no_ext, fmt="csv", sort_by_time=False, block_rows=BLOCK_ROWS):
+    """
+    チャンクファイル群を1つのファイルにマージし、(出力パス, 行数) を返す。
+    """
+    writer = _MergeWriter(path_no_ext, fmt)
+    blocks = kway_merge(chunk_files, block_rows) if sort_by_time else _concat_blocks(chunk_files, block_rows)
+    for block in blocks:
+        writer.write(block)
+    return writer.close(), writer.rows
+
+
+# ---------------------------
+# ベンチマーク（合成100チャンクのセッション）
+# ---------------------------
+def _legacy_merge(chunk_files, path):
+    # 従来の merge_and_save_chunks と同じループ内 concat
+    merged_data = pd.DataFrame()
+    for file in chunk_files:
+        df = load_chunk_file(file)
+        merged_data = pd.concat([merged_data, df], ignore_index=True)
+    merged_data.to_csv(path, index=False)
+    return len(merged_data)
+
+
+def make_synthetic_session(directory, num_chunks=100, rows_per_chunk=28000, num_agents=10, fmt="npz"):
+    """
+    num_agents 台が交互にチャンクを出す合成セッションを作り、ファイルパスのリストを返す。
+    """
+    rng = np.random.default_rng(0)
+    files = []
+    for c in range(num_chunks):
+        agent_id = c % num_agents + 1
+        start = 1.744e9 + (c // num_agents) * rows_per_chunk * 0.01 + rng.uniform(0, 0.01)
+        micros32 = np.arange(rows_per_chunk, dtype=np.uint32) * 39 + agent_id * 1000
+        micros32_raw = micros32.astype(np.int64) << 8
+        df = pd.DataFrame({
+            "time_pc_sec_abs": start + np.arange(rows_per_chunk) * 0.01,
+            "micros32": micros32,
+            "micros32_raw": micros32_raw,
+            "time_local_sec": micros32_raw / 1e6,
+            "a0": rng.integers(0, 256, rows_per_chunk, dtype=np.uint8),
+            "a1": rng.integers(0, 256, rows_per_chunk, dtype=np.uint8),
+            "a2": rng.integers(0, 256, rows_per_chunk, dtype=np.uint8),
+            "agent_id": agent_id,
+            "chunk_id": f"2025{c:010d}",
+        })
+        files.append(save_chunk_frame(df, os.path.join(directory, f"chunk_{c:03d}"), fmt))
+    return files
+
+
+def _run_case(fn, conn):
+    import resource
+    base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.perf_counter()
+    rows = fn()
+    elapsed = time.perf_counter() - t0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base  # Linux: KB
+    conn.send((rows, elapsed, peak * 1024))
+    conn.close()
+
+
+def measure(fn):
+    """
+    別プロセス（fork）で fn を実行し、(行数, 秒, ピークRSS増加バイト) を返す。
+    """
+    ctx = multiprocessing.get_context("fork")
+    parent, child = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_run_case, args=(fn, child))
+    proc.start()
+    result = parent.recv()
+    proc.join()
+    return result
+
+
+def benchmark(num_chunks=100, rows_per_chunk=28000, chunk_format="npz"):
+    with tempfile.TemporaryDirectory() as tmp:
+        files = make_synthetic_session(tmp, num_chunks, rows_per_chunk, fmt=chunk_format)
+        total = num_chunks * rows_per_chunk
+        print(f"[BENCH] {num_chunks} {chunk_format} chunks x {rows_per_chunk} rows = {total} rows")
+
+        cases = [
+            ("legacy concat-in-loop -> csv", lambda: _legacy_merge(files, os.path.join(tmp, "legacy.csv"))),
+            ("stream -> csv", lambda: stream_merge(files, os.path.join(tmp, "stream"), "csv")[1]),
+            ("stream -> npz", lambda: stream_merge(files, os.path.join(tmp, "stream"), "npz")[1]),
+            ("k-way sorted -> csv", lambda: stream_merge(files, os.path.join(tmp, "sorted"), "csv", sort_by_time=True)[1]),
+        ]
+        if HAS_PYARROW:
+            cases.append(("stream -> parquet", lambda: stream_merge(files, os.path.join(tmp, "stream"), "parquet")[1]))
+        for name, fn in cases:
+            rows, elapsed, peak = measure(fn)
+            print(f"[BENCH] {name:30s} rows={rows} time={elapsed:7.2f} s  peak_rss_delta={peak / 1e6:8.1f} MB")
+
+        merged, _ = stream_merge(files, os.path.join(tmp, "check"), "npz", sort_by_time=True)
+        t = load_chunk_file(merged)[SORT_KEY].to_numpy()
+        print(f"[BENCH] k-way output sorted: {bool((np.diff(t) >= 0).all())}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark chunk merging on a synthetic session.")
+    parser.add_argument("--chunks", type=int, default=100)
+    parser.add_argument("--rows", type=int, default=28000)
+    parser.add_argument("--format", default="npz", choices=list(EXTENSIONS), help="chunk file format")
+    args = parser.parse_args()
+    benchmark(args.chunks, args.rows, args.format)
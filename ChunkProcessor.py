@@ -1,60 +1,70 @@
 import os
+import sqlite3
+import numpy as np
 import pandas as pd
 from datetime import datetime
+from ChunkStorage import SAVE_COLUMNS, save_chunk_frame
+from ChunkMerge import stream_merge
+from TimeReconstruction import mean_clock_offset, reconstruct_chunk_times
+from SessionIndex import index_file
 
 SAVE_FOLDER = "saved_chunks"  # 保存用フォルダ名
+CHUNK_FORMAT = "npz"   # チャンクファイルの形式 (csv / npz / parquet / feather)
+MERGED_FORMAT = "csv"  # マージファイルの形式（MATLAB の main_plot.m で読むなら csv）
+MERGE_SORT_BY_TIME = False  # True: マージファイルを time_pc_sec_abs 順に並べる
+CLOCK_FALLBACK_SEC = 0.5  # 時計同期の時刻がこのチャンク自身の平均オフセットからこれ以上ずれたら使わない
 
 # 保存用フォルダを作成（存在しない場合のみ）
 if not os.path.exists(SAVE_FOLDER):
     os.makedirs(SAVE_FOLDER)
 
-def build_dataframe_for_chunk(agent_id, chunk_data, chunk_send_micros, chunk_recv_times):
-    if not chunk_data:
+def _chunk_length(chunk_data):
+    # chunk_data は列の辞書 (AgentChunkBuffer.columns()) または (micros24, a0, a1, a2) のリスト
+    if isinstance(chunk_data, dict):
+        return len(chunk_data["micros24"])
+    return len(chunk_data)
+
+def build_dataframe_for_chunk(agent_id, chunk_data, chunk_send_micros, chunk_recv_times, clock=None, chunk_time=None):
+    # chunk_time: チャンク名に使う時刻 (datetime)。サーバーは締めた時刻、ジャーナルからの復元では受信時刻を渡す（省略時は現在時刻）
+    if not chunk_data or _chunk_length(chunk_data) == 0:
         return None, None  # データがない場合は None を返す
 
     # 平均オフセットを送信時刻の下位24ビット再構成で算出
-    wrapped_send_secs = [(((s >> 8) % 16777216) << 8) / 1e6 for s in chunk_send_micros]
-    offsets = [recv - send for send, recv in zip(wrapped_send_secs, chunk_recv_times)]
-    offset = sum(offsets) / len(offsets)
-    print(len(offsets), f"Average offset for agent {agent_id}: {offset:.6f} seconds")
+    offset = mean_clock_offset(chunk_send_micros, chunk_recv_times)
+    print(len(chunk_recv_times), f"Average offset for agent {agent_id}: {offset:.6f} seconds")
 
     df = pd.DataFrame(chunk_data, columns=["micros24", "a0", "a1", "a2"])
-    
-    micros_list = df["micros24"].tolist()
-    extended = [0] * len(micros_list)
-    wrap_offset = 0
-    prev = micros_list[0]
-    extended[0] = prev
-    for i in range(1, len(micros_list)):
-        curr = micros_list[i]
-        if curr < prev:
-            wrap_offset += 16777216  # 24ビットのオーバーフローを補正
-        extended[i] = curr + wrap_offset
-        prev = curr
-
-    df["micros32"] = extended
-    df["micros32_raw"] = [val << 8 for val in extended]  # 24ビットを32ビットに拡張
-    df["time_local_sec"] = [val / 1e6 for val in df["micros32_raw"]]
-    df["time_pc_sec_abs"] = df["time_local_sec"] + offset
-
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    # 24ビットのオーバーフロー展開と時刻変換をまとめて計算
+    for name, values in reconstruct_chunk_times(df["micros24"].to_numpy(), offset).items():
+        df[name] = values
+
+    # 時計同期の推定器があれば、平均オフセットの代わりに offset + skew で PC 時刻を付け直す
+    # （再起動をまたいだ推定など、チャンク自身の送受信と食い違うときは平均オフセットのまま）
+    if clock is not None and clock.ready:
+        retimed = clock.retime(df["time_local_sec"].to_numpy())
+        residual = float(np.max(np.abs(retimed - df["time_pc_sec_abs"].to_numpy())))
+        if residual <= CLOCK_FALLBACK_SEC:
+            df["time_pc_sec_abs"] = retimed
+            print(f"[INFO] Agent {agent_id} clock sync: {clock.summary()}")
+        else:
+            print(f"[WARN] Agent {agent_id} clock sync is {residual:.3f} s off this chunk's own offset; "
+                  f"using the mean offset.")
+
+    # 同じ秒に締めたチャンクでも名前が重ならないようにマイクロ秒まで付ける
+    timestamp = (chunk_time or datetime.now()).strftime("%Y%m%d_%H%M%S_%f")
     chunk_id = timestamp
     df["agent_id"] = agent_id
     df["chunk_id"] = chunk_id
 
     # 保存先を保存用フォルダに変更
-    filename = os.path.join(SAVE_FOLDER, f"chunk_agent_{agent_id}_{timestamp}.csv")
-    save_columns = [
-        "time_pc_sec_abs", "micros32", "micros32_raw", "time_local_sec",
-        "a0", "a1", "a2", "agent_id", "chunk_id"
-    ]
-    df.to_csv(filename, index=False, columns=save_columns)
+    filename = save_chunk_frame(df[SAVE_COLUMNS], os.path.join(SAVE_FOLDER, f"chunk_agent_{agent_id}_{timestamp}"), CHUNK_FORMAT)
     print(f"[INFO] Agent={agent_id}, chunk size={len(df)} -> Saved to {filename}")
 
     # ファイルパスも返す
     return df[["agent_id", "chunk_id", "time_pc_sec_abs", "a0", "a1", "a2"]], filename
 
-def merge_and_save_chunks(chunk_files):
+def merge_and_save_chunks(chunk_files, sort_by_time=MERGE_SORT_BY_TIME):
     # チャンクファイルが存在しない場合は処理をスキップ
     if not chunk_files:
         print("[INFO] No chunk files provided. Skipping merge process.")
@@ -65,19 +75,18 @@ def merge_and_save_chunks(chunk_files):
     if not os.path.exists(merged_folder):
         os.makedirs(merged_folder)
 
-    # マージ処理
-    merged_data = pd.DataFrame()
-    for file in chunk_files:
-        df = pd.read_csv(file)
-        merged_data = pd.concat([merged_data, df], ignore_index=True)
+    # 保存先ファイル名の生成（手動フラッシュと終了時のマージが同じ秒に重なっても上書きしないようマイクロ秒まで付ける）
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    # マージ処理（ファイルを順に読みながら書き出す。sort_by_time なら時刻順に k-way マージ）
+    merged_file, rows = stream_merge(chunk_files, os.path.join(merged_folder, f"merged_{timestamp}"), MERGED_FORMAT, sort_by_time)
+    print(f"[INFO] Merged data saved to {merged_file} ({rows} rows)")
 
-    # 保存先ファイル名の生成
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    merged_file = os.path.join(merged_folder, f"merged_{timestamp}.csv")
-
-    # マージデータを保存
-    merged_data.to_csv(merged_file, index=False)
-    print(f"[INFO] Merged data saved to {merged_file}")
+    # セッションインデックスに追加（失敗してもマージ結果には影響させない）
+    if merged_file:
+        try:
+            index_file(merged_file, merged_folder)
+        except (sqlite3.Error, OSError) as e:
+            print(f"[WARN] Could not update session index: {e}")
 
     # チャンクファイルを削除
     for file in chunk_files:
@@ -0,0 +1,280 @@
+import argparse
+import contextlib
+import heapq
+import io
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from ServerMetrics import record_saved_file
+
+# ---------------------------
+# チャンクの締め切りと書き出し
+#   FlushScheduler: エージェントごとの締め切り（最後の受信 + CHUNK_TIMEOUT）をヒープで持ち、
+#     タイマーから due() を呼ぶと黙ったエージェントのチャンクを時間どおりに締められる。
+#     パケットごとの処理は dict の更新だけで、ヒープは1エージェント1件（期限が来たときに延長して入れ直す）。
+#   ChunkWriterPool: 締めたチャンクの DataFrame 化と保存を別スレッドで行う。
+#     受信側は列のコピーを渡すだけで pandas やファイルシステムを待たない。
+#     書き出し待ちが MAX_BACKLOG 件を超えたときだけ submit が待つ（メモリの上限）。
+# ---------------------------
+FLUSH_TICK_SEC = 0.5  # 締め切りを調べる間隔（チャンクは最大 CHUNK_TIMEOUT + この時間で締まる）
+WRITER_THREADS = 2
+MAX_BACKLOG = 64  # 書き出し待ちのチャンク数の上限（1チャンク 28000 行で約 0.4 MB）
+
+
+class FlushScheduler:
+    """
+    エージェントごとの無通信の締め切り。1つのスレッドからだけ使う。
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.last = {}  # agent_id -> 最後の受信時刻
+        self._heap = []  # (締め切り, agent_id)。エージェントごとに高々1件
+        self._scheduled = set()
+
+    def touch(self, agent_id, now):
+        """
+        agent_id から受信したことを記録する。前の受信から timeout を超えていれば True（先に締めること）。
+        """
+        last = self.last.get(agent_id)
+        self.last[agent_id] = now
+        if agent_id not in self._scheduled:
+            self._scheduled.add(agent_id)
+            heapq.heappush(self._heap, (now + self.timeout, agent_id))
+        return last is not None and now - last > self.timeout
+
+    def due(self, now):
+        """
+        締め切りを過ぎた（timeout 以上黙っている）エージェントの一覧。返したエージェントは次の受信まで予定から外す。
+        """
+        heap = self._heap
+        expired = []
+        while heap and heap[0][0] <= now:
+            _, agent_id = heapq.heappop(heap)
+            deadline = self.last[agent_id] + self.timeout
+            if deadline <= now:
+                self._scheduled.discard(agent_id)
+                expired.append(agent_id)
+            else:
+                heapq.heappush(heap, (deadline, agent_id))  # その後も受信していたので延長
+        return expired
+
+
+class ChunkWriterPool:
+    """
+    チャンク保存のスレッドプール。save(agent_id, columns, send_list, recv_list, clock, chunk_time) -> 保存ファイルパス or None。
+    chunk_time は submit() で締めた時刻 (datetime)。保存済みファイルは書き終わった順ではなく締めた順に返す。
+    """
+
+    def __init__(self, save, metrics=None, workers=WRITER_THREADS, max_backlog=MAX_BACKLOG):
+        self.save = save
+        self.metrics = metrics
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chunk-writer")
+        self._merger = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chunk-merge")  # マージは1つずつ
+        self._slots = threading.BoundedSemaphore(max_backlog)
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+        self._sealed = 0  # 次に締めるチャンクの通し番号
+        self._writing = set()  # 書き出し中のチャンクの通し番号
+        self._merged = 0  # after_written に渡し済みの区切り
+        self.saved_files = []  # (通し番号, パス)
+        self.failed = []  # 保存に失敗したチャンクの通し番号
+        if metrics is not None:
+            metrics.gauge("write_backlog", lambda: self.pending)
+
+    @property
+    def pending(self):
+        return len(self._writing)
+
+    def submit(self, agent_id, columns, send_list, recv_list, clock=None):
+        """
+        締めたチャンクを書き出しに回す。columns などは呼び出し側がもう触らないコピーを渡すこと。
+        """
+        sealed_at = time.time()
+        self._slots.acquire()
+        with self._lock:
+            seq = self._sealed
+            self._sealed += 1
+            self._writing.add(seq)
+            if self.metrics is not None:
+                self.metrics.track_max("write_backlog", self.pending)
+            self._executor.submit(self._write, seq, agent_id, columns, send_list, recv_list, clock, sealed_at)
+
+    def _write(self, seq, agent_id, columns, send_list, recv_list, clock, sealed_at):
+        try:
+            t0 = time.time()
+            saved_file = self.save(agent_id, columns, send_list, recv_list, clock, datetime.fromtimestamp(sealed_at))
+            t1 = time.time()
+            if self.metrics is not None:
+                self.metrics.observe("chunk_flush", t1 - t0)
+                self.metrics.observe("flush_latency", t1 - sealed_at)
+                if saved_file:
+                    record_saved_file(self.metrics, saved_file)
+            if saved_file:
+                with self._lock:
+                    self.saved_files.append((seq, saved_file))
+        except Exception as e:
+            print(f"[ERROR] Failed to save chunk for agent {agent_id}: {e}")
+            with self._lock:
+                self.failed.append(seq)
+        finally:
+            self._slots.release()
+            with self._lock:
+                self._writing.discard(seq)
+                self._done.notify_all()
+
+    def mark(self):
+        """
+        ここまでに締めたチャンクの区切り（wait / take_saved_files / after_written に渡す）。
+        """
+        with self._lock:
+            return self._sealed
+
+    def wait(self, upto=None):
+        """
+        upto より前に締めたチャンク（None ならすべて）の書き出しが終わるまで待つ。
+        """
+        with self._lock:
+            while self._writing and (upto is None or min(self._writing) < upto):
+                self._done.wait()
+
+    def take_saved_files(self, upto=None, since=0):
+        """
+        通し番号が since 以上 upto 未満のチャンク（upto が None なら since 以降すべて）の保存済みファイルを、
+        締めた順に取り出す。
+        """
+        with self._lock:
+            end = self._sealed if upto is None else upto
+            taken = [f for f in self.saved_files if since <= f[0] < end]
+            self.saved_files = [f for f in self.saved_files if not since <= f[0] < end]
+        return [path for _, path in sorted(taken)]
+
+    def take_failed(self, upto=None, since=0):
+        """
+        take_saved_files と同じ範囲で、保存に失敗したチャンクの数を取り出す（ジャーナルを残すかの判断に使う）。
+        """
+        with self._lock:
+            end = self._sealed if upto is None else upto
+            failed = sum(since <= seq < end for seq in self.failed)
+            self.failed = [seq for seq in self.failed if not since <= seq < end]
+        return failed
+
+    def after_written(self, fn, upto=None):
+        """
+        upto より前に締めたチャンクが書き終わってから、マージ用のスレッドで fn(締めた順の保存済みファイル, 保存に失敗した数) を呼ぶ。
+        手動フラッシュのマージに使い、呼び出し側（イベントループ）は書き出しもマージも待たない。
+        マージ用のスレッドは1本なので、続けてフラッシュしてもマージは頼んだ順に1つずつ動く。
+        """
+        with self._lock:
+            if upto is None:
+                upto = self._sealed
+            # 前の after_written が取るチャンクは取らない（前のマージがまだ待っていても混ざらない）
+            since, self._merged = self._merged, max(self._merged, upto)
+
+        def run():
+            self.wait(upto)
+            try:
+                fn(self.take_saved_files(upto, since), self.take_failed(upto, since))
+            except Exception as e:
+                print(f"[ERROR] Failed to merge chunks: {e}")
+        self._merger.submit(run)
+
+    def close(self):
+        """
+        書き出しと after_written() の処理がすべて終わるまで待ってスレッドを止める。
+        """
+        self.wait()
+        self._merger.shutdown()
+        self._executor.shutdown()
+
+
+# ---------------------------
+# ベンチマーク（締めたときに受信側が止まる時間と、黙ったエージェントが締まるまでの時間）
+# ---------------------------
+def benchmark(num_agents=10, rows_per_chunk=28000, timeout=1.0):
+    import numpy as np
+    import ChunkProcessor
+    from ChunkProcessor import build_dataframe_for_chunk
+    from ServerMetrics import ServerMetrics
+
+    def save(agent_id, columns, send_list, recv_list, clock, chunk_time=None):
+        return build_dataframe_for_chunk(agent_id, columns, send_list, recv_list, clock=clock, chunk_time=chunk_time)[1]
+
+    rng = np.random.default_rng(0)
+    columns = {"micros24": (np.arange(rows_per_chunk, dtype=np.uint32) * 39) & 0xFFFFFF,
+               "a0": rng.integers(0, 256, rows_per_chunk, dtype=np.uint8),
+               "a1": rng.integers(0, 256, rows_per_chunk, dtype=np.uint8),
+               "a2": rng.integers(0, 256, rows_per_chunk, dtype=np.uint8)}
+    send_list = [int(m) << 8 for m in columns["micros24"][83::84]]
+    recv_list = [time.time() + i * 0.84 for i in range(len(send_list))]
+
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        saved_folder, ChunkProcessor.SAVE_FOLDER = ChunkProcessor.SAVE_FOLDER, tmp
+        try:
+            # 以前: 受信ループの中でそのまま保存
+            stalls = []
+            for agent_id in range(1, num_agents + 1):
+                t0 = time.perf_counter()
+                save(agent_id, dict(columns), send_list, recv_list, None)
+                stalls.append(time.perf_counter() - t0)
+            sync = (max(stalls), sum(stalls))
+
+            # 以後: 列のコピーを渡してプールで保存
+            metrics = ServerMetrics()
+            pool = ChunkWriterPool(save, metrics)
+            stalls = []
+            t_start = time.perf_counter()
+            for agent_id in range(1, num_agents + 1):
+                t0 = time.perf_counter()
+                pool.submit(agent_id + 100, {k: v.copy() for k, v in columns.items()}, send_list, recv_list, None)
+                stalls.append(time.perf_counter() - t0)
+            pool.wait()
+            t_all = time.perf_counter() - t_start
+            pool.close()
+            written = len(pool.take_saved_files())
+
+            # 黙ったエージェントが締まるまでの時間（タイマー間隔 FLUSH_TICK_SEC）
+            sched = FlushScheduler(timeout)
+            t0 = time.monotonic()
+            for agent_id in range(1, num_agents + 1):
+                sched.touch(agent_id, t0)
+            sealed_after = None
+            while sealed_after is None:
+                time.sleep(FLUSH_TICK_SEC)
+                if sched.due(time.monotonic()):
+                    sealed_after = time.monotonic() - t0
+        finally:
+            ChunkProcessor.SAVE_FOLDER = saved_folder
+
+    h = metrics.snapshot()["histograms"]
+    print(f"[BENCH] {num_agents} chunks x {rows_per_chunk} rows ({ChunkProcessor.CHUNK_FORMAT})")
+    print(f"[BENCH] synchronous save in the receive loop: longest stall {sync[0] * 1e3:.1f} ms, "
+          f"total {sync[1] * 1e3:.0f} ms")
+    print(f"[BENCH] writer pool: longest stall {max(stalls) * 1e3:.2f} ms, all written after {t_all * 1e3:.0f} ms "
+          f"({written} files), flush latency p50/max {h['flush_latency']['p50_ms']:.0f}/"
+          f"{h['flush_latency']['max_ms']:.0f} ms, backlog max {metrics.maxima['write_backlog']}")
+    print(f"[BENCH] silent agents sealed {sealed_after:.2f} s after their last packet (timeout {timeout:g} s, "
+          f"tick {FLUSH_TICK_SEC:g} s)")
+
+    # 締め切り管理のコスト（パケットごとの touch）
+    sched = FlushScheduler(5.0)
+    n = 200000
+    t0 = time.perf_counter()
+    now = 0.0
+    for i in range(n):
+        now += 1e-4
+        sched.touch(i % num_agents, now)
+        if i % 5000 == 0:
+            sched.due(now)
+    print(f"[BENCH] FlushScheduler.touch: {(time.perf_counter() - t0) / n * 1e6:.2f} us/packet")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark timer-driven chunk sealing and background writes.")
+    parser.add_argument("--agents", type=int, default=10)
+    parser.add_argument("--rows", type=int, default=28000)
+    args = parser.parse_args()
+    benchmark(args.agents, args.rows)
@@ -0,0 +1,243 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401  (Parquet/Feather はあれば使う)
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+# ---------------------------
+# チャンク/マージファイルの保存形式
+#   csv     : 従来形式（MATLAB の main_plot.m から読む場合）
+#   npz     : NumPy のバイナリ列（追加依存なし）
+#   parquet : pyarrow がある場合
+#   feather : pyarrow がある場合
+# ---------------------------
+SAVE_COLUMNS = [
+    "time_pc_sec_abs", "micros32", "micros32_raw", "time_local_sec",
+    "a0", "a1", "a2", "agent_id", "chunk_id"
+]
+
+# 保存時の列の型（a0..a2, agent_id は 0..255、micros32 は24ビット拡張カウンタ）
+NARROW_DTYPES = {
+    "time_pc_sec_abs": np.float64,
+    "micros32": np.uint32,
+    "micros32_raw": np.uint64,
+    "time_local_sec": np.float64,
+    "a0": np.uint8,
+    "a1": np.uint8,
+    "a2": np.uint8,
+    "agent_id": np.uint8,
+}
+
+EXTENSIONS = {"csv": ".csv", "npz": ".npz", "parquet": ".parquet", "feather": ".feather"}
+DATA_EXTENSIONS = tuple(EXTENSIONS.values())
+
+
+def to_narrow(df):
+    """
+    保存用に列を狭い型へ変換し、chunk_id をカテゴリ型にする。
+    """
+    out = pd.DataFrame(index=pd.RangeIndex(len(df)))
+    for col in SAVE_COLUMNS:
+        if col not in df.columns:
+            continue
+        if col == "chunk_id":
+            out[col] = pd.Categorical(df[col].astype(str))
+        else:
+            out[col] = df[col].to_numpy().astype(NARROW_DTYPES[col], copy=False)
+    return out
+
+
+def format_for_path(path):
+    ext = os.path.splitext(path)[1].lower()
+    for name, e in EXTENSIONS.items():
+        if e == ext:
+            return name
+    raise ValueError(f"Unknown chunk file format: {path}")
+
+
+def check_format(fmt):
+    if fmt not in EXTENSIONS:
+        raise ValueError(f"Unknown storage format '{fmt}' (choose from {', '.join(EXTENSIONS)})")
+    if fmt in ("parquet", "feather") and not HAS_PYARROW:
+        print(f"[WARN] pyarrow is not installed; falling back to npz instead of {fmt}.")
+        return "npz"
+    return fmt
+
+
+# ---------------------------
+# npz 形式
+#   micros32_raw が micros32 << 8 で再現できる場合は保存しない。
+#   time_local_sec は micros32_raw / 1e6 から復元する。
+# ---------------------------
+def _save_npz(df, path):
+    arrays = {}
+    for col in ("time_pc_sec_abs", "micros32", "a0", "a1", "a2", "agent_id"):
+        if col in df.columns:
+            arrays[col] = df[col].to_numpy()
+    if "micros32_raw" in df.columns:
+        raw = df["micros32_raw"].to_numpy()
+        if "micros32" not in df.columns or not np.array_equal(raw, df["micros32"].to_numpy().astype(np.uint64) << np.uint64(8)):
+            arrays["micros32_raw"] = raw
+    if "chunk_id" in df.columns:
+        cat = df["chunk_id"].cat
+        arrays["chunk_codes"] = cat.codes.to_numpy().astype(np.int32)
+        arrays["chunk_categories"] = np.asarray(cat.categories, dtype=str)
+    np.savez(path, **arrays)
+
+
+def _load_npz(path, columns=None):
+    with np.load(path, allow_pickle=False) as z:
+        keys = set(z.files)
+        data = {}
+        if "time_pc_sec_abs" in keys:
+            data["time_pc_sec_abs"] = z["time_pc_sec_abs"]
+        if "micros32" in keys:
+            data["micros32"] = z["micros32"]
+            if "micros32_raw" in keys:
+                data["micros32_raw"] = z["micros32_raw"]
+            else:
+                data["micros32_raw"] = z["micros32"].astype(np.uint64) << np.uint64(8)
+            data["time_local_sec"] = data["micros32_raw"] / 1e6
+        for col in ("a0", "a1", "a2", "agent_id"):
+            if col in keys:
+                data[col] = z[col]
+        if "chunk_codes" in keys:
+            data["chunk_id"] = pd.Categorical.from_codes(z["chunk_codes"], categories=z["chunk_categories"])
+    df = pd.DataFrame(data)
+    if columns is not None:
+        df = df[[c for c in columns if c in df.columns]]
+    return df
+
+
+def save_chunk_frame(df, path_no_ext, fmt="npz"):
+    """
+    DataFrame を指定形式で保存し、拡張子付きのパスを返す。
+    """
+    fmt = check_format(fmt)
+    path = path_no_ext + EXTENSIONS[fmt]
+    if fmt == "csv":
+        df.to_csv(path, index=False, columns=[c for c in SAVE_COLUMNS if c in df.columns])
+        return path
+
+    narrow = to_narrow(df)
+    if fmt == "npz":
+        _save_npz(narrow, path)
+    elif fmt == "parquet":
+        narrow.to_parquet(path, index=False)
+    else:
+        narrow.to_feather(path)
+    return path
+
+
+def load_chunk_file(path, columns=None):
+    """
+    拡張子から形式を判定してチャンク/マージファイルを読み込む。
+    バイナリ形式では a0..a2 は uint8、chunk_id はカテゴリ型で返る。
+    """
+    fmt = format_for_path(path)
+    if fmt == "csv":
+        if columns is None:
+            return pd.read_csv(path)
+        header = pd.read_csv(path, nrows=0).columns
+        return pd.read_csv(path, usecols=[c for c in columns if c in header])
+    if fmt == "npz":
+        return _load_npz(path, columns)
+    if fmt == "parquet":
+        return pd.read_parquet(path, columns=columns)
+    df = pd.read_feather(path)
+    return df if columns is None else df[[c for c in columns if c in df.columns]]
+
+
+def list_data_files(directory):
+    """
+    ディレクトリ内のチャンク/マージファイル（対応形式のみ）を返す。
+    """
+    return [os.path.join(directory, f) for f in os.listdir(directory) if f.lower().endswith(DATA_EXTENSIONS)]
+
+
+# ---------------------------
+# 既存CSVアーカイブの変換とベンチマーク
+# ---------------------------
+def convert_archive(src_dir, dst_dir, fmt="npz", verify=False):
+    """
+    src_dir 内の CSV を fmt に変換して dst_dir に保存する（元ファイルは残す）。
+    """
+    fmt = check_format(fmt)
+    os.makedirs(dst_dir, exist_ok=True)
+    files = sorted(f for f in os.listdir(src_dir) if f.endswith(".csv"))
+    csv_bytes = 0
+    out_bytes = 0
+    for i, name in enumerate(files):
+        src = os.path.join(src_dir, name)
+        try:
+            df = pd.read_csv(src)
+        except pd.errors.EmptyDataError:
+            print(f"[WARN] Skipped empty file: {name}")
+            continue
+        dst = save_chunk_frame(df, os.path.join(dst_dir, os.path.splitext(name)[0]), fmt)
+        csv_bytes += os.path.getsize(src)
+        out_bytes += os.path.getsize(dst)
+        if verify:
+            back = load_chunk_file(dst)
+            for col in df.columns:
+                if col == "chunk_id":
+                    same = (back[col].astype(str).to_numpy() == df[col].astype(str).to_numpy()).all()
+                else:
+                    same = np.array_equal(back[col].to_numpy(), df[col].to_numpy())
+                if not same:
+                    print(f"[WARN] Column {col} differs after conversion: {name}")
+        if (i + 1) % 20 == 0 or i + 1 == len(files):
+            print(f"[INFO] Converted {i + 1}/{len(files)} files")
+    ratio = out_bytes / csv_bytes if csv_bytes else 0.0
+    print(f"[INFO] {len(files)} files: csv {csv_bytes / 1e6:.1f} MB -> {fmt} {out_bytes / 1e6:.1f} MB ({ratio:.1%})")
+    return csv_bytes, out_bytes
+
+
+def benchmark(src_dir, max_files=20, formats=None):
+    """
+    src_dir の最新 max_files 件について、形式ごとのサイズと読み込み時間を比較する。
+    """
+    formats = formats or ["csv", "npz"] + (["parquet", "feather"] if HAS_PYARROW else [])
+    files = sorted(f for f in os.listdir(src_dir)
+                   if f.endswith(".csv") and os.path.getsize(os.path.join(src_dir, f)) > 1)[-max_files:]
+    frames = [pd.read_csv(os.path.join(src_dir, f)) for f in files]
+    rows = sum(len(df) for df in frames)
+
+    print(f"[BENCH] {len(files)} files, {rows} rows")
+    with tempfile.TemporaryDirectory() as tmp:
+        for fmt in formats:
+            paths = [save_chunk_frame(df, os.path.join(tmp, f"{fmt}_{i}"), fmt) for i, df in enumerate(frames)]
+            size = sum(os.path.getsize(p) for p in paths)
+            t0 = time.perf_counter()
+            for p in paths:
+                load_chunk_file(p)
+            t_load = time.perf_counter() - t0
+            print(f"[BENCH] {fmt:8s} size={size / 1e6:8.2f} MB ({size / rows:5.1f} B/row)  "
+                  f"load={t_load * 1e3:8.1f} ms ({rows / t_load / 1e6:.2f} Mrows/s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert and benchmark chunk storage formats.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_conv = sub.add_parser("convert", help="convert a CSV archive to a binary format")
+    p_conv.add_argument("src", nargs="?", default="merged_chunks")
+    p_conv.add_argument("dst", nargs="?", default="merged_chunks_npz")
+    p_conv.add_argument("--format", default="npz", choices=list(EXTENSIONS))
+    p_conv.add_argument("--verify", action="store_true", help="reload each file and compare columns")
+    p_bench = sub.add_parser("bench", help="compare size and load time per format")
+    p_bench.add_argument("src", nargs="?", default="merged_chunks")
+    p_bench.add_argument("--files", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        convert_archive(args.src, args.dst, args.format, args.verify)
+    else:
+        benchmark(args.src, args.files)
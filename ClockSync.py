@@ -0,0 +1,280 @@
+import argparse
+import copy
+
+import numpy as np
+
+from TimeReconstruction import MICROS24_WRAP, MICROS_SHIFT, wrapped_send_seconds
+
+# ---------------------------
+# エージェントごとのオンライン時計同期
+#   offset(s) = recv_time − s を送信時刻 s の一次式 α + β·s で近似する（β が時計のずれ = skew）。
+#   ネットワーク遅延は常に正なので、一斉送信ごとの区間で offset の最小値（下側包絡）だけを残し、
+#   その点を指数忘却付きの最小二乗の累積和に足し込む。1パケットあたり O(1)、送受信の組は保存しない。
+#   Pico が再起動すると micros() が 0 から数え直すので、offset が推定から REBOOT_JUMP_SEC 以上跳んだら
+#   別の時計とみなして推定をやり直す（2つの起動をまたいで当てはめると時刻が数百秒ずれる）。
+# ---------------------------
+SEND_PERIOD_SEC = (MICROS24_WRAP << MICROS_SHIFT) / 1e6  # 24ビット折り返しの周期 ≒ 4294.967296 秒
+BUCKET_SEC = 10.0  # 下側包絡を取る区間の最大長（Picoの送信時刻基準）
+BURST_GAP_SEC = 2.0  # これ以上送信が途切れたら区間を切る（一斉送信1回 = 1区間）
+FORGETTING = 0.999  # 区間ごとの指数忘却（温度による周波数変化に追従）
+MIN_SPAN_SEC = 30.0  # skew を推定するのに必要な送信時刻の広がり
+REBOOT_JUMP_SEC = 2.0  # offset が推定からこれ以上ずれたら再起動とみなす（遅延のスパイクより十分大きく、起動にかかる時間より小さい）
+
+
+class ClockSyncEstimator:
+    """
+    1エージェント分の時計オフセットと skew の逐次推定器。
+    """
+
+    def __init__(self, bucket_sec=BUCKET_SEC, burst_gap_sec=BURST_GAP_SEC, forgetting=FORGETTING,
+                 min_span_sec=MIN_SPAN_SEC, reboot_jump_sec=REBOOT_JUMP_SEC):
+        self.bucket_sec = bucket_sec
+        self.burst_gap_sec = burst_gap_sec
+        self.forgetting = forgetting
+        self.min_span_sec = min_span_sec
+        self.reboot_jump_sec = reboot_jump_sec
+        self.resets = 0
+        self.reset()
+
+    def reset(self):
+        """
+        推定を捨てて最初からやり直す（Pico の再起動で micros() が数え直したとき）。
+        """
+        self.packets = 0
+        self._latest = None       # 最後の送信時刻（展開済み秒）と、その受信時刻
+        self._latest_recv = None
+        self._s0 = None          # 数値安定化のための基準（最初の送信時刻と offset）
+        self._y0 = None
+        self._bucket_start = None  # 現在の区間の開始時刻と最後の送信時刻
+        self._last_x = None
+        self._bucket_min = None  # (s, y) 区間内で offset が最小の点
+        self._s_min = None
+        self._s_max = None
+        # 最小二乗の累積和（s, y は基準からの差）
+        self._w = 0.0
+        self._sx = 0.0
+        self._sy = 0.0
+        self._sxx = 0.0
+        self._sxy = 0.0
+
+    # ---------------------------
+    # 更新
+    # ---------------------------
+    def _unwrap_send(self, send_micros, recv_time):
+        wrapped = float(wrapped_send_seconds(send_micros))
+        if self._latest is None:
+            return wrapped
+        # 受信時刻の進みから送信時刻を予想し、それに一番近い折り返し周期を選ぶ（長い無通信をまたいでも数え違えない）
+        expected = self._latest + (recv_time - self._latest_recv)
+        return wrapped + round((expected - wrapped) / SEND_PERIOD_SEC) * SEND_PERIOD_SEC
+
+    def update(self, send_micros, recv_time):
+        s = self._unwrap_send(send_micros, recv_time)
+        jump = (recv_time - s) - self.offset_at(s) if self.packets else 0.0
+        if abs(jump) > self.reboot_jump_sec:
+            print(f"[WARN] Clock offset jumped by {jump:+.3f} s (Pico reboot?): restarting clock sync.")
+            self.reset()
+            self.resets += 1
+            s = self._unwrap_send(send_micros, recv_time)
+        self._latest = s
+        self._latest_recv = recv_time
+        if self._s0 is None:
+            self._s0 = s
+            self._y0 = recv_time - s
+        x = s - self._s0
+        y = (recv_time - s) - self._y0
+        self.packets += 1
+
+        if (self._bucket_min is None or x - self._last_x > self.burst_gap_sec
+                or x - self._bucket_start > self.bucket_sec):
+            self._commit_bucket()
+            self._bucket_start = x
+            self._bucket_min = (x, y)
+        elif y < self._bucket_min[1]:
+            self._bucket_min = (x, y)
+        self._last_x = x
+
+    def _commit_bucket(self):
+        if self._bucket_min is None:
+            return
+        x, y = self._bucket_min
+        lam = self.forgetting
+        self._w = self._w * lam + 1.0
+        self._sx = self._sx * lam + x
+        self._sy = self._sy * lam + y
+        self._sxx = self._sxx * lam + x * x
+        self._sxy = self._sxy * lam + x * y
+        self._s_min = x if self._s_min is None else min(self._s_min, x)
+        self._s_max = x if self._s_max is None else max(self._s_max, x)
+        self._bucket_min = None
+
+    # ---------------------------
+    # 推定値
+    # ---------------------------
+    def _fit(self):
+        """
+        (α, β) を基準座標で返す。区間が1つしか無い、または送信時刻の広がりが
+        足りない間は β = 0 として下側包絡の最小値を使う。
+        """
+        w, sx, sy, sxx, sxy = self._w, self._sx, self._sy, self._sxx, self._sxy
+        pending = self._bucket_min
+        if pending is not None:
+            x, y = pending
+            w, sx, sy, sxx, sxy = w + 1.0, sx + x, sy + y, sxx + x * x, sxy + x * y
+        if w == 0:
+            return None
+        span_ok = self._s_min is not None and (
+            max(self._s_max, pending[0] if pending else self._s_max) - self._s_min >= self.min_span_sec)
+        denom = w * sxx - sx * sx
+        if span_ok and w >= 2 and denom > 0:
+            beta = (w * sxy - sx * sy) / denom
+            alpha = (sy - beta * sx) / w
+            return alpha, beta
+        return sy / w, 0.0
+
+    @property
+    def ready(self):
+        return self.packets > 0
+
+    @property
+    def skew(self):
+        """
+        PC時計に対する Pico 時計のずれ（無次元。1e-6 = 1 ppm）。
+        """
+        fit = self._fit()
+        return 0.0 if fit is None else fit[1]
+
+    def offset_at(self, send_sec):
+        """
+        送信時刻 send_sec（展開済み秒）での recv − send の推定値。
+        """
+        alpha, beta = self._fit()
+        return self._y0 + alpha + beta * (send_sec - self._s0)
+
+    @property
+    def offset(self):
+        """
+        最新の送信時刻での offset。
+        """
+        return self.offset_at(self._latest)
+
+    def retime(self, time_local_sec):
+        """
+        チャンクのローカル時刻（time_local_sec, チャンク内で展開済み）を PC 時刻に変換する。
+        ローカル時刻を直近の送信時刻と同じ折り返し周期に合わせ、その時刻での offset を足す。
+        """
+        t = np.asarray(time_local_sec, dtype=np.float64)
+        latest = self._latest
+        shift = np.round((latest - t[-1]) / SEND_PERIOD_SEC) * SEND_PERIOD_SEC if len(t) else 0.0
+        alpha, beta = self._fit()
+        s = t + shift
+        return s + self._y0 + alpha + beta * (s - self._s0)
+
+    def micros_at(self, pc_time):
+        """
+        PC 時刻 pc_time に Pico の micros()（32ビット）が示す値の推定（retime の逆、下位8ビットの精度は無い）。
+        """
+        alpha, beta = self._fit()
+        # pc = s + y0 + α + β(s − s0) を s について解く（折り返しの周期がちょうど 2^32 μs なので剰余で micros に戻る）
+        s = (pc_time - self._y0 - alpha + beta * self._s0) / (1.0 + beta)
+        return int(round(s * 1e6)) % (1 << 32)
+
+    def snapshot(self):
+        """
+        別スレッドで retime するための状態のコピー（O(1)）。
+        """
+        return copy.copy(self)
+
+    def summary(self):
+        return f"offset={self.offset:.6f}s skew={self.skew * 1e6:+.2f}ppm packets={self.packets}"
+
+
+class BootSequence:
+    """
+    Pico の起動シーケンス（HELLO のあと、ログパケットを挟まずに REQUEST_PARAMS）を見分ける。
+    送信後やポーズ中の定期的な REQUEST_PARAMS では時計は変わらないので、推定を捨てるのは起動のときだけにする。
+    受信する1つのスレッドからだけ使う。
+    """
+
+    def __init__(self):
+        self._greeted = set()  # HELLO のあとまだログパケットを送っていないアドレス
+
+    def hello(self, addr):
+        self._greeted.add(addr)
+
+    def log_packet(self, addr):
+        self._greeted.discard(addr)
+
+    def params_request(self, addr):
+        """
+        この REQUEST_PARAMS が起動直後のものなら True。
+        """
+        if addr in self._greeted:
+            self._greeted.discard(addr)
+            return True
+        return False
+
+
+# ---------------------------
+# ベンチマーク（合成ジッタ）
+# ---------------------------
+def simulate_session(num_chunks=10, chunk_sec=280.0, record_period=0.01, packets_per_chunk=334,
+                     skew_ppm=40.0, base_delay=0.002, jitter=0.004, spike_prob=0.02, spike=0.2,
+                     idle_sec=30.0, seed=0):
+    """
+    Pico の動作（chunk_sec 記録 → STOP後にまとめて送信）を真の skew とジッタ付きで再現する。
+    戻り値: [(record_local_sec, true_pc_sec, send_micros, recv_times), ...]
+    """
+    rng = np.random.default_rng(seed)
+    skew = skew_ppm * 1e-6
+    true_offset = 1.744e9
+    pico_t = 5.0
+    chunks = []
+    for _ in range(num_chunks):
+        rec_local = pico_t + np.arange(int(chunk_sec / record_period)) * record_period
+        pico_t = rec_local[-1] + 0.5
+        send_local = pico_t + np.arange(packets_per_chunk) * 0.004  # 1パケット ≒ 4 ms
+        pico_t = send_local[-1] + idle_sec
+        delay = base_delay + rng.exponential(jitter, packets_per_chunk)
+        delay += (rng.random(packets_per_chunk) < spike_prob) * rng.uniform(0, spike, packets_per_chunk)
+        # 送信が詰まるとサーバー側の処理待ちで遅延が単調に増える
+        delay += np.linspace(0, 0.05, packets_per_chunk)
+        recv = true_offset + send_local * (1 + skew) + delay
+        true_pc = true_offset + rec_local * (1 + skew)
+        send_micros = np.round(send_local * 1e6).astype(np.int64) & 0xFFFFFFFF
+        rec_micros24 = (np.round(rec_local * 1e6).astype(np.int64) >> MICROS_SHIFT) & (MICROS24_WRAP - 1)
+        chunks.append((rec_micros24, true_pc, send_micros, recv))
+    return chunks
+
+
+def benchmark(**kwargs):
+    from TimeReconstruction import mean_clock_offset, reconstruct_chunk_times
+
+    chunks = simulate_session(**kwargs)
+    clock = ClockSyncEstimator()
+    rows = []
+    for k, (rec_micros24, true_pc, send_micros, recv) in enumerate(chunks):
+        for s, r in zip(send_micros, recv):
+            clock.update(int(s), float(r))
+        mean_times = reconstruct_chunk_times(rec_micros24, mean_clock_offset(send_micros, recv))
+        local = mean_times["time_local_sec"]
+        err_mean = mean_times["time_pc_sec_abs"] - true_pc
+        err_sync = clock.retime(local) - true_pc
+        rows.append((k, np.sqrt(np.mean(err_mean ** 2)), np.abs(err_mean).max(),
+                     np.sqrt(np.mean(err_sync ** 2)), np.abs(err_sync).max(), clock.skew * 1e6))
+
+    print("[BENCH] chunk  mean-offset rms/max [ms]   clock-sync rms/max [ms]   skew est [ppm]")
+    for k, rm, mm, rs, ms, sk in rows:
+        print(f"[BENCH] {k:5d}  {rm * 1e3:8.2f} / {mm * 1e3:8.2f}       {rs * 1e3:8.2f} / {ms * 1e3:8.2f}      {sk:+8.2f}")
+    rm = np.mean([r[1] for r in rows[2:]])
+    rs = np.mean([r[3] for r in rows[2:]])
+    print(f"[BENCH] mean rms error after warm-up (chunks 2..): mean-offset {rm * 1e3:.2f} ms, clock-sync {rs * 1e3:.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare mean-offset and online clock-sync retiming on synthetic jitter.")
+    parser.add_argument("--chunks", type=int, default=10)
+    parser.add_argument("--skew-ppm", type=float, default=40.0)
+    parser.add_argument("--jitter", type=float, default=0.004, help="mean of exponential delay jitter (s)")
+    args = parser.parse_args()
+    benchmark(num_chunks=args.chunks, skew_ppm=args.skew_ppm, jitter=args.jitter)
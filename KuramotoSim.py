@@ -0,0 +1,333 @@
+import argparse
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from ChunkStorage import save_chunk_frame
+from PhaseAnalysis import PHASE_PERIOD
+from SessionAnalysis import session_metrics
+from TimeReconstruction import MICROS_SHIFT
+
+# ---------------------------
+# VolSim（VolSim/volvocine.m, volvocine_combined.m）の Kuramoto モデルの Python 版
+#   結合行列 W[j, k] = e_k * e_j * (c2 + c1 * cos(thetas[(k - j) mod N])) を最初に1回だけ作り、
+#   Sigma_j = -Σ_k W[j, k] sin(q_j - q_k + alpha) を
+#   sin(q_j + α)·(W cos q) − cos(q_j + α)·(W sin q) の行列積で全モジュール同時に計算する。
+#   q' = Omega - kappa * Sigma / N を dt 刻みの前進オイラーで進める（MATLAB と同じ同期更新）。
+#   alpha は実機ファームウェアの位相遅れ定数に相当（alpha = 0 で volvocine.m と同じ）。
+#   複数の試行（初期位相）は先頭の次元にまとめて1回の行列演算で進め、
+#   パラメータスイープはプロセスプールで並列に回す。
+#   出力は merged_chunks の CSV と同じ列なので plot_relativePhase でそのまま実機と比べられる。
+# ---------------------------
+N_MODULES = 6
+DT = 0.01  # [s]（実機のログ周期 100Hz と同じ）
+SIM_SECONDS = 20.0
+OMEGA = 2 * np.pi  # [rad/s]
+KAPPA = 5.0
+ALPHA = 0.0
+C1 = 1.0  # 回転方向
+C2 = 0.1  # 平進方向
+SIM_FOLDER = "simulated"
+
+DEFAULT_PARAMS = {
+    "n": N_MODULES,
+    "dt": DT,
+    "seconds": SIM_SECONDS,
+    "omega": OMEGA,
+    "omega_spread": 0.0,  # Omega_j = omega * (1 + spread * linspace(-0.5, 0.5, N))
+    "kappa": KAPPA,
+    "alpha": ALPHA,
+    "c1": C1,
+    "c2": C2,
+    "failed": (),  # 発揮率 0 にするモジュール（1 始まり、MATLAB の efficiency(k) = 0 と同じ）
+    "mutual": True,  # True: e_k * e_j（volvocine.m）、False: e_k のみ（volvocine_combined.m）
+    "trials": 1,
+    "seed": 0,
+}
+
+
+def make_params(**overrides):
+    unknown = set(overrides) - set(DEFAULT_PARAMS)
+    if unknown:
+        raise ValueError(f"Unknown simulation parameters: {', '.join(sorted(unknown))}")
+    params = dict(DEFAULT_PARAMS)
+    params.update(overrides)
+    return params
+
+
+def module_angles(n):
+    return 2 * np.pi * np.arange(n) / n  # thetas = 0:2*pi/N:2*pi-2*pi/N
+
+
+def efficiency_vector(n, failed=()):
+    efficiency = np.ones(n)
+    for module in failed:
+        efficiency[module - 1] = 0.0
+    return efficiency
+
+
+def coupling_matrix(n, c1=C1, c2=C2, efficiency=None, mutual=True):
+    """
+    W[j, k] = calculateSigma(k, j)。行 j がモジュール j に入る結合。
+    """
+    efficiency = np.ones(n) if efficiency is None else np.asarray(efficiency, dtype=np.float64)
+    idx = np.arange(n)
+    offset = (idx[None, :] - idx[:, None]) % n  # [j, k] -> mod(k - j, N)
+    W = c2 + c1 * np.cos(module_angles(n)[offset])
+    W = W * efficiency[None, :]
+    if mutual:
+        W = W * efficiency[:, None]
+    return W
+
+
+def natural_frequencies(n, omega=OMEGA, spread=0.0):
+    return omega * (1.0 + spread * np.linspace(-0.5, 0.5, n)) if n > 1 else np.array([omega])
+
+
+def initial_phases(n, trials=1, seed=0):
+    rng = np.random.default_rng(seed)
+    return 2 * np.pi * (rng.random((trials, n)) - 0.5)  # q(1, 1:N) = 2*pi*(rand(1, N) - 0.5)
+
+
+def simulate(params, q0=None):
+    """
+    params（make_params）でシミュレーションし、アンラップ済みの位相 (steps, trials, N) を返す。
+    q0 を渡すとその初期位相 (trials, N) から始める。
+    """
+    n = params["n"]
+    steps = int(round(params["seconds"] / params["dt"]))
+    W = coupling_matrix(n, params["c1"], params["c2"], efficiency_vector(n, params["failed"]), params["mutual"])
+    omega = natural_frequencies(n, params["omega"], params["omega_spread"])
+    gain = params["kappa"] * params["dt"] / n
+    drift = omega * params["dt"]
+    alpha = params["alpha"]
+
+    q = initial_phases(n, params["trials"], params["seed"]) if q0 is None else np.array(q0, dtype=np.float64, ndmin=2)
+    out = np.empty((steps, len(q), n))
+    out[0] = q
+    Wt = W.T
+    for i in range(1, steps):
+        s, c = np.sin(q), np.cos(q)
+        ws, wc = s @ Wt, c @ Wt  # Σ_k W[j, k] sin q_k, Σ_k W[j, k] cos q_k
+        sigma = -(np.sin(q + alpha) * wc - np.cos(q + alpha) * ws)
+        q = q + drift - gain * sigma
+        out[i] = q
+    return out
+
+
+def wrap_phase(q):
+    return np.mod(q + np.pi, 2 * np.pi) - np.pi  # mod(q + pi, 2*pi) - pi
+
+
+# ---------------------------
+# 実機のマージ済み CSV と同じ列に変換
+# ---------------------------
+def phase_counts(q):
+    """
+    位相 [rad] を a0 のカウント (0..PHASE_PERIOD-1) に量子化する。
+    （ファームウェアは 255/2π 倍だが、解析側の PHASE_PERIOD で戻せるようにそろえる）
+    """
+    return (np.floor(np.mod(q, 2 * np.pi) * (PHASE_PERIOD / (2 * np.pi))).astype(np.int64) % PHASE_PERIOD).astype(np.uint8)
+
+
+def to_session_frame(q, params, start_time=None, trial=0, tag="sim"):
+    """
+    1試行分を merged CSV と同じ列の DataFrame にする。agent_id はモジュール番号 (1..N)。
+    a1, a2 はセンサが無いので 0。
+    """
+    steps, _, n = q.shape
+    start_time = time.time() if start_time is None else start_time
+    t_local = np.arange(steps) * params["dt"]
+    micros32_raw = np.round(t_local * 1e6).astype(np.int64)
+    frames = []
+    for module in range(n):
+        frames.append(pd.DataFrame({
+            "time_pc_sec_abs": start_time + t_local,
+            "micros32": micros32_raw >> MICROS_SHIFT,
+            "micros32_raw": micros32_raw,
+            "time_local_sec": t_local,
+            "a0": phase_counts(q[:, trial, module]),
+            "a1": np.zeros(steps, dtype=np.uint8),
+            "a2": np.zeros(steps, dtype=np.uint8),
+            "agent_id": module + 1,
+            "chunk_id": f"{tag}_{module + 1}",
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def run_label(params):
+    failed = "-".join(str(m) for m in params["failed"]) or "none"
+    return (f"k{params['kappa']:g}_a{params['alpha']:g}_s{params['omega_spread']:g}_f{failed}"
+            f"_n{params['n']}_seed{params['seed']}")
+
+
+def write_session(q, params, directory=SIM_FOLDER, fmt="csv", trial=0, start_time=None):
+    os.makedirs(directory, exist_ok=True)
+    label = run_label(params)
+    df = to_session_frame(q, params, start_time, trial, tag=label)
+    return save_chunk_frame(df, os.path.join(directory, f"sim_{label}_t{trial}"), fmt)
+
+
+# ---------------------------
+# 指標とスイープ
+# ---------------------------
+def direction_order(q, n, efficiency):
+    """
+    OrderEX.m / volvocine_combined.m の方向別秩序変数 (R1, R2) を時刻ごとに返す。
+    """
+    thetas = module_angles(n)
+    p1 = efficiency * np.sin(thetas) / n
+    p2 = -efficiency * np.cos(thetas) / n
+    s, c = np.sin(q), np.cos(q)
+    r1 = np.hypot(s @ p1, c @ p1)
+    r2 = np.hypot(s @ p2, c @ p2)
+    return r1, r2
+
+
+def run_case(params):
+    """
+    1組のパラメータの全試行を回し、試行ごとの指標の平均を返す（プロセスプールのワーカー）。
+    """
+    t0 = time.perf_counter()
+    q = simulate(params)
+    n = params["n"]
+    efficiency = efficiency_vector(n, params["failed"])
+    active = np.flatnonzero(efficiency > 0)
+    rate = 1.0 / params["dt"]
+    t = np.arange(q.shape[0]) * params["dt"]
+    tail = max(1, len(t) // 10)
+
+    rows = []
+    for trial in range(q.shape[1]):
+        counts = {int(m) + 1: q[:, trial, m] * (PHASE_PERIOD / (2 * np.pi)) for m in active}
+        metrics = session_metrics(t, counts, rate)
+        r1, r2 = direction_order(q[:, trial], n, efficiency)
+        metrics["r1_final"] = float(r1[-tail:].mean())
+        metrics["r2_final"] = float(r2[-tail:].mean())
+        rows.append(metrics)
+    result = pd.DataFrame(rows).mean(numeric_only=True).to_dict()
+    result.update({
+        "kappa": params["kappa"], "alpha": params["alpha"], "omega_spread": params["omega_spread"],
+        "failed": "-".join(str(m) for m in params["failed"]), "trials": q.shape[1],
+        "elapsed_sec": time.perf_counter() - t0,
+    })
+    return result
+
+
+def sweep(kappas=(KAPPA,), alphas=(ALPHA,), spreads=(0.0,), failed_sets=((),), workers=None, **base):
+    """
+    kappa × alpha × omega_spread × 故障モジュールの全組み合わせを並列に回し、要約表を返す。
+    """
+    cases = [make_params(kappa=k, alpha=a, omega_spread=s, failed=tuple(f), **base)
+             for k, a, s, f in itertools.product(kappas, alphas, spreads, failed_sets)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(run_case, cases))
+    return pd.DataFrame(results)
+
+
+# ---------------------------
+# 検証とベンチマーク（MATLAB と同じ三重ループとの比較）
+# ---------------------------
+def _loop_simulate(params, q0):
+    n = params["n"]
+    steps = int(round(params["seconds"] / params["dt"]))
+    thetas = module_angles(n)
+    efficiency = efficiency_vector(n, params["failed"])
+    omega = natural_frequencies(n, params["omega"], params["omega_spread"])
+    q = np.zeros((steps, n))
+    q[0] = q0
+    for i in range(1, steps):
+        for j in range(n):
+            sigma = 0.0
+            for k in range(n):
+                w = efficiency[k] * (efficiency[j] if params["mutual"] else 1.0) * \
+                    (params["c2"] + params["c1"] * np.cos(thetas[(k - j) % n]))
+                sigma -= w * np.sin(q[i - 1, j] - q[i - 1, k] + params["alpha"])
+            q[i, j] = wrap_phase(q[i - 1, j] + (omega[j] - params["kappa"] * sigma / n) * params["dt"])
+    return q
+
+
+def benchmark(seconds=SIM_SECONDS, trials=64):
+    params = make_params(seconds=seconds, omega_spread=0.2, failed=(3,), alpha=0.1)
+    q0 = initial_phases(params["n"], 1, params["seed"])
+
+    t0 = time.perf_counter()
+    ref = _loop_simulate(params, q0[0])
+    t_loop = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    q = simulate(params, q0)
+    t_vec = time.perf_counter() - t0
+    err = np.abs(wrap_phase(wrap_phase(q[:, 0]) - ref)).max()
+    print(f"[BENCH] {params['n']} modules, {q.shape[0]} steps: triple loop {t_loop * 1e3:8.1f} ms, "
+          f"vectorized {t_vec * 1e3:6.1f} ms (x{t_loop / t_vec:.0f}), max |diff| {err:.2e} rad")
+
+    batch = make_params(seconds=seconds, trials=trials)
+    t0 = time.perf_counter()
+    simulate(batch)
+    t_batch = time.perf_counter() - t0
+    print(f"[BENCH] {trials} trials in one batch: {t_batch * 1e3:.1f} ms "
+          f"({t_batch / trials * 1e3:.2f} ms/trial, triple loop would be ~{t_loop * trials:.0f} s)")
+
+
+def _failed_sets(values):
+    return [tuple(int(m) for m in v.split(",") if m) for v in values]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vectorized VolSim Kuramoto model with parallel parameter sweeps.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_run = sub.add_parser("run", help="simulate once and write a merged-format file")
+    p_run.add_argument("--seconds", type=float, default=SIM_SECONDS)
+    p_run.add_argument("--n", type=int, default=N_MODULES)
+    p_run.add_argument("--kappa", type=float, default=KAPPA)
+    p_run.add_argument("--alpha", type=float, default=ALPHA)
+    p_run.add_argument("--omega-spread", type=float, default=0.0)
+    p_run.add_argument("--failed", default="", help="comma separated module numbers, e.g. 3 or 2,5")
+    p_run.add_argument("--combined", action="store_true", help="coupling of volvocine_combined.m (e_k only)")
+    p_run.add_argument("--seed", type=int, default=0)
+    p_run.add_argument("--out", default=SIM_FOLDER)
+    p_run.add_argument("--compare", default=None, help="merged hardware file to plot next to the simulation")
+
+    p_sweep = sub.add_parser("sweep", help="run a parameter grid in a process pool")
+    p_sweep.add_argument("--seconds", type=float, default=SIM_SECONDS)
+    p_sweep.add_argument("--n", type=int, default=N_MODULES)
+    p_sweep.add_argument("--kappa", type=float, nargs="+", default=[KAPPA])
+    p_sweep.add_argument("--alpha", type=float, nargs="+", default=[ALPHA])
+    p_sweep.add_argument("--omega-spread", type=float, nargs="+", default=[0.0])
+    p_sweep.add_argument("--failed", nargs="+", default=[""], help="failed module sets, e.g. '' 3 2,5")
+    p_sweep.add_argument("--trials", type=int, default=8)
+    p_sweep.add_argument("--workers", type=int, default=None)
+    p_sweep.add_argument("--out", default=os.path.join(SIM_FOLDER, "sweep_summary.csv"))
+
+    p_bench = sub.add_parser("bench", help="compare with the MATLAB-style triple loop")
+    p_bench.add_argument("--seconds", type=float, default=SIM_SECONDS)
+    p_bench.add_argument("--trials", type=int, default=64)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        params = make_params(seconds=args.seconds, n=args.n, kappa=args.kappa, alpha=args.alpha,
+                             omega_spread=args.omega_spread, failed=_failed_sets([args.failed])[0],
+                             mutual=not args.combined, seed=args.seed)
+        path = write_session(simulate(params), params, args.out)
+        print(f"[INFO] Simulation written to {path}")
+        from Plotter import plot_relativePhase
+        plot_relativePhase(path)
+        if args.compare:
+            plot_relativePhase(args.compare)
+    elif args.command == "sweep":
+        t0 = time.perf_counter()
+        summary = sweep(args.kappa, args.alpha, args.omega_spread, _failed_sets(args.failed), args.workers,
+                        seconds=args.seconds, n=args.n, trials=args.trials)
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        summary.to_csv(args.out, index=False)
+        columns = ["kappa", "alpha", "omega_spread", "failed", "order_final", "r1_final", "r2_final",
+                   "lock_fraction", "elapsed_sec"]
+        print(summary[columns].to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+        print(f"[INFO] {len(summary)} cases in {time.perf_counter() - t0:.1f} s -> {args.out}")
+    else:
+        benchmark(args.seconds, args.trials)
@@ -0,0 +1,203 @@
+import argparse
+import time
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+# ---------------------------
+# 大きな時系列の表示用 LOD（level of detail）
+#   1本の系列から最小値/最大値の包絡線のピラミッドを1回だけ作る。
+#   レベル k は 4^k サンプルごとのビンの (最小, 最大) を元の順番で並べたもので、
+#   スパイクや欠けは粗いレベルでも必ず残る。
+#   描画時は表示中の x 範囲に入る点数が画面の横幅程度になる一番細かいレベルを選び、
+#   ズーム/パン（xlim_changed）やウィンドウサイズ変更のたびに差し替える。
+# ---------------------------
+LEVEL_FACTOR = 4  # レベルごとのビン幅の倍率
+MIN_LEVEL_BINS = 8  # これより少ないビン数のレベルは作らない
+POINTS_PER_PIXEL = 2  # 1本の線に描く点数の目安（線が占める横幅ピクセルあたり）
+MIN_POINTS = 16  # 範囲外や極端に短い線でも最低これだけは描く
+
+
+class EnvelopePyramid:
+    """
+    (t, y) の min/max 包絡線ピラミッド。levels[0] は元データ、levels[k] は (t, y) の組。
+    t は単調非減少であること（そうでなければ時刻順に並べ替える）。
+    """
+
+    def __init__(self, t, y, factor=LEVEL_FACTOR, min_bins=MIN_LEVEL_BINS):
+        t = np.asarray(t, dtype=np.float64)
+        y = np.asarray(y)
+        if len(t) > 1 and (np.diff(t) < 0).any():
+            order = np.argsort(t, kind="stable")
+            t, y = t[order], y[order]
+        self.levels = [(t, y)]
+        if len(t) < 2:
+            return
+
+        # 各ビンの (最小値, その位置, 最大値, その位置)。位置は元データの添字
+        index = np.arange(len(t))
+        lo_val, lo_idx, hi_val, hi_idx = y, index, y, index
+        while len(lo_val) // factor >= min_bins:
+            lo_val, lo_idx = _reduce_bins(lo_val, lo_idx, factor, np.argmin)
+            hi_val, hi_idx = _reduce_bins(hi_val, hi_idx, factor, np.argmax)
+            self.levels.append(self._points(t, y, lo_idx, hi_idx))
+
+    @staticmethod
+    def _points(t, y, lo_idx, hi_idx):
+        # ビンごとに最小と最大を元の順番で並べ、両端の元データ点も残す（x 範囲が縮まないように）
+        first = np.minimum(lo_idx, hi_idx)
+        second = np.maximum(lo_idx, hi_idx)
+        idx = np.empty(2 * len(first) + 2, dtype=np.int64)
+        idx[0], idx[-1] = 0, len(t) - 1
+        idx[1:-1:2] = first
+        idx[2:-1:2] = second
+        return t[idx], y[idx]
+
+    def __len__(self):
+        return len(self.levels[0][0])
+
+    def select(self, xmin, xmax, max_points):
+        """
+        [xmin, xmax] に入る点が max_points 以下になる一番細かいレベルの、その範囲（前後1点ずつ余分）を返す。
+        """
+        for t, y in self.levels:
+            lo = max(np.searchsorted(t, xmin, side="left") - 1, 0)
+            hi = min(np.searchsorted(t, xmax, side="right") + 1, len(t))
+            if hi - lo <= max_points:
+                break
+        return t[lo:hi], y[lo:hi]
+
+
+def _reduce_bins(values, index, factor, arg):
+    """
+    factor 個ずつのビンで arg (np.argmin / np.argmax) を取り、値と元データの位置を返す。
+    端数は最後の値で埋める（最小/最大は変わらない）。
+    """
+    pad = -len(values) % factor
+    if pad:
+        values = np.concatenate((values, np.repeat(values[-1:], pad)))
+        index = np.concatenate((index, np.repeat(index[-1:], pad)))
+    rows = np.arange(len(values) // factor)
+    pick = arg(values.reshape(-1, factor), axis=1) + rows * factor
+    return values[pick], index[pick]
+
+
+class LODLines:
+    """
+    Figure 内の LOD 付きの線をまとめて管理する。plot() で線を足し、connect() でズームに追従させる。
+    """
+
+    def __init__(self, fig, points_per_pixel=POINTS_PER_PIXEL):
+        self.fig = fig
+        self.points_per_pixel = points_per_pixel
+        self.lines = {}  # ax -> [(Line2D, EnvelopePyramid)]
+
+    def plot(self, ax, t, y, **kwargs):
+        pyramid = EnvelopePyramid(t, y)
+        t0, _ = pyramid.levels[0]
+        xmin, xmax = (t0[0], t0[-1]) if len(t0) else (0.0, 1.0)
+        line, = ax.plot(*pyramid.select(xmin, xmax, self._budget(ax, pyramid, xmin, xmax)), **kwargs)
+        self.lines.setdefault(ax, []).append((line, pyramid))
+        return line
+
+    def _budget(self, ax, pyramid, xmin, xmax):
+        # 線が表示範囲のうち横に占めるピクセル数に比例させる（短いチャンクを何本並べても点数が増えない）
+        t = pyramid.levels[0][0]
+        if not len(t) or xmax <= xmin:
+            return MIN_POINTS
+        span = min(xmax, t[-1]) - max(xmin, t[0])
+        pixels = ax.bbox.width * max(span, 0.0) / (xmax - xmin)
+        return max(int(pixels * self.points_per_pixel), MIN_POINTS)
+
+    def update(self, ax):
+        """
+        ax の現在の x 範囲に合わせて線のデータを差し替える。
+        """
+        xmin, xmax = ax.get_xlim()
+        for line, pyramid in self.lines.get(ax, []):
+            line.set_data(*pyramid.select(xmin, xmax, self._budget(ax, pyramid, xmin, xmax)))
+
+    def _on_xlim(self, ax):
+        # set_data で線が stale になるので、再描画はキャンバス側（ツールバー操作の draw_idle）に任せる
+        self.update(ax)
+
+    def _on_resize(self, event):
+        for ax in self.lines:
+            self.update(ax)
+
+    def connect(self):
+        """
+        ズーム/パンとウィンドウサイズ変更で再描画する。sharex の軸もそれぞれの xlim_changed で更新される。
+        """
+        self.fig._lod_lines = self  # コールバックは弱参照なので Figure に持たせておく
+        for ax in self.lines:
+            ax.callbacks.connect("xlim_changed", self._on_xlim)
+        self.fig.canvas.mpl_connect("resize_event", self._on_resize)
+        for ax in self.lines:
+            self.update(ax)
+
+    def point_count(self):
+        return sum(len(line.get_xdata()) for lines in self.lines.values() for line, _ in lines)
+
+
+# ---------------------------
+# ベンチマーク（合成データ、Agg で描画時間を測る）
+# ---------------------------
+def benchmark(num_groups=30, rows_per_group=100000):
+    plt.switch_backend("Agg")
+    rng = np.random.default_rng(0)
+    groups = []
+    for g in range(num_groups):
+        t = 1.744e9 + g * rows_per_group * 0.01 + np.arange(rows_per_group) * 0.01
+        groups.append((t, [rng.integers(0, 256, rows_per_group, dtype=np.uint8) for _ in range(3)]))
+    total = num_groups * rows_per_group
+    print(f"[BENCH] {num_groups} groups x {rows_per_group} rows x 3 channels = {3 * total} points")
+
+    def draw(use_lod, zoom):
+        fig, axs = plt.subplots(3, 1, figsize=(9, 8), sharex=True)
+        lod = LODLines(fig) if use_lod else None
+        t0 = time.perf_counter()
+        for t, channels in groups:
+            for ax, y in zip(axs, channels):
+                if lod:
+                    lod.plot(ax, t, y)
+                else:
+                    ax.plot(t, y)
+        if lod:
+            lod.connect()
+        t_build = time.perf_counter() - t0
+        fig.canvas.draw()
+        t_draw = time.perf_counter() - t0 - t_build
+        t1 = time.perf_counter()
+        fig.canvas.draw()  # 全体表示のまま描き直す（パン中の1フレーム相当）
+        t_redraw = time.perf_counter() - t1
+        t1 = time.perf_counter()
+        axs[0].set_xlim(*zoom)
+        fig.canvas.draw()
+        t_zoom = time.perf_counter() - t1
+        points = lod.point_count() if lod else 3 * total
+        plt.close(fig)
+        return t_build, t_draw, t_redraw, t_zoom, points
+
+    mid = groups[num_groups // 2][0]
+    zoom = (mid[0], mid[0] + 20.0)
+    for name, use_lod in (("raw lines", False), ("min/max LOD", True)):
+        t_build, t_draw, t_redraw, t_zoom, points = draw(use_lod, zoom)
+        print(f"[BENCH] {name:12s} build {t_build * 1e3:7.1f} ms  first draw {t_draw * 1e3:7.1f} ms  "
+              f"full redraw {t_redraw * 1e3:7.1f} ms  zoom redraw {t_zoom * 1e3:7.1f} ms  points at zoom {points}")
+
+    # 包絡線がどのレベルでも表示範囲の最小/最大を保っているか
+    t, (y, _, _) = groups[0]
+    pyramid = EnvelopePyramid(t, y)
+    ok = True
+    for level_t, level_y in pyramid.levels:
+        ok &= level_y.min() == y.min() and level_y.max() == y.max() and level_t[0] == t[0] and level_t[-1] == t[-1]
+    print(f"[BENCH] {len(pyramid.levels)} levels, extremes and end points preserved: {bool(ok)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark min/max LOD decimation for large plots.")
+    parser.add_argument("--groups", type=int, default=30)
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+    benchmark(args.groups, args.rows)
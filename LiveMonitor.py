@@ -0,0 +1,342 @@
+import argparse
+import queue
+import threading
+import time
+
+import numpy as np
+import matplotlib.pyplot as plt
+import matplotlib.ticker as ticker
+
+from PacketDecoder import LOG_BUFFER_SIZE, MICROS24_MASK, decode_records
+from PhaseAnalysis import relative_phase_radians, unwrap_phase_counts
+from TimeReconstruction import MICROS_SHIFT
+
+# ---------------------------
+# ライブモニタ
+#   デコード済みレコードをエージェントごとのリングバッファにメモリ上で保持し、
+#   メインスレッドの描画ループが一定フレームレートで相対位相と Agent 99 の IMU を更新する。
+#   受信側は offer() で受け渡しキューに put_nowait するだけ（満杯なら捨てて数える）なので、
+#   描画が遅くても受信/ACK は止まらない。ディスクは経由しない。
+#   描画は blitting（背景をキャッシュして線だけ描き直す）で行う。
+# ---------------------------
+RING_RECORDS = LOG_BUFFER_SIZE  # エージェントごとのリング容量（1チャンク分 = 280秒 @ 100Hz）
+WINDOW_SEC = 60.0  # 表示する直近の時間幅
+FRAME_RATE = 10.0  # 描画の上限フレームレート (Hz)
+RESAMPLE_HZ = 100.0  # 相対位相を計算する共通時間軸（上限）
+MAX_POINTS = 1500  # 1本の線に描く点数の上限（画面の横幅程度あれば十分）
+INBOX_SIZE = 4096  # 受け渡しキューの長さ（パケット数）
+IMU_AGENT_ID = 99
+TICK_SEC = (1 << MICROS_SHIFT) / 1e6  # micros24 の1カウント = 256 µs
+
+
+def record_pc_times(records, send_micros, recv_time):
+    """
+    パケット内の各レコードの PC 時刻を、送信時刻からの経過（24ビット折り返しを考慮）で求める。
+    ネットワーク遅延の分だけ遅れるが、チャンク全体を待たずにパケット単位で計算できる。
+    """
+    m = records["micros"].astype(np.int64)
+    micros24 = m[:, 0] | (m[:, 1] << 8) | (m[:, 2] << 16)
+    send24 = (send_micros >> MICROS_SHIFT) & MICROS24_MASK
+    age = (send24 - micros24) & MICROS24_MASK
+    return recv_time - age * TICK_SEC
+
+
+class RecordRing:
+    """
+    固定長のリングバッファ（時刻, a0, a1, a2）。古いレコードから上書きする。
+    """
+
+    def __init__(self, capacity=RING_RECORDS):
+        self.capacity = capacity
+        self.time = np.zeros(capacity, dtype=np.float64)
+        self.a0 = np.zeros(capacity, dtype=np.uint8)
+        self.a1 = np.zeros(capacity, dtype=np.uint8)
+        self.a2 = np.zeros(capacity, dtype=np.uint8)
+        self.head = 0  # 次に書く位置
+        self.size = 0
+
+    def extend(self, times, a0, a1, a2):
+        n = len(times)
+        if n > self.capacity:
+            times, a0, a1, a2 = times[-self.capacity:], a0[-self.capacity:], a1[-self.capacity:], a2[-self.capacity:]
+            n = self.capacity
+        idx = (self.head + np.arange(n)) % self.capacity
+        self.time[idx] = times
+        self.a0[idx] = a0
+        self.a1[idx] = a1
+        self.a2[idx] = a2
+        self.head = (self.head + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+
+    def latest_time(self):
+        return self.time[(self.head - 1) % self.capacity] if self.size else None
+
+    def window(self, t_start):
+        """
+        t_start 以降のレコードを時刻順に並べて (time, a0, a1, a2) で返す。
+        """
+        if self.size < self.capacity:
+            t = self.time[:self.size]
+            sel = np.flatnonzero(t >= t_start)
+        else:
+            sel = np.flatnonzero(self.time >= t_start)
+        if len(sel) == 0:
+            return None
+        t = self.time[sel]
+        if (np.diff(t) < 0).any():
+            sel = sel[np.argsort(t, kind="stable")]
+        return self.time[sel], self.a0[sel], self.a1[sel], self.a2[sel]
+
+
+class LiveMonitor:
+    """
+    受信スレッドから offer() で受け取り、メインスレッドで poll() を呼ぶと描画する。
+    """
+
+    def __init__(self, window_sec=WINDOW_SEC, frame_rate=FRAME_RATE, ring_records=RING_RECORDS,
+                 inbox_size=INBOX_SIZE):
+        self.window_sec = window_sec
+        self.frame_period = 1.0 / frame_rate
+        self.ring_records = ring_records
+        self.inbox = queue.Queue(maxsize=inbox_size)
+        self.rings = {}  # agent_id -> RecordRing（描画スレッドだけが触る）
+
+        self._count_lock = threading.Lock()
+        self.offered = 0
+        self.dropped = 0
+        self.frames = 0
+        self.render_time = 0.0
+
+        self.fig = None
+        self._next_frame = 0.0
+        self._background = None
+        self._phase_lines = {}  # agent_id -> Line2D
+        self._imu_lines = {}
+        self._base_agent = None
+
+    # ---------------------------
+    # 受信側（どのスレッドからでも呼べる。ブロックしない）
+    # ---------------------------
+    def offer(self, agent_id, send_micros, recv_time, records):
+        try:
+            self.inbox.put_nowait((agent_id, send_micros, recv_time, records))
+            accepted = True
+        except queue.Full:
+            accepted = False
+        with self._count_lock:  # 複数のデコードスレッドから呼ばれる
+            if accepted:
+                self.offered += 1
+            else:
+                self.dropped += 1
+
+    # ---------------------------
+    # 描画側（メインスレッド）
+    # ---------------------------
+    def drain(self):
+        """
+        受け渡しキューの中身をすべてリングバッファへ移す。移したパケット数を返す。
+        """
+        n = 0
+        while True:
+            try:
+                agent_id, send_micros, recv_time, records = self.inbox.get_nowait()
+            except queue.Empty:
+                return n
+            ring = self.rings.get(agent_id)
+            if ring is None:
+                ring = self.rings[agent_id] = RecordRing(self.ring_records)
+            ring.extend(record_pc_times(records, send_micros, recv_time),
+                        records["a0"], records["a1"], records["a2"])
+            n += 1
+
+    def start(self):
+        """
+        図を作って非ブロッキングで表示する。軸の範囲は固定（x は最新時刻からの相対秒）。
+        """
+        self.fig, (self.ax_phase, self.ax_imu) = plt.subplots(2, 1, figsize=(10, 7), sharex=True)
+        ax = self.ax_phase
+        ax.set_xlim(-self.window_sec, 0)
+        ax.set_ylim(-np.pi, np.pi)
+        ax.yaxis.set_major_locator(ticker.MultipleLocator(base=np.pi / 2))
+        ax.yaxis.set_major_formatter(ticker.FuncFormatter(lambda x, _: f"{int(x / np.pi)}π" if x % np.pi == 0 else f"{x / np.pi:.1f}π"))
+        ax.set_ylabel("Phase Diff (radians)")
+        ax.grid(True)
+        self.ax_imu.set_ylim(-128, 256)
+        self.ax_imu.set_ylabel("Agent99\na0/a1")
+        self.ax_imu.set_xlabel("Time from latest record (s)")
+        self.ax_imu.grid(True)
+        self._status_text = self.ax_phase.text(0.01, 0.97, "", transform=self.ax_phase.transAxes,
+                                               va="top", fontsize=8, animated=True)
+        self.fig.canvas.mpl_connect("draw_event", self._on_draw)
+        plt.show(block=False)
+        self.fig.canvas.draw()
+
+    def _on_draw(self, event):
+        # リサイズや凡例の更新で全体を描き直したら背景を取り直す
+        canvas = self.fig.canvas
+        self._background = canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_animated()
+
+    def _animated_artists(self):
+        return list(self._phase_lines.values()) + list(self._imu_lines.values()) + [self._status_text]
+
+    def _draw_animated(self):
+        for artist in self._animated_artists():
+            artist.axes.draw_artist(artist)
+
+    def _line(self, lines, ax, key, label, color=None):
+        line = lines.get(key)
+        if line is None:
+            line, = ax.plot([], [], label=label, color=color, animated=True)
+            lines[key] = line
+        return line
+
+    def _update_artists(self):
+        """
+        リングバッファから線のデータを作り直す。新しい線ができたら True（凡例の更新が必要）。
+        """
+        created = False
+        latest = [r.latest_time() for r in self.rings.values() if r.size]
+        if not latest:
+            return created
+        t_end = max(latest)
+        t_start = t_end - self.window_sec
+
+        phase_agents = sorted(a for a in self.rings if a != IMU_AGENT_ID)
+        grid = np.arange(t_start, t_end, max(1.0 / RESAMPLE_HZ, self.window_sec / MAX_POINTS))
+        resampled = {}
+        for agent_id in phase_agents:
+            w = self.rings[agent_id].window(t_start)
+            if w is None or len(w[0]) < 2:
+                continue
+            t, a0, _, _ = w
+            resampled[agent_id] = np.interp(grid, t, unwrap_phase_counts(a0),
+                                            left=np.nan, right=np.nan)
+
+        if resampled:
+            base = min(resampled)
+            if base != self._base_agent:
+                # 基準エージェントが変わったら線を作り直す
+                for line in self._phase_lines.values():
+                    line.remove()
+                self._phase_lines = {}
+                self._base_agent = base
+                created = True
+            for agent_id, a0 in resampled.items():
+                if agent_id == base:
+                    continue
+                n = len(self._phase_lines)
+                created |= agent_id not in self._phase_lines
+                line = self._line(self._phase_lines, self.ax_phase, agent_id,
+                                  f"Agent {agent_id} - Agent {base}", f"C{n % 10}")
+                line.set_data(grid - t_end, relative_phase_radians(a0, resampled[base]))
+
+        imu = self.rings.get(IMU_AGENT_ID)
+        w = imu.window(t_start) if imu is not None else None
+        if w is not None:
+            step = -(-len(w[0]) // MAX_POINTS)
+            t, a0, a1 = w[0][::step], w[1][::step], w[2][::step]
+            a1 = a1.astype(np.int16)
+            a1[a1 >= 170] -= 255
+            created |= not self._imu_lines
+            self._line(self._imu_lines, self.ax_imu, "a0", "Agent 99 a0", "tab:blue").set_data(t - t_end, a0)
+            self._line(self._imu_lines, self.ax_imu, "a1", "Agent 99 a1", "tab:orange").set_data(t - t_end, a1)
+
+        self._status_text.set_text(self.status_line())
+        return created
+
+    def poll(self, now=None):
+        """
+        前回の描画から 1/frame_rate 秒経っていればキューを取り込み、変化した線だけ描き直す。
+        図が閉じられていたら何もしない。
+        """
+        if self.fig is None or not plt.fignum_exists(self.fig.number):
+            return False
+        now = time.time() if now is None else now
+        if now < self._next_frame:
+            return False
+        self._next_frame = now + self.frame_period
+
+        t0 = time.perf_counter()
+        self.drain()
+        canvas = self.fig.canvas
+        if self._update_artists() or self._background is None:
+            if self._phase_lines:
+                self.ax_phase.legend(handles=list(self._phase_lines.values()), title="Relative Phase", loc="upper right")
+            if self._imu_lines:
+                self.ax_imu.legend(handles=list(self._imu_lines.values()), loc="upper right")
+            canvas.draw()  # draw_event で背景を取り直し、線も描かれる
+        else:
+            canvas.restore_region(self._background)
+            self._draw_animated()
+            canvas.blit(self.fig.bbox)
+        canvas.flush_events()
+        self.frames += 1
+        self.render_time += time.perf_counter() - t0
+        return True
+
+    def status_line(self):
+        records = sum(r.size for r in self.rings.values())
+        avg = self.render_time / self.frames * 1e3 if self.frames else 0.0
+        return (f"[LIVE] agents={len(self.rings)} records={records} packets={self.offered} "
+                f"dropped={self.dropped} frames={self.frames} render={avg:.1f}ms/frame")
+
+
+# ---------------------------
+# デモ / ベンチマーク（合成パケットを実時間の N 倍速で流す）
+# ---------------------------
+def _feed(monitor, num_agents, speed, stop):
+    from LoadGenerator import RECORD_PERIOD_US, RECORDS_PER_PACKET, agent_packets
+
+    plans = [agent_packets(k + 1, LOG_BUFFER_SIZE, start_micros=k * 1000) for k in range(num_agents)]
+    plans.append(agent_packets(IMU_AGENT_ID, LOG_BUFFER_SIZE))
+    packet_period = RECORDS_PER_PACKET * RECORD_PERIOD_US / 1e6 / speed
+    t0 = time.time()
+    for i in range(max(len(p) for p in plans)):
+        if stop.is_set():
+            return
+        # 記録時刻が実時間に沿うよう、受信時刻を記録の進みに合わせて作る
+        recv_time = t0 + i * packet_period * speed
+        for plan in plans:
+            if i < len(plan):
+                data, last24 = plan[i]
+                # 最後のレコードの直後に送ったことにする（記録しながら流す想定）
+                monitor.offer(data[0], last24 << MICROS_SHIFT, recv_time, decode_records(data))
+        time.sleep(packet_period)
+
+
+def run_demo(num_agents=5, speed=10.0, seconds=20.0):
+    from LoadGenerator import agent_packets
+
+    monitor = LiveMonitor()
+    monitor.start()
+    stop = threading.Event()
+    feeder = threading.Thread(target=_feed, args=(monitor, num_agents, speed, stop), daemon=True)
+    feeder.start()
+
+    # offer() 1回あたりのコスト（受信側に掛かる分）
+    records = decode_records(agent_packets(1, 84)[0][0])
+    t0 = time.perf_counter()
+    probe = LiveMonitor(inbox_size=100000)
+    for _ in range(10000):
+        probe.offer(1, 0, 0.0, records)
+    offer_us = (time.perf_counter() - t0) / 10000 * 1e6
+
+    end = time.time() + seconds
+    try:
+        while time.time() < end and plt.fignum_exists(monitor.fig.number):
+            if not monitor.poll():
+                time.sleep(0.005)
+    finally:
+        stop.set()
+    print(monitor.status_line())
+    print(f"[BENCH] offer() {offer_us:.2f} us/packet on the receive side")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Live monitor demo fed with synthetic agents.")
+    parser.add_argument("--agents", type=int, default=5)
+    parser.add_argument("--speed", type=float, default=10.0, help="playback speed relative to real time")
+    parser.add_argument("--seconds", type=float, default=20.0)
+    args = parser.parse_args()
+    run_demo(args.agents, args.speed, args.seconds)
@@ -0,0 +1,182 @@
+import argparse
+import select
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+from PacketDecoder import HEADER_SIZE, RECORD_SIZE, LOG_RECORD_DTYPE
+
+# ---------------------------
+# ループバック負荷生成器
+#   Pico の sendLogBuffer と同じ形式のパケットを、多数の仮想エージェントから
+#   一斉に送りつけてサーバーのバースト耐性を測る。
+# ---------------------------
+MAX_PACKET_BYTES = 512  # Volvocine_Pico.ino の maxPacketBytes
+RECORDS_PER_PACKET = (MAX_PACKET_BYTES - HEADER_SIZE) // RECORD_SIZE  # 84
+LOG_BUFFER_SIZE = 28000
+RECORD_PERIOD_US = 10000  # CONTROL_PERIOD_US (2ms) × saveInterval (5)
+
+
+def build_log_packet(agent_id, send_micros, micros24, a0, a1, a2):
+    """
+    agent_id (1) + send_micros (4) + 6バイトレコード列 のパケットを組み立てる。
+    """
+    records = np.empty(len(micros24), dtype=LOG_RECORD_DTYPE)
+    m = np.asarray(micros24, dtype=np.uint32)
+    records["micros"][:, 0] = m & 0xFF
+    records["micros"][:, 1] = (m >> 8) & 0xFF
+    records["micros"][:, 2] = (m >> 16) & 0xFF
+    records["a0"] = a0
+    records["a1"] = a1
+    records["a2"] = a2
+    return struct.pack("<BI", agent_id, send_micros & 0xFFFFFFFF) + records.tobytes()
+
+
+def synth_agent_log(agent_id, n_records=LOG_BUFFER_SIZE, start_micros=0, omega=3.14 * 3):
+    """
+    ファームウェアの logSensorData 相当の合成ログ（micros24 と a0..a2）を作る。
+    """
+    micros = start_micros + np.arange(n_records, dtype=np.uint64) * RECORD_PERIOD_US
+    micros24 = ((micros >> 8) & 0xFFFFFF).astype(np.uint32)
+    t = micros.astype(np.float64) / 1e6
+    phase = np.mod(omega * t + agent_id, 2 * np.pi)
+    a0 = (phase * (255.0 / (2 * np.pi))).astype(np.uint8)
+    a1 = np.full(n_records, 8, dtype=np.uint8)
+    a2 = (128 + 100 * np.sin(t)).astype(np.uint8)
+    return micros24, a0, a1, a2
+
+
+def agent_packets(agent_id, n_records=LOG_BUFFER_SIZE, start_micros=0):
+    """
+    1エージェント分のログを RECORDS_PER_PACKET 件ずつのパケット列にする。
+    戻り値: [(packet_bytes, last_micros24), ...]
+    """
+    micros24, a0, a1, a2 = synth_agent_log(agent_id, n_records, start_micros)
+    send_micros = start_micros + n_records * RECORD_PERIOD_US
+    packets = []
+    for i in range(0, n_records, RECORDS_PER_PACKET):
+        j = min(i + RECORDS_PER_PACKET, n_records)
+        pkt = build_log_packet(agent_id, send_micros + i, micros24[i:j], a0[i:j], a1[i:j], a2[i:j])
+        packets.append((pkt, int(micros24[j - 1])))
+    return packets
+
+
+def run_burst(target, num_agents=10, records_per_agent=LOG_BUFFER_SIZE, ack_grace=2.0):
+    """
+    全エージェントが STOP 直後に一斉送信する状況を再現する（ACKを待たずに送る）。
+    送信数・ACK受信数・所要時間を返す。
+    """
+    socks = []
+    plans = []
+    for k in range(num_agents):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.bind(("127.0.0.1", 0))
+        s.setblocking(False)
+        socks.append(s)
+        plans.append(agent_packets(k + 1, records_per_agent, start_micros=k * 1000))
+
+    acked = [set() for _ in range(num_agents)]
+    expected = [{last for _, last in p} for p in plans]
+    stop = threading.Event()
+
+    def collect():
+        while not stop.is_set():
+            ready, _, _ = select.select(socks, [], [], 0.05)
+            for s in ready:
+                k = socks.index(s)
+                while True:
+                    try:
+                        ack = s.recv(16)
+                    except BlockingIOError:
+                        break
+                    if len(ack) >= 4:
+                        acked[k].add(ack[1] | (ack[2] << 8) | (ack[3] << 16))
+
+    collector = threading.Thread(target=collect, daemon=True)
+    collector.start()
+
+    t0 = time.perf_counter()
+    sent = 0
+    sent_bytes = 0
+    longest = max(len(p) for p in plans)
+    for i in range(longest):
+        for k, plan in enumerate(plans):
+            if i < len(plan):
+                pkt = plan[i][0]
+                try:
+                    socks[k].sendto(pkt, target)
+                except BlockingIOError:
+                    continue
+                sent += 1
+                sent_bytes += len(pkt)
+    t_send = time.perf_counter() - t0
+
+    deadline = time.time() + ack_grace
+    while time.time() < deadline and sum(len(a & e) for a, e in zip(acked, expected)) < sent:
+        time.sleep(0.01)
+    stop.set()
+    collector.join()
+    for s in socks:
+        s.close()
+
+    n_acked = sum(len(a & e) for a, e in zip(acked, expected))
+    return {
+        "agents": num_agents,
+        "sent": sent,
+        "acked": n_acked,
+        "lost": sent - n_acked,
+        "send_sec": t_send,
+        "send_pps": sent / t_send if t_send else 0.0,
+        "send_MBps": sent_bytes / t_send / 1e6 if t_send else 0.0,
+    }
+
+
+def self_test(num_agents, records_per_agent, batch, rcvbuf):
+    """
+    同一プロセス内でパイプラインサーバーを起動し、バースト受信能力を測る。
+    チャンクはディスクに書かず件数だけ数える。
+    """
+    from ServerPipeline import ServerPipeline
+    from BatchReceiver import BatchReceiver, configure_socket
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if rcvbuf:
+        configure_socket(sock, rcvbuf)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(0.2)
+    receiver = BatchReceiver(sock, timeout=0.2) if batch else None
+    received = []
+    pipeline = ServerPipeline(sock, {}, chunk_timeout=60.0, receiver=receiver,
+                              chunk_sink=lambda agent_id, columns, *_: received.append(len(columns["micros24"])))
+    pipeline.start()
+    try:
+        result = run_burst(sock.getsockname(), num_agents, records_per_agent)
+        pipeline.flush_all()
+    finally:
+        pipeline.stop()
+        sock.close()
+    result["records_stored"] = sum(received)
+    print(pipeline.status_line())
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay Pico log packets over UDP to measure burst capacity.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--agents", type=int, default=10)
+    parser.add_argument("--records", type=int, default=LOG_BUFFER_SIZE, help="records per agent")
+    parser.add_argument("--self-test", action="store_true", help="start an in-process pipeline server on loopback")
+    parser.add_argument("--no-batch", action="store_true", help="self-test: use plain recvfrom instead of recvmmsg")
+    parser.add_argument("--rcvbuf", type=int, default=8 * 1024 * 1024, help="self-test: SO_RCVBUF (0 = OS default)")
+    args = parser.parse_args()
+
+    if args.self_test:
+        result = self_test(args.agents, args.records, not args.no_batch, args.rcvbuf)
+    else:
+        result = run_burst((args.host, args.port), args.agents, args.records)
+
+    print("[RESULT] " + " ".join(f"{k}={v:.2f}" if isinstance(v, float) else f"{k}={v}" for k, v in result.items()))
@@ -0,0 +1,116 @@
+import struct
+import numpy as np
+
+# ---------------------------
+# パケット形式 (Volvocine_Pico.ino の sendLogBuffer と一致させること)
+#   [agent_id:1][send_micros:4][record:6] * n
+#   record = micros24 (3バイト, little endian), a0, a1, a2
+# ---------------------------
+HEADER_SIZE = 5
+RECORD_SIZE = 6
+MICROS24_MASK = 0xFFFFFF
+LOG_BUFFER_SIZE = 28000  # Pico側の logBuffer と同じ件数を初期確保
+
+LOG_RECORD_DTYPE = np.dtype([
+    ("micros", "u1", (3,)),
+    ("a0", "u1"),
+    ("a1", "u1"),
+    ("a2", "u1"),
+])
+assert LOG_RECORD_DTYPE.itemsize == RECORD_SIZE
+
+CHUNK_COLUMNS = ["micros24", "a0", "a1", "a2"]
+
+
+def parse_header(data):
+    """
+    パケット先頭の agent_id と send_micros を返す（ペイロードは読まない）。
+    """
+    return data[0], struct.unpack_from("<I", data, 1)[0]
+
+
+def last_micros24(data):
+    """
+    最後のレコードの先頭3バイトから micros24 を直接読む（ACK用、デコードは不要）。
+    """
+    i = len(data) - RECORD_SIZE
+    return data[i] | (data[i + 1] << 8) | (data[i + 2] << 16)
+
+
+def build_ack(agent_id, micros24):
+    """
+    waitForAck が期待する4バイトACK: agent_id + micros24 (little endian)。
+    """
+    return bytes((agent_id, micros24 & 0xFF, (micros24 >> 8) & 0xFF, (micros24 >> 16) & 0xFF))
+
+
+def decode_records(data):
+    """
+    ペイロードを構造化dtypeでゼロコピーに参照する。
+    レコード長が割り切れない場合は ValueError。
+    """
+    if (len(data) - HEADER_SIZE) % RECORD_SIZE != 0:
+        raise ValueError(f"payload length {len(data) - HEADER_SIZE} is not a multiple of {RECORD_SIZE}")
+    return np.frombuffer(data, dtype=LOG_RECORD_DTYPE, offset=HEADER_SIZE)
+
+
+class AgentChunkBuffer:
+    """
+    エージェントごとの列指向チャンクバッファ。
+    レコードは事前確保した配列へ直接書き込み、足りなければ倍々で拡張する。
+    """
+
+    def __init__(self, capacity=LOG_BUFFER_SIZE):
+        self.micros24 = np.empty(capacity, dtype=np.uint32)
+        self.a0 = np.empty(capacity, dtype=np.uint8)
+        self.a1 = np.empty(capacity, dtype=np.uint8)
+        self.a2 = np.empty(capacity, dtype=np.uint8)
+        self.size = 0
+        self.send_micros = []
+        self.recv_times = []
+
+    def __len__(self):
+        return self.size
+
+    def _reserve(self, needed):
+        capacity = len(self.micros24)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name in CHUNK_COLUMNS:
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def append_records(self, records, send_micros, recv_time):
+        n = len(records)
+        start, end = self.size, self.size + n
+        self._reserve(end)
+
+        m = records["micros"]
+        out = self.micros24[start:end]
+        out[:] = m[:, 2]
+        out <<= 8
+        out |= m[:, 1]
+        out <<= 8
+        out |= m[:, 0]
+        self.a0[start:end] = records["a0"]
+        self.a1[start:end] = records["a1"]
+        self.a2[start:end] = records["a2"]
+
+        self.size = end
+        self.send_micros.append(send_micros)
+        self.recv_times.append(recv_time)
+
+    def columns(self):
+        """
+        現在のチャンクを列のコピーとして返す（reset 後も安全に使える）。
+        """
+        return {name: getattr(self, name)[:self.size].copy() for name in CHUNK_COLUMNS}
+
+    def reset(self):
+        self.size = 0
+        self.send_micros = []
+        self.recv_times = []
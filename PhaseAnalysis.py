@@ -0,0 +1,133 @@
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+
+# ---------------------------
+# 位相解析
+#   a0 は位相 [0, 2π) を 0..255 に量子化した値。
+#   アンラップ・相対位相・折り返し点の NaN マスクを NumPy でまとめて計算する。
+# ---------------------------
+PHASE_PERIOD = 256
+HALF_PERIOD = PHASE_PERIOD // 2
+
+
+def unwrap_phase_counts(phase, period=PHASE_PERIOD):
+    """
+    前サンプルから半周期より大きく跳んだ所で ±period を累積して連続化する。
+    （correct_phase_discontinuity のループと同じ結果）
+    uint8 の a0 をそのまま渡せるよう int64 で計算する（uint8 のままだと np.diff が折り返して跳びを見逃す）。
+    """
+    p = np.asarray(phase, dtype=np.int64)
+    if len(p) < 2:
+        return p.copy()
+    d = np.diff(p)
+    half = period // 2
+    steps = (d < -half).astype(np.int64) - (d > half).astype(np.int64)
+    corrections = np.empty(len(p), dtype=np.int64)
+    corrections[0] = 0
+    np.cumsum(steps, out=corrections[1:])
+    return p + corrections * period
+
+
+def wrapped_difference(a, b, period=PHASE_PERIOD):
+    """
+    a − b を [-period/2, period/2) に折り返す。
+    """
+    half = period // 2
+    return (np.asarray(a) - np.asarray(b) + half) % period - half
+
+
+def mask_wrap_jumps(diff, threshold=HALF_PERIOD):
+    """
+    前サンプルとの差が threshold を超える点（折り返し）を NaN にしたコピーを返す。
+    """
+    out = np.array(diff, dtype=np.float64)
+    if len(out) > 1:
+        jumps = np.abs(np.diff(diff)) > threshold
+        out[1:][jumps] = np.nan
+    return out
+
+
+def relative_phase_radians(phase, base_phase, period=PHASE_PERIOD):
+    """
+    基準エージェントとの相対位相 [rad]。折り返し点は線が繋がらないよう NaN にする。
+    """
+    diff = wrapped_difference(phase, base_phase, period)
+    return mask_wrap_jumps(diff, period // 2) * (2 * np.pi / period)
+
+
+# ---------------------------
+# マイクロベンチマーク（merged_chunks の実データ）
+# ---------------------------
+def _loop_unwrap(phase_data):
+    # Plotter.correct_phase_discontinuity の従来実装
+    corrected_phase = phase_data.copy()
+    for i in range(1, len(corrected_phase)):
+        diff = corrected_phase[i] - corrected_phase[i - 1]
+        if diff < -128:
+            corrected_phase[i:] += 256
+        elif diff > 128:
+            corrected_phase[i:] -= 256
+    return corrected_phase
+
+
+def _loop_relative(a0, base):
+    # plot_relativePhase 内の従来ループ
+    phase_diff = (a0 - base + 128) % 256 - 128
+    phase_diff_with_nan = phase_diff.copy()
+    for i in range(1, len(phase_diff)):
+        if abs(phase_diff[i] - phase_diff[i - 1]) > 128:
+            phase_diff_with_nan[i] = np.nan
+    return phase_diff_with_nan * (2 * np.pi / 256)
+
+
+def _timed(fn, *args):
+    t0 = time.perf_counter()
+    out = fn(*args)
+    return out, time.perf_counter() - t0
+
+
+def benchmark(files):
+    from ChunkStorage import load_chunk_file
+
+    total = {"unwrap_loop": 0.0, "unwrap_vec": 0.0, "rel_loop": 0.0, "rel_vec": 0.0}
+    samples = 0
+    for path in files:
+        df = load_chunk_file(path, columns=["agent_id", "time_pc_sec_abs", "a0"])
+        series = []
+        for _, sub in df[df["agent_id"] != 99].groupby("agent_id"):
+            a0 = sub.sort_values("time_pc_sec_abs")["a0"].to_numpy().astype(np.int64)
+            ref, t_loop = _timed(_loop_unwrap, a0)
+            got, t_vec = _timed(unwrap_phase_counts, a0)
+            assert np.array_equal(ref, got), path
+            total["unwrap_loop"] += t_loop
+            total["unwrap_vec"] += t_vec
+            samples += len(a0)
+            series.append(got.astype(np.float64))
+        if len(series) >= 2:
+            n = min(len(s) for s in series)
+            base = series[0][:n]
+            for s in series[1:]:
+                ref, t_loop = _timed(_loop_relative, s[:n], base)
+                got, t_vec = _timed(relative_phase_radians, s[:n], base)
+                assert np.array_equal(ref, got, equal_nan=True), path
+                total["rel_loop"] += t_loop
+                total["rel_vec"] += t_vec
+
+    print(f"[BENCH] {len(files)} files, {samples} samples")
+    print(f"[BENCH] unwrap   loop {total['unwrap_loop'] * 1e3:9.1f} ms  vectorized {total['unwrap_vec'] * 1e3:7.1f} ms  "
+          f"(x{total['unwrap_loop'] / max(total['unwrap_vec'], 1e-12):.0f})")
+    print(f"[BENCH] relative loop {total['rel_loop'] * 1e3:9.1f} ms  vectorized {total['rel_vec'] * 1e3:7.1f} ms  "
+          f"(x{total['rel_loop'] / max(total['rel_vec'], 1e-12):.0f})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark phase unwrapping against the previous loops.")
+    parser.add_argument("directory", nargs="?", default="merged_chunks")
+    parser.add_argument("--files", type=int, default=10, help="number of newest files to use")
+    args = parser.parse_args()
+    paths = sorted(p for p in glob.glob(os.path.join(args.directory, "*.csv")) if os.path.getsize(p) > 1)
+    benchmark(paths[-args.files:])
@@ -0,0 +1,266 @@
+import argparse
+import hashlib
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from SessionAnalysis import IMU_AGENT_ID, RESAMPLE_HZ, overlap_window, phase_tracks, resample_tracks
+from SessionLoader import load_session_files
+from TimeAnomalies import JUMP_THRESHOLD_SEC, T_TOL
+from TimeReconstruction import T_OVERFLOW
+
+# ---------------------------
+# 再サンプル結果のキャッシュ（plot_relativePhase 用）
+#   段階1: 時刻補正・並べ替え・アンラップ済みのエージェントごとの (時刻, 位相) と Agent 99 の列
+#   段階2: 段階1 を rate [Hz] の共通時間軸に補間した行列
+#   基準エージェントや表示区間を変えても再計算せず、rate を変えたときは段階1 から補間だけやり直す。
+#   キーはファイルのパス・サイズ・更新時刻と補正/再サンプルのパラメータ。
+#   ディスク (npz) とメモリの両方に置き、どちらも最近使っていないものから捨てる（LRU）。
+# ---------------------------
+CACHE_FOLDER = ".resample_cache"
+MAX_CACHE_BYTES = 512 * 1024 * 1024  # ディスクキャッシュの上限
+MEMORY_ENTRIES = 8  # プロセス内に保持する件数
+CACHE_VERSION = 1  # 補正や保存形式を変えたら上げる
+
+_memory = OrderedDict()
+
+
+class AlignedSession:
+    """
+    共通時間軸に揃えた位相行列。time は min_time からの秒、phases[i] は agents[i] の a0 カウント。
+    """
+
+    def __init__(self, time, min_time, agents, phases, imu):
+        self.time = time
+        self.min_time = min_time
+        self.agents = agents
+        self.phases = phases
+        self.imu = imu  # {"time_pc_sec_abs", "a0", "a1"} の配列
+
+    def phase_dict(self):
+        return {int(a): self.phases[i] for i, a in enumerate(self.agents)}
+
+    def window(self, start=None, end=None):
+        """
+        min_time からの秒で [start, end) を切り出した AlignedSession（配列はビュー）。
+        """
+        lo = 0 if start is None else np.searchsorted(self.time, start)
+        hi = len(self.time) if end is None else np.searchsorted(self.time, end)
+        imu_t = self.imu["time_pc_sec_abs"] - self.min_time
+        keep = np.ones(len(imu_t), dtype=bool)
+        if start is not None:
+            keep &= imu_t >= start
+        if end is not None:
+            keep &= imu_t < end
+        imu = {k: v[keep] for k, v in self.imu.items()}
+        return AlignedSession(self.time[lo:hi], self.min_time, self.agents, self.phases[:, lo:hi], imu)
+
+    def imu_frame(self):
+        return pd.DataFrame(self.imu)
+
+
+# ---------------------------
+# キーと保存
+# ---------------------------
+def _signature(file_list):
+    parts = [f"v{CACHE_VERSION}", f"{T_OVERFLOW!r}", f"{T_TOL!r}", f"{JUMP_THRESHOLD_SEC!r}"]
+    for path in file_list:
+        st = os.stat(path)
+        parts.append(f"{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}")
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+
+def _cache_file(cache_dir, key, stage):
+    return os.path.join(cache_dir, f"{key}_{stage}.npz")
+
+
+def _read(path):
+    try:
+        with np.load(path) as z:
+            data = {k: z[k] for k in z.files}
+    except (OSError, ValueError):
+        return None
+    os.utime(path)  # LRU 用に最終使用時刻を更新
+    return data
+
+
+def _write(path, cache_dir, max_bytes, **arrays):
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = path + ".tmp.npz"
+    np.savez(tmp, **arrays)
+    os.replace(tmp, path)
+    evict(cache_dir, max_bytes)
+
+
+def evict(cache_dir=CACHE_FOLDER, max_bytes=MAX_CACHE_BYTES):
+    """
+    合計サイズが max_bytes を超えていたら、最終使用時刻の古いファイルから消す。消した数を返す。
+    """
+    if not os.path.isdir(cache_dir):
+        return 0
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        st = os.stat(path)
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+        removed += 1
+    return removed
+
+
+def _remember(key, value):
+    _memory[key] = value
+    _memory.move_to_end(key)
+    while len(_memory) > MEMORY_ENTRIES:
+        _memory.popitem(last=False)
+
+
+def clear_memory():
+    _memory.clear()
+
+
+# ---------------------------
+# 段階1: 補正・アンラップ済みトラック
+# ---------------------------
+def _build_tracks(file_list, prepare):
+    df = load_session_files(file_list)
+    if df is None:
+        return None
+    df = prepare(df)
+    min_time, max_time = overlap_window(df)
+    tracks = phase_tracks(df)
+    agents = np.array(sorted(tracks), dtype=np.int64)
+    lengths = np.array([len(tracks[a][0]) for a in agents], dtype=np.int64)
+    df_99 = df[df["agent_id"] == IMU_AGENT_ID]
+    return {
+        "window": np.array([min_time, max_time]),
+        "agents": agents,
+        "offsets": np.concatenate(([0], np.cumsum(lengths))),
+        "times": np.concatenate([tracks[a][0] for a in agents]) if len(agents) else np.empty(0),
+        "phases": np.concatenate([tracks[a][1] for a in agents]) if len(agents) else np.empty(0, dtype=np.int64),
+        "imu_time": df_99["time_pc_sec_abs"].to_numpy(dtype=np.float64),
+        "imu_a0": df_99["a0"].to_numpy(),
+        "imu_a1": df_99["a1"].to_numpy(),
+    }
+
+
+def _tracks_from(stage1):
+    off = stage1["offsets"]
+    return {int(a): (stage1["times"][off[i]:off[i + 1]], stage1["phases"][off[i]:off[i + 1]])
+            for i, a in enumerate(stage1["agents"])}
+
+
+def load_aligned(file_list, prepare, rate=RESAMPLE_HZ, cache_dir=CACHE_FOLDER, max_bytes=MAX_CACHE_BYTES):
+    """
+    ファイル群を rate [Hz] に揃えた AlignedSession を返す（重なりが無ければ None）。
+    prepare(df) は時刻補正を行う関数（Plotter.prepare_session_times）。キャッシュが無いときだけ呼ばれる。
+    """
+    if isinstance(file_list, str):
+        file_list = [file_list]
+    file_list = [f for f in file_list if os.path.isfile(f)]
+    if not file_list:
+        return None
+    key = _signature(file_list)
+    rate_key = f"{key}_{rate:g}hz"
+
+    aligned = _memory.get(rate_key)
+    if aligned is not None:
+        _memory.move_to_end(rate_key)
+        return aligned
+
+    stage2_path = _cache_file(cache_dir, key, f"{rate:g}hz")
+    stage2 = _read(stage2_path) if os.path.isfile(stage2_path) else None
+    if stage2 is None:
+        stage1_path = _cache_file(cache_dir, key, "tracks")
+        stage1 = _memory.get(key)
+        if stage1 is None and os.path.isfile(stage1_path):
+            stage1 = _read(stage1_path)
+        if stage1 is None:
+            stage1 = _build_tracks(file_list, prepare)
+            if stage1 is None:
+                return None
+            _write(stage1_path, cache_dir, max_bytes, **stage1)
+        else:
+            print(f"[INFO] Reusing cached corrected tracks ({len(stage1['agents'])} agents).")
+        _remember(key, stage1)
+
+        min_time, max_time = stage1["window"]
+        if min_time >= max_time:
+            print(f"[INFO] No overlapping time range for agents. min_time={min_time}, max_time={max_time}")
+            return None
+        time_series, phases = resample_tracks(_tracks_from(stage1), min_time, max_time, rate)
+        agents = stage1["agents"]
+        stage2 = {
+            "time": time_series,
+            "min_time": np.array(min_time),
+            "agents": agents,
+            "matrix": np.vstack([phases[int(a)] for a in agents]) if len(agents) else np.empty((0, len(time_series))),
+            "imu_time": stage1["imu_time"],
+            "imu_a0": stage1["imu_a0"],
+            "imu_a1": stage1["imu_a1"],
+        }
+        _write(stage2_path, cache_dir, max_bytes, **stage2)
+    else:
+        print(f"[INFO] Using cached {rate:g} Hz resampled data.")
+
+    aligned = AlignedSession(stage2["time"], float(stage2["min_time"]), stage2["agents"], stage2["matrix"],
+                             {"time_pc_sec_abs": stage2["imu_time"], "a0": stage2["imu_a0"], "a1": stage2["imu_a1"]})
+    _remember(rate_key, aligned)
+    return aligned
+
+
+# ---------------------------
+# ベンチマーク
+# ---------------------------
+def benchmark(path, cache_dir=None):
+    import contextlib
+    import io
+    import tempfile
+    from Plotter import prepare_session_times
+    from SessionAnalysis import resample_phases
+
+    def uncached():
+        df = load_session_files([path])
+        return resample_phases(prepare_session_times(df))
+
+    def timed(fn):
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            out = fn()
+        return out, (time.perf_counter() - t0) * 1e3
+
+    if cache_dir is None:
+        with tempfile.TemporaryDirectory() as tmp:
+            return benchmark(path, tmp)
+
+    ref, t_full = timed(uncached)
+    clear_memory()
+    _, t_miss = timed(lambda: load_aligned(path, prepare_session_times, cache_dir=cache_dir))
+    clear_memory()
+    got, t_disk = timed(lambda: load_aligned(path, prepare_session_times, cache_dir=cache_dir))
+    _, t_mem = timed(lambda: load_aligned(path, prepare_session_times, cache_dir=cache_dir))
+    clear_memory()
+    _, t_rate = timed(lambda: load_aligned(path, prepare_session_times, rate=50.0, cache_dir=cache_dir))
+    _, t_win = timed(lambda: got.window(10.0, 40.0))
+
+    same = np.array_equal(ref[0], got.time) and all(np.array_equal(ref[2][a], p) for a, p in got.phase_dict().items())
+    print(f"[BENCH] {path}: identical to uncached path: {same}")
+    print(f"[BENCH] uncached {t_full:7.1f} ms | miss {t_miss:7.1f} ms | disk hit {t_disk:6.1f} ms | "
+          f"memory hit {t_mem:5.2f} ms | new rate (tracks cached) {t_rate:6.1f} ms | window {t_win:5.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the resampling cache on one merged file.")
+    parser.add_argument("file")
+    parser.add_argument("--cache-dir", default=None, help="empty directory to use (default: a temporary one)")
+    args = parser.parse_args()
+    benchmark(args.file, args.cache_dir)
@@ -0,0 +1,114 @@
+import argparse
+import collections
+import time
+
+from PacketDecoder import HEADER_SIZE, RECORD_SIZE, last_micros24
+
+# ---------------------------
+# 再送パケットの抑止
+#   ACK が届かないと Pico の sendLogBuffer は同じレコード列を送り直す（ヘッダの send_micros だけ変わる）。
+#   エージェントごとに直近 DEDUP_WINDOW 個のパケットを
+#   (先頭 micros24, 最後の micros24, レコード数) で覚えておき、同じものはデコード前に捨てる。
+#   ACK は再送にも必ず返す（返さないと Pico は maxRetries まで送り続ける）。
+#   micros24 は約16.8秒で一周するので、キーが一致したときはペイロードも比べて確かめる。
+# ---------------------------
+DEDUP_WINDOW = 16  # エージェントごとに覚えておくパケット数（停止-待機式なので本来は直前の1個で足りる）
+
+
+def packet_key(data):
+    """
+    (先頭 micros24, 最後の micros24, レコード数)。ヘッダ位置から直接読むのでデコードは不要。
+    """
+    first = data[HEADER_SIZE] | (data[HEADER_SIZE + 1] << 8) | (data[HEADER_SIZE + 2] << 16)
+    return first, last_micros24(data), (len(data) - HEADER_SIZE) // RECORD_SIZE
+
+
+class RetransmitFilter:
+    """
+    エージェントごとの直近パケットの記録。check() で再送か調べ、受け付けたパケットは add() で覚える。
+    キューが溢れて捨てたパケット（ACK を返していない）は add() しないこと。
+    """
+
+    def __init__(self, window=DEDUP_WINDOW):
+        self.window = window
+        self.recent = {}  # agent_id -> {key: (data, recv_time)}（挿入順 = 古い順）
+        self.suppressed = collections.Counter()  # agent_id -> 抑止した再送の数
+
+    def check(self, data, recv_time):
+        """
+        同じパケットを受け付け済みなら、最初に受けてからの経過秒数を返す。新しいパケットなら None。
+        """
+        recent = self.recent.get(data[0])
+        if not recent:
+            return None
+        seen = recent.get(packet_key(data))
+        if seen is None:
+            return None
+        first_data, first_time = seen
+        if memoryview(data)[HEADER_SIZE:] != memoryview(first_data)[HEADER_SIZE:]:
+            return None  # micros24 が一周して偶然キーが一致しただけ
+        self.suppressed[data[0]] += 1
+        return recv_time - first_time
+
+    def add(self, data, recv_time):
+        recent = self.recent.get(data[0])
+        if recent is None:
+            recent = self.recent[data[0]] = {}
+        recent[packet_key(data)] = (data, recv_time)
+        if len(recent) > self.window:
+            del recent[next(iter(recent))]
+
+    def total(self):
+        return sum(self.suppressed.values())
+
+    def summary(self):
+        return " ".join(f"{a}:{n}" for a, n in sorted(self.suppressed.items())) or "-"
+
+
+# ---------------------------
+# ベンチマーク（1パケットあたりのコスト）
+# ---------------------------
+def benchmark(num_packets=200000, num_agents=10, records_per_packet=84, dup_rate=0.05):
+    import numpy as np
+    from LoadGenerator import build_log_packet
+    from PacketDecoder import AgentChunkBuffer, decode_records
+
+    rng = np.random.default_rng(0)
+    packets = []
+    t = np.zeros(num_agents, dtype=np.int64)
+    for i in range(num_packets):
+        agent_id = i % num_agents + 1
+        micros = (t[agent_id - 1] + np.arange(records_per_packet) * 10000) & 0xFFFFFF
+        t[agent_id - 1] += records_per_packet * 10000
+        a = rng.integers(0, 256, (3, records_per_packet), dtype=np.uint8)
+        packets.append(build_log_packet(agent_id, i * 977, micros, *a))
+        if rng.random() < dup_rate:
+            packets.append(build_log_packet(agent_id, i * 977 + 1100000, micros, *a))  # send_micros だけ違う再送
+
+    f = RetransmitFilter()
+    t0 = time.perf_counter()
+    for data in packets:
+        if f.check(data, 0.0) is None:
+            f.add(data, 0.0)
+    elapsed = time.perf_counter() - t0
+    expected = len(packets) - num_packets
+    print(f"[BENCH] {len(packets)} packets ({expected} retransmits): filter {elapsed / len(packets) * 1e6:.2f} us/packet, "
+          f"suppressed={f.total()} (expected {expected})")
+
+    # 比較: 再送をそのままデコードして列バッファに積むコスト
+    buf = AgentChunkBuffer()
+    t0 = time.perf_counter()
+    for data in packets:
+        buf.append_records(decode_records(data), 0, 0.0)
+        if len(buf) > 1000000:
+            buf.reset()
+    elapsed = time.perf_counter() - t0
+    print(f"[BENCH] decode + append: {elapsed / len(packets) * 1e6:.2f} us/packet")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the per-packet cost of retransmit suppression.")
+    parser.add_argument("--packets", type=int, default=200000)
+    parser.add_argument("--dup-rate", type=float, default=0.05)
+    args = parser.parse_args()
+    benchmark(args.packets, dup_rate=args.dup_rate)
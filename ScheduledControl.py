@@ -0,0 +1,431 @@
+import argparse
+import itertools
+import threading
+import time
+
+import numpy as np
+
+# ---------------------------
+# 予約つき START/STOP（全エージェントの開始・停止の時刻をそろえる）
+#   以前は 's' / 't' で agent_addrs の各エージェントに START/STOP を4回ずつ順に送るだけだった。
+#   届いたかどうかは分からず、WiFi の遅延や取りこぼしがそのまま開始時刻のずれになっていた。
+#   ここでは PC 時刻 T を決め、エージェントごとに T に当たる自分の micros() の値を計算して
+#   START_AT:<micros> を送る。時刻を絶対値で渡すので、届くのが遅れても再送しても開始時刻は変わらない。
+#     - PC 時刻から micros への換算には ClockSyncEstimator の推定（send_micros から求めた offset と skew）を使う。
+#       推定がまだ無いエージェント（セッション最初の START など）には先に SYNC を数回送り、
+#       往復時間が最短だった返事から換算を作る（誤差は往復時間の半分以内）。
+#     - Pico は受け取った時点の micros() を添えて ACK を返す。返事の無いエージェントにだけ再送する。
+#       ACK の micros() が換算と合わない（Pico が再起動した等）ときは換算を直して予約し直す。
+#     - T までに確認が取れなかったエージェント（START_AT を知らない古いファームウェアを含む）には、
+#       T の時点で従来の START/STOP を送る。
+#   T を過ぎたら、確認の取れたエージェントの開始時刻が T からどれだけずれうるか（SYNC と ACK の往復時間から分かる上限）を表示する。
+# プロトコル（ファームウェア側は Volvocine_Pico.ino の checkControlCommand）:
+#   サーバー -> Pico: SYNC:<seq>          Pico -> サーバー: SYNC:<agent_id>:<seq>:<受信時の micros>
+#   サーバー -> Pico: START_AT:<micros>   Pico -> サーバー: ACK:START_AT:<agent_id>:<予定の micros>:<受信時の micros>
+#   STOP_AT も同じ形。
+# ---------------------------
+LEAD_SEC = 0.5  # 予約を送ってから T までの余裕（この間に再送と換算の修正を済ませる）
+RETRY_SEC = 0.1  # 返事の無いエージェントへの再送間隔
+GUARD_SEC = 0.02  # T の直前には送り直さない
+SYNC_PROBES = 10  # 推定の無いエージェントに送る SYNC の数
+SYNC_INTERVAL = 0.01  # SYNC を送る間隔（全体で WiFi 省電力の起床間隔 約0.1秒をまたぐ）
+SYNC_WAIT_SEC = 0.3  # SYNC の返事を待つ最大時間
+MAPPING_TOL_SEC = 0.005  # ACK の micros() が換算からこれ以上外れていたら換算を直す
+POLL_SEC = 0.005  # 予約中に poll する間隔
+FALLBACK_REPEATS = 4  # 確認の取れなかったエージェントに従来の命令を送る回数（以前の range(1, 5) と同じ）
+REPLY_PREFIXES = (b"SYNC:", b"ACK:")
+MICROS_WRAP = 1 << 32
+
+_probe_seq = itertools.count(1)
+
+
+def _signed_micros(d):
+    """
+    32ビットの micros の差を符号付きにする（折り返しをまたいでも正しい向き）。
+    """
+    return (d + (MICROS_WRAP >> 1)) % MICROS_WRAP - (MICROS_WRAP >> 1)
+
+
+class ClockMapping:
+    """
+    PC 時刻と Pico の micros()（32ビット）の一次の対応。pc_ref で micros_ref、Pico の時計は PC の 1/(1 + skew) 倍で進む。
+    error は換算の誤差の上限（秒、ClockSync の推定では不明なので None）、source は "clock"（ClockSync の推定）/ "sync"（SYNC の返事）/ "ack"（ACK で直したもの）。
+    """
+
+    def __init__(self, pc_ref, micros_ref, skew=0.0, error=None, source="sync"):
+        self.pc_ref = pc_ref
+        self.micros_ref = micros_ref
+        self.skew = skew
+        self.error = error
+        self.source = source
+
+    def micros_at(self, pc_time):
+        return int(round(self.micros_ref + (pc_time - self.pc_ref) / (1.0 + self.skew) * 1e6)) % MICROS_WRAP
+
+    def pc_at(self, micros):
+        return self.pc_ref + _signed_micros(micros - self.micros_ref) / 1e6 * (1.0 + self.skew)
+
+
+class _AgentState:
+    def __init__(self):
+        self.mapping = None
+        self.probes = {}  # seq -> 送信時刻
+        self.replies = 0
+        self.target = None  # 予約した micros
+        self.copies = {}  # 送った値 -> 送信時刻（再送は target に 1 μs ずつ足して、どの送信への ACK か分かるようにする）
+        self.last_sent = None
+        self.acked = None  # (受信時の micros, ACK を受けた PC 時刻)
+        self.start_window = None  # 開始時刻の T からのずれの範囲 (下限, 上限)
+        self.fallback = False
+
+
+class ScheduledCommand:
+    """
+    1回分の予約（name は "START" か "STOP"）。send(agent_id, text) で送り、返事は on_reply、時間の経過は poll で進める。
+    poll が True を返したら終わり（report / result で結果を見る）。1つのスレッドからだけ使う（CommandFanout がロックする）。
+    """
+
+    def __init__(self, name, agent_ids, send, clocks=None, lead=LEAD_SEC, now=None):
+        self.name = name
+        self.send = send
+        self.lead = lead
+        self.started = time.time() if now is None else now
+        self.target_time = None  # T（PC 時刻）。SYNC が済んでから決める
+        self.retries = 0
+        self.corrections = 0
+        self.done = False
+        self.agents = {agent_id: _AgentState() for agent_id in agent_ids}
+        for agent_id, state in self.agents.items():
+            clock = clocks.get(agent_id) if clocks else None
+            if clock is not None and clock.ready:
+                clock = clock.snapshot()
+                state.mapping = ClockMapping(self.started, clock.micros_at(self.started), clock.skew, source="clock")
+        self._last_probe = None
+
+    # ---------------------------
+    # 返事
+    # ---------------------------
+    def on_reply(self, data, recv_time):
+        parts = data.decode(errors="ignore").split(":")
+        try:
+            if parts[0] == "SYNC" and len(parts) == 4:
+                self._on_sync(int(parts[1]), int(parts[2]), int(parts[3]), recv_time)
+            elif parts[0] == "ACK" and len(parts) == 5 and parts[1] == self.name + "_AT":
+                self._on_ack(int(parts[2]), int(parts[3]), int(parts[4]), recv_time)
+        except ValueError:
+            print(f"[WARN] Malformed control reply: {data!r}")
+
+    def _on_sync(self, agent_id, seq, micros, recv_time):
+        state = self.agents.get(agent_id)
+        if state is None or seq not in state.probes:
+            return
+        sent = state.probes.pop(seq)
+        state.replies += 1
+        error = (recv_time - sent) / 2
+        if state.mapping is None or error < state.mapping.error:
+            state.mapping = ClockMapping(sent + error, micros, error=error, source="sync")
+
+    def _on_ack(self, agent_id, target, micros, recv_time):
+        state = self.agents.get(agent_id)
+        if state is None or target not in state.copies or self.done:
+            return  # 直す前の予約への返事
+        # Pico が受け取ったのは [その値を送った時刻, ACK を受けた時刻] のどこか
+        lo, hi = state.copies[target], recv_time
+        mapped = state.mapping.pc_at(micros)
+        if mapped < lo - MAPPING_TOL_SEC or mapped > hi + MAPPING_TOL_SEC:
+            self.corrections += 1
+            state.mapping = ClockMapping((lo + hi) / 2, micros, state.mapping.skew, (hi - lo) / 2, source="ack")
+            print(f"[WARN] Agent {agent_id}: clock mapping was off by {(mapped - (lo + hi) / 2) * 1e3:+.1f} ms; "
+                  f"rescheduling {self.name}.")
+            if recv_time < self.target_time - GUARD_SEC:
+                self._send_target(agent_id, state, recv_time)
+                return
+        state.acked = (micros, recv_time)
+        until = _signed_micros(target - micros) / 1e6 * (1.0 + state.mapping.skew)
+        lo, hi = lo + until - self.target_time, hi + until - self.target_time
+        error = state.mapping.error
+        if error is not None and max(lo, -error) <= min(hi, error):
+            lo, hi = max(lo, -error), min(hi, error)  # 換算自体の誤差の範囲とも重ねる
+        state.start_window = (lo, hi)
+
+    # ---------------------------
+    # 送信
+    # ---------------------------
+    def _send_target(self, agent_id, state, now):
+        state.target = state.mapping.micros_at(self.target_time)
+        state.copies = {}
+        state.acked = None
+        self._send_copy(agent_id, state, now)
+
+    def _send_copy(self, agent_id, state, now):
+        value = (state.target + len(state.copies)) % MICROS_WRAP
+        state.copies[value] = state.last_sent = now
+        self.send(agent_id, f"{self.name}_AT:{value}")
+
+    def poll(self, now):
+        if self.done:
+            return True
+        if self.target_time is None:
+            self._sync(now)
+            if self.target_time is None:
+                return False
+
+        if now < self.target_time - GUARD_SEC:
+            for agent_id, state in self.agents.items():
+                if state.target is not None and state.acked is None and now - state.last_sent >= RETRY_SEC:
+                    self.retries += 1
+                    self._send_copy(agent_id, state, now)
+            return False
+        if now < self.target_time:
+            return False
+
+        # T: 確認の取れなかったエージェントには従来の命令を送る
+        late = [agent_id for agent_id, state in self.agents.items() if state.acked is None]
+        for _ in range(FALLBACK_REPEATS):
+            for agent_id in late:
+                self.send(agent_id, self.name)
+        for agent_id in late:
+            self.agents[agent_id].fallback = True
+        self.done = True
+        return True
+
+    def _sync(self, now):
+        """
+        推定の無いエージェントに SYNC を送り、返事がそろうか SYNC_WAIT_SEC が過ぎたら T を決めて予約を一斉に送る。
+        """
+        waiting = [(agent_id, state) for agent_id, state in self.agents.items()
+                   if state.mapping is None or state.mapping.source == "sync"]
+        if waiting and now - self.started < SYNC_WAIT_SEC:
+            if self._last_probe is None or now - self._last_probe >= SYNC_INTERVAL:
+                sending = [(agent_id, state) for agent_id, state in waiting
+                           if len(state.probes) + state.replies < SYNC_PROBES]
+                if sending:
+                    self._last_probe = now
+                    for agent_id, state in sending:
+                        seq = next(_probe_seq)
+                        state.probes[seq] = time.time()
+                        self.send(agent_id, f"SYNC:{seq}")
+            if any(state.replies < SYNC_PROBES for _, state in waiting):
+                return
+
+        self.target_time = now + self.lead
+        # 送る内容を先に全部作ってから、間を空けずに続けて送る
+        for agent_id, state in self.agents.items():
+            state.probes.clear()
+            if state.mapping is not None:
+                self._send_target(agent_id, state, now)
+
+    # ---------------------------
+    # 結果
+    # ---------------------------
+    def result(self):
+        windows = [s.start_window for s in self.agents.values() if s.start_window is not None]
+        out = {
+            "command": self.name, "agents": len(self.agents), "confirmed": len(windows),
+            "fallback": sum(s.fallback for s in self.agents.values()),
+            "unsynced": sum(s.mapping is None for s in self.agents.values()),
+            "retries": self.retries, "corrections": self.corrections,
+        }
+        if windows:
+            w = np.array(windows) * 1e3
+            bound = np.abs(w).max(axis=1)
+            out["bound_p50_ms"] = float(np.median(bound))
+            out["bound_max_ms"] = float(bound.max())
+            out["spread_max_ms"] = float(w[:, 1].max() - w[:, 0].min())
+        return out
+
+    def report(self):
+        r = self.result()
+        line = (f"[STATS] {self.name} at {time.strftime('%H:%M:%S', time.localtime(self.target_time))}"
+                f".{int(self.target_time * 1000) % 1000:03d}: confirmed {r['confirmed']}/{r['agents']} "
+                f"(retries {r['retries']}, clock corrections {r['corrections']}, fallback {r['fallback']})")
+        if r["confirmed"]:
+            line += (f"\n[STATS] {self.name} offset from T (upper bound per agent): p50 ±{r['bound_p50_ms']:.2f} ms, "
+                     f"max ±{r['bound_max_ms']:.2f} ms; spread between agents at most {r['spread_max_ms']:.2f} ms")
+        late = sorted(a for a, s in self.agents.items() if s.fallback)
+        if late:
+            line += f"\n[WARN] No {self.name}_AT confirmation from agents {late}: sent plain {self.name} at T."
+        return line
+
+
+class CommandFanout:
+    """
+    予約コマンドの窓口。サーバーは 's' / 't' で schedule を呼び、SYNC: / ACK: で始まる返事を on_reply に渡す。
+    on_reply は別スレッド（パイプラインの受信スレッド）から呼んでもよい。
+    attach した ServerLoop のタイマーで、予約中だけ POLL_SEC ごとに poll する。
+    """
+
+    def __init__(self, send, clocks=None, lead=LEAD_SEC):
+        self.send = send  # send(agent_id, text)
+        self.clocks = clocks  # agent_id -> ClockSyncEstimator（無ければ毎回 SYNC）
+        self.lead = lead
+        self.active = []
+        self.finished = []
+        self._lock = threading.Lock()
+        self._loop = None
+        self._ticking = False
+
+    def attach(self, loop):
+        self._loop = loop
+
+    def schedule(self, name, agent_ids):
+        now = time.time()
+        command = ScheduledCommand(name, agent_ids, self.send, self.clocks, self.lead, now)
+        with self._lock:
+            # 同じ命令をもう一度押したら、前の予約を置き換える
+            self.active = [c for c in self.active if c.name != name] + [command]
+        print(f"[INFO] Scheduling {name} for {len(command.agents)} agents.")
+        self.poll()
+        return command
+
+    def on_reply(self, data, addr, recv_time):
+        with self._lock:
+            for command in self.active:
+                command.on_reply(data, recv_time)
+
+    def poll(self):
+        """
+        予約を進める。まだ予約中なら True。
+        """
+        now = time.time()
+        with self._lock:
+            for command in list(self.active):
+                if command.poll(now):
+                    self.active.remove(command)
+                    self.finished.append(command)
+                    print(command.report())
+            busy = bool(self.active)
+        if busy and self._loop is not None and not self._ticking:
+            self._ticking = True
+            self._loop.call_later(POLL_SEC, self._tick)
+        return busy
+
+    def _tick(self):
+        self._ticking = False
+        self.poll()
+
+
+# ---------------------------
+# ベンチマーク（AgentEmulator の仮想エージェントが実際に START/STOP した時刻のずれ）
+# ---------------------------
+def _emulator_process(server, num_agents, rounds, jitter, loss, wake, seed, finished, out):
+    import asyncio
+    from AgentEmulator import EmulatorStats, run_agents, synthetic_replay
+
+    stats = EmulatorStats()
+    replay = synthetic_replay(num_agents, records=2000, chunks=rounds)
+
+    async def run():
+        # START を取りこぼしたエージェントは次の START を待ち続けるので、サーバー側の合図で打ち切る
+        task = asyncio.ensure_future(run_agents(server, replay, speed=1.0, auto=False, loss=loss, jitter=jitter,
+                                                seed=seed, stats=stats, wake=wake))
+        while not task.done() and not finished.is_set():
+            await asyncio.sleep(0.1)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
+    out.put(stats.transitions)
+
+
+def benchmark(num_agents=10, jitter=0.005, loss=0.05, wake=0.1, seed=0, record_sec=2.0):
+    import contextlib
+    import io
+    import multiprocessing
+    import socket
+
+    from BatchReceiver import BatchReceiver, configure_socket
+    from ServerPipeline import ServerPipeline
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    configure_socket(sock)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(0.2)
+    agent_addrs = {}
+    current = [None]  # 今の CommandFanout（返事の渡し先）
+    pipeline = ServerPipeline(sock, agent_addrs, chunk_timeout=60.0, receiver=BatchReceiver(sock, timeout=0.2),
+                              chunk_sink=lambda *_: None,
+                              control_sink=lambda *reply: current[0] and current[0].on_reply(*reply))
+
+    def send(agent_id, text):
+        sock.sendto(text.encode(), agent_addrs[agent_id])
+
+    def run(fanout, name):
+        if fanout is None:
+            for _ in range(4):
+                for agent_id in list(agent_addrs):
+                    send(agent_id, name)
+            return time.time()
+        command = fanout.schedule(name, list(agent_addrs))
+        while fanout.poll():
+            time.sleep(POLL_SEC)
+        return command
+
+    def wait_uploaded(quiet_sec=5.0):
+        last, since = -1, time.time()
+        while time.time() - since < quiet_sec:
+            n = pipeline.metrics.counters["records"]
+            if n != last:
+                last, since = n, time.time()
+            time.sleep(0.1)
+
+    cases = [("before: START/STOP x4", None), ("after: START_AT via SYNC", {}),
+             ("after: START_AT via ClockSync", pipeline.clocks)]
+    out = multiprocessing.Queue()
+    finished = multiprocessing.Event()
+    emulator = multiprocessing.Process(target=_emulator_process, args=(sock.getsockname(), num_agents, len(cases),
+                                                                       jitter, loss, wake, seed, finished, out))
+    log = io.StringIO()
+    targets = []
+    marks = []  # 回ごとの (START を出した時刻, STOP を出した時刻, 終わった時刻)。切り替えはこの区間で数える
+    with contextlib.redirect_stdout(log):  # HELLO ごとの [INFO] を捨てる
+        pipeline.start()
+        emulator.start()
+        while len(agent_addrs) < num_agents:
+            time.sleep(0.05)
+        time.sleep(1.0)  # 登録直後のパラメータ受信中はコマンドを読み捨てるので待つ
+        for _, clocks in cases:
+            fanout = current[0] = CommandFanout(send, clocks) if clocks is not None else None
+            t0 = time.time()
+            start = run(fanout, "START")
+            time.sleep(record_sec)
+            t1 = time.time()
+            stop = run(fanout, "STOP")
+            targets.append((start, stop))
+            wait_uploaded()
+            marks.append((t0, t1, time.time()))
+        finished.set()
+        transitions = out.get()
+        emulator.join()
+        pipeline.stop()
+    sock.close()
+
+    print(f"[BENCH] {num_agents} emulated agents, jitter 0-{jitter * 1e3:g} ms and loss {loss:.0%} per datagram "
+          f"each way" + (f", agents wake every {wake * 1e3:g} ms to receive" if wake else ""))
+    for i, (label, _) in enumerate(cases):
+        for k, name in enumerate(("START", "STOP")):
+            lo, hi = marks[i][k], marks[i][k + 1]
+            times = np.array([t for _, n, _, t in transitions if n == name and lo <= t < hi])
+            target = targets[i][k]
+            line = f"[BENCH] {label:30s} {name:5s}: {len(times)}/{num_agents} switched"
+            if len(times):
+                line += f", actual spread {(times.max() - times.min()) * 1e3:6.2f} ms"
+            if isinstance(target, ScheduledCommand):
+                r = target.result()
+                if len(times):
+                    line += f", actual offset from T max {np.abs(times - target.target_time).max() * 1e3:5.2f} ms"
+                line += (f" | reported bound ±{r.get('bound_max_ms', float('nan')):.2f} ms, "
+                         f"retries {r['retries']}, corrections {r['corrections']}, fallback {r['fallback']}")
+            print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure START/STOP skew across emulated agents "
+                                                 "(plain commands vs scheduled START_AT/STOP_AT).")
+    parser.add_argument("--agents", type=int, default=10)
+    parser.add_argument("--jitter", type=float, default=0.005, help="max extra delay per datagram (s)")
+    parser.add_argument("--loss", type=float, default=0.05, help="drop probability per datagram, each way")
+    parser.add_argument("--wake", type=float, default=0.1, help="power-save wake interval of the agents (s, 0 = always awake)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    benchmark(args.agents, args.jitter, args.loss, args.wake, args.seed)
@@ -0,0 +1,325 @@
+import argparse
+import collections
+import heapq
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+
+# ---------------------------
+# イベントループ（UDP ソケット・キーボード・制御ソケット・タイマーをまとめて待つ）
+#   以前の main() はパケットを1つ受けるたびに check_key() の select(0.05 s) で待っていたので、
+#   受信は全エージェント合わせて約20パケット/秒で頭打ちになり、アイドル時のキー入力は
+#   SOCKET_TIMEOUT まで待たされていた。ここでは selectors で全部を同時に待ち、
+#   どれかが読めるようになった瞬間に処理する。
+#   端末が無い（ヘッドレス）ときは 127.0.0.1:CONTROL_PORT の UDP にコマンドを送って操作する:
+#     python ServerLoop.py send start|stop|calibrate|flush|quit
+# ---------------------------
+CONTROL_HOST = "127.0.0.1"
+CONTROL_PORT = 5001
+DRAIN_MAX = 256  # 1回の起床でソケットから読む最大データグラム数（キーとタイマーを待たせない）
+KEY_POLL_SEC = 0.05  # Windows のコンソールは select できないので、この間隔で msvcrt を見る
+
+# 制御ソケットのコマンド -> キー（handle_control_key / 手動フラッシュと同じ処理に流す）
+CONTROL_COMMANDS = {"start": "s", "stop": "t", "calibrate": "c", "flush": "\n", "quit": "q"}
+
+
+class ServerLoop:
+    """
+    ソケットの読み出し・キー入力・タイマーを1スレッドで処理する。
+    on_datagram(data, addr, recv_time) と on_key(key) は呼び出し側が渡す。
+    """
+
+    def __init__(self, on_key, keyboard=None, control_port=CONTROL_PORT):
+        self.selector = selectors.DefaultSelector()
+        self.on_key = on_key
+        self.running = False
+        self._timers = []  # (時刻, 通し番号, 関数, 間隔 or None)
+        self._seq = 0
+        self._calls = collections.deque()  # 別スレッドから頼まれた関数（call_soon_threadsafe）
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, self.run_pending)
+        self.control = None
+
+        if keyboard is None:
+            keyboard = sys.stdin is not None and sys.stdin.isatty()
+            if not keyboard:
+                print("[INFO] No terminal: running headless.")
+        if keyboard:
+            self._setup_keyboard()
+        if control_port:
+            self.control = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.control.bind((CONTROL_HOST, control_port))
+            self.control.setblocking(False)
+            self.selector.register(self.control, selectors.EVENT_READ, self._on_control)
+            print(f"[INFO] Control socket on {CONTROL_HOST}:{self.control.getsockname()[1]} "
+                  f"(python ServerLoop.py send start|stop|calibrate|flush|quit)")
+
+    def _setup_keyboard(self):
+        if os.name == "nt":
+            import msvcrt
+
+            def poll():
+                while msvcrt.kbhit():
+                    self.on_key(msvcrt.getwch())
+            self.call_every(KEY_POLL_SEC, poll)
+            return
+        import keyinput  # noqa: F401  端末を cbreak にする（終了時に atexit で戻る）
+        fd = sys.stdin.fileno()
+
+        def on_stdin():
+            for ch in os.read(fd, 64).decode(errors="ignore"):
+                self.on_key(ch)
+        self.selector.register(fd, selectors.EVENT_READ, on_stdin)
+
+    # ---------------------------
+    # 登録
+    # ---------------------------
+    def add_socket(self, sock, on_datagram, bufsize=1024):
+        """
+        sock が読めるようになるたびに、溜まっているデータグラムを最大 DRAIN_MAX 個まで on_datagram に渡す。
+        """
+        sock.setblocking(False)
+
+        def drain():
+            for _ in range(DRAIN_MAX):
+                try:
+                    data, addr = sock.recvfrom(bufsize)
+                except (BlockingIOError, InterruptedError):
+                    return
+                except ConnectionResetError:
+                    continue  # Windows: 前に送ったACKの ICMP port unreachable
+                on_datagram(data, addr, time.time())
+        self.selector.register(sock, selectors.EVENT_READ, drain)
+
+    def add_reader(self, fileobj, callback):
+        """
+        fileobj（ソケットや multiprocessing の Connection など fileno を持つもの）が読めるようになったら callback() を呼ぶ。
+        """
+        self.selector.register(fileobj, selectors.EVENT_READ, callback)
+
+    def call_later(self, delay, fn):
+        self._push(time.monotonic() + delay, fn, None)
+
+    def call_every(self, interval, fn):
+        self._push(time.monotonic() + interval, fn, interval)
+
+    def call_soon_threadsafe(self, fn):
+        """
+        別スレッド（書き出しスレッドなど）から、fn をループのスレッドで呼ぶよう頼む。
+        ループを止めたあとに頼まれた分は run_pending() で呼ぶ。
+        """
+        self._calls.append(fn)
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
+            pass  # 閉じた後か、起こす合図がもう溜まっている
+
+    def run_pending(self):
+        """
+        call_soon_threadsafe で頼まれた関数を今呼ぶ。ループの中では自動で呼ばれ、
+        終了処理ではループを止めたあと、書き出しスレッドを閉じてから残りを呼ぶのに使う。
+        """
+        try:
+            while self._wake_r.recv(256):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self._calls:
+            self._calls.popleft()()
+
+    def _push(self, when, fn, interval):
+        self._seq += 1
+        heapq.heappush(self._timers, (when, self._seq, fn, interval))
+
+    # ---------------------------
+    # 実行
+    # ---------------------------
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        self.running = True
+        timers = self._timers
+        while self.running:
+            timeout = max(timers[0][0] - time.monotonic(), 0.0) if timers else None
+            for key, _ in self.selector.select(timeout):
+                key.data()
+                if not self.running:
+                    return
+            now = time.monotonic()
+            while timers and timers[0][0] <= now:
+                when, _, fn, interval = heapq.heappop(timers)
+                if interval is not None:
+                    self._push(max(when + interval, now), fn, interval)
+                fn()
+
+    def close(self):
+        if self.control is not None:
+            self.control.close()
+        self.selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def _on_control(self):
+        while True:
+            try:
+                data, addr = self.control.recvfrom(256)
+            except (BlockingIOError, InterruptedError, ConnectionResetError):
+                return
+            command = data.decode(errors="ignore").strip().lower()
+            key = CONTROL_COMMANDS.get(command)
+            if key is None:
+                self.control.sendto(f"ERROR unknown command {command!r} ({'/'.join(CONTROL_COMMANDS)})".encode(),
+                                    addr)
+                continue
+            print(f"[INFO] Control command: {command}")
+            self.control.sendto(b"OK " + command.encode(), addr)
+            self.on_key(key)
+
+
+def send_command(command, port=CONTROL_PORT, timeout=2.0):
+    """
+    動いているサーバーの制御ソケットにコマンドを送り、返事を返す（返事が無ければ None）。
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.settimeout(timeout)
+        s.sendto(command.encode(), (CONTROL_HOST, port))
+        try:
+            return s.recv(256).decode(errors="ignore")
+        except socket.timeout:
+            return None
+
+
+# ---------------------------
+# ベンチマーク（ループバックでの受信パケット/秒、以前のループとの比較）
+# ---------------------------
+def _handler(sock, buffers):
+    from PacketDecoder import AgentChunkBuffer, build_ack, decode_records, last_micros24, parse_header
+
+    def on_datagram(data, addr, recv_time):
+        agent_id, send_micros = parse_header(data)
+        buf = buffers.get(agent_id)
+        if buf is None:
+            buf = buffers[agent_id] = AgentChunkBuffer()
+        buf.append_records(decode_records(data), send_micros, recv_time)
+        if len(buf) > 1000000:
+            buf.reset()
+        sock.sendto(build_ack(agent_id, last_micros24(data)), addr)
+        buffers["packets"] = buffers.get("packets", 0) + 1
+    return on_datagram
+
+
+def _agents(target, num_agents, seconds, result, first_agent=1):
+    """
+    ファームウェアと同じ停止-待機式（1パケット送って ACK を待つ）のエージェントを num_agents 個動かす。
+    """
+    from LoadGenerator import agent_packets
+
+    socks, packets, index, sent_at = [], [], [], []
+    sel = selectors.DefaultSelector()
+    for i in range(num_agents):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setblocking(False)
+        sel.register(s, selectors.EVENT_READ, i)
+        socks.append(s)
+        packets.append(agent_packets(first_agent + i, 28000))
+        index.append(0)
+        sent_at.append(0.0)
+    latencies = []
+
+    def send(i):
+        s_packet, _ = packets[i][index[i] % len(packets[i])]
+        socks[i].sendto(s_packet, target)
+        sent_at[i] = time.perf_counter()
+
+    end = time.perf_counter() + seconds
+    for i in range(num_agents):
+        send(i)
+    while time.perf_counter() < end:
+        for key, _ in sel.select(0.1):
+            i = key.data
+            try:
+                socks[i].recv(16)
+            except BlockingIOError:
+                continue
+            latencies.append(time.perf_counter() - sent_at[i])
+            index[i] += 1
+            send(i)
+        now = time.perf_counter()
+        for i in range(num_agents):
+            if now - sent_at[i] > 1.0:  # waitForAck のタイムアウト
+                send(i)
+    for s in socks:
+        s.close()
+    latencies.sort()
+    result["acked"] = len(latencies)
+    result["p50_ms"] = latencies[len(latencies) // 2] * 1e3 if latencies else float("nan")
+
+
+def _run_case(name, serve, num_agents, seconds):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    buffers = {}
+    on_datagram = _handler(sock, buffers)
+    stop = threading.Event()
+    server = threading.Thread(target=serve, args=(sock, on_datagram, stop), daemon=True)
+    server.start()
+    result = {}
+    _agents(sock.getsockname(), num_agents, seconds, result)
+    stop.set()
+    server.join()
+    sock.close()
+    print(f"[BENCH] {name:34s} {buffers.get('packets', 0) / seconds:8.0f} packets/s  "
+          f"ACK p50 {result['p50_ms']:.2f} ms  ({num_agents} stop-and-wait agents, {seconds:g} s)")
+
+
+def _serve_legacy(sock, on_datagram, stop):
+    # 以前の main(): recvfrom のあとで毎回 check_key() の select(stdin, 0.05 s)
+    import select
+    r, w = os.pipe()  # 何も書かれない「端末」
+    sock.settimeout(1.0)
+    while not stop.is_set():
+        try:
+            data, addr = sock.recvfrom(1024)
+            on_datagram(data, addr, time.time())
+        except socket.timeout:
+            pass
+        select.select([r], [], [], 0.05)
+    os.close(r)
+    os.close(w)
+
+
+def _serve_loop(sock, on_datagram, stop):
+    loop = ServerLoop(lambda key: None, keyboard=False, control_port=None)
+    loop.add_socket(sock, on_datagram)
+    loop.call_every(0.1, lambda: stop.is_set() and loop.stop())
+    loop.run()
+    loop.close()
+
+
+def benchmark(num_agents=10, seconds=3.0):
+    _run_case("before: recvfrom + select(stdin, 50ms)", _serve_legacy, num_agents, seconds)
+    _run_case("after: ServerLoop (selectors)", _serve_loop, num_agents, seconds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Control a running server, or benchmark the event loop.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("send", help="send a command to a running server")
+    p.add_argument("name", choices=sorted(CONTROL_COMMANDS))
+    p.add_argument("--port", type=int, default=CONTROL_PORT)
+    p = sub.add_parser("bench")
+    p.add_argument("--agents", type=int, default=10)
+    p.add_argument("--seconds", type=float, default=3.0)
+    args = parser.parse_args()
+
+    if args.command == "send":
+        reply = send_command(args.name, args.port)
+        print(reply if reply is not None else f"[ERROR] No reply from {CONTROL_HOST}:{args.port}")
+    else:
+        benchmark(args.agents, args.seconds)
@@ -0,0 +1,337 @@
+import argparse
+import bisect
+import json
+import os
+import threading
+import time
+
+# ---------------------------
+# 受信サーバーの計測
+#   カウンタ（全体とエージェント別）とバケット式ヒストグラムを持ち、
+#   一定間隔で1行の状態表示と、機械可読な出力（JSON lines / Prometheus テキスト）を書く。
+#   記録は int の加算とバケット探索だけなので、パケットごとに呼んでも print よりずっと軽い。
+# ---------------------------
+LATENCY_BUCKETS = (25e-6, 50e-6, 100e-6, 250e-6, 500e-6, 1e-3, 2.5e-3, 5e-3, 10e-3, 25e-3, 50e-3,
+                   100e-3, 250e-3, 500e-3, 1.0, 2.5, 5.0)  # [s]
+HISTOGRAMS = {
+    "ack_turnaround": "受信から ACK 送信まで",
+    "queue_wait": "受信からデコード開始まで（パイプライン）",
+    "decode": "1パケットのデコードと列バッファへの追記",
+    "chunk_flush": "1チャンクの保存",
+    "flush_latency": "チャンクを締めてから保存し終わるまで（書き出し待ちを含む）",
+    "retransmit_gap": "最初の受信から同じパケットの再送を受けるまで（ACK 待ち時間の調整用）",
+}
+COUNTERS = ("packets", "records", "bytes_in", "acks", "malformed", "dropped_full", "duplicates",
+            "idle_seals", "chunks_written", "bytes_written")
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARN": 30, "ERROR": 40}
+TOP_AGENTS = 4  # 状態表示に出すエージェント数
+
+
+class Histogram:
+    """
+    固定バケットのヒストグラム。分位点はバケットの上端で近似する。
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最後は +Inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        with self._lock:
+            mean = self.total / self.count if self.count else 0.0
+            return {"count": self.count, "mean_ms": mean * 1e3, "p50_ms": self.quantile(0.5) * 1e3,
+                    "p99_ms": self.quantile(0.99) * 1e3, "max_ms": self.max * 1e3}
+
+
+class ServerMetrics:
+    """
+    サーバー全体の計測値。受信・デコード・保存の各スレッドから呼んでよい。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.agents = {}  # agent_id -> [packets, records, duplicates]
+        self.histograms = {name: Histogram() for name in HISTOGRAMS}
+        self.gauges = {}  # 名前 -> 値を返す関数（キュー長など）
+        self.maxima = {}  # 名前 -> これまでの最大値
+        self.started = time.time()
+        self._last = (self.started, dict(self.counters), {})
+
+    # ---------------------------
+    # 記録
+    # ---------------------------
+    def inc(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def packet(self, agent_id, n_bytes, n_records=0):
+        """
+        受信した1パケットを数える。n_records を渡せばレコード数も同時に数える（シングルスレッドのサーバー用）。
+        """
+        with self._lock:
+            counters = self.counters
+            counters["packets"] += 1
+            counters["bytes_in"] += n_bytes
+            counters["records"] += n_records
+            entry = self.agents.get(agent_id)
+            if entry is None:
+                entry = self.agents[agent_id] = [0, 0, 0]
+            entry[0] += 1
+            entry[1] += n_records
+
+    def records(self, agent_id, n):
+        with self._lock:
+            self.counters["records"] += n
+            entry = self.agents.get(agent_id)
+            if entry is None:
+                entry = self.agents[agent_id] = [0, 0, 0]
+            entry[1] += n
+
+    def duplicate(self, agent_id, gap):
+        """
+        抑止した再送を数える。gap は同じパケットを最初に受けてからの秒数。
+        """
+        with self._lock:
+            self.counters["duplicates"] += 1
+            entry = self.agents.get(agent_id)
+            if entry is None:
+                entry = self.agents[agent_id] = [0, 0, 0]
+            entry[2] += 1
+        self.histograms["retransmit_gap"].add(gap)
+
+    def observe(self, name, seconds):
+        self.histograms[name].add(seconds)
+
+    def track_max(self, name, value):
+        if value > self.maxima.get(name, 0):
+            self.maxima[name] = value
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    # ---------------------------
+    # 出力
+    # ---------------------------
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            counters = dict(self.counters)
+            agents = {a: list(v) for a, v in self.agents.items()}
+        gauges = {}
+        for name, fn in self.gauges.items():
+            try:
+                gauges[name] = fn()
+            except Exception:
+                gauges[name] = None
+        return {
+            "time": now,
+            "uptime_sec": now - self.started,
+            "counters": counters,
+            "agents": {str(a): {"packets": v[0], "records": v[1], "duplicates": v[2]}
+                       for a, v in sorted(agents.items())},
+            "histograms": {name: h.snapshot() for name, h in self.histograms.items()},
+            "gauges": gauges,
+            "maxima": dict(self.maxima),
+        }
+
+    def status_line(self, snap=None):
+        """
+        前回呼ばれてからの速度と、主要な遅延・キュー長を1行にまとめる。
+        """
+        snap = snap or self.snapshot()
+        now, counters = snap["time"], snap["counters"]
+        last_time, last_counters, last_agents = self._last
+        dt = max(now - last_time, 1e-9)
+        agent_records = {a: v["records"] for a, v in snap["agents"].items()}
+        self._last = (now, counters, agent_records)
+
+        def rate(name):
+            return (counters[name] - last_counters.get(name, 0)) / dt
+
+        h = snap["histograms"]
+        top = sorted(((n - last_agents.get(a, 0)) / dt, a) for a, n in agent_records.items())[::-1][:TOP_AGENTS]
+        agents = " ".join(f"{a}:{r:.0f}" for r, a in top if r > 0) or "-"
+        gauges = " ".join(f"{k}={v}" for k, v in snap["gauges"].items())
+        retx = ""
+        if h["retransmit_gap"]["count"]:
+            retx = f"retx gap p50/max={h['retransmit_gap']['p50_ms']:.0f}/{h['retransmit_gap']['max_ms']:.0f}ms "
+        return (f"[METRICS] {rate('packets'):.0f} pkt/s {rate('records'):.0f} rec/s "
+                f"{rate('bytes_in') / 1e3:.1f} kB/s in | tot pkts={counters['packets']} recs={counters['records']} "
+                f"bad={counters['malformed']} drop={counters['dropped_full']} dup={counters['duplicates']} "
+                f"chunks={counters['chunks_written']} written={counters['bytes_written'] / 1e6:.1f}MB | "
+                f"ack p50/p99={h['ack_turnaround']['p50_ms']:.2f}/{h['ack_turnaround']['p99_ms']:.2f}ms "
+                f"decode p99={h['decode']['p99_ms']:.2f}ms flush mean={h['chunk_flush']['mean_ms']:.0f}ms "
+                f"lat p99={h['flush_latency']['p99_ms']:.0f}ms {retx}| "
+                f"{gauges} | rec/s by agent {agents}")
+
+    def write_json_line(self, path, snap=None):
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(snap or self.snapshot()) + "\n")
+
+    def write_prometheus(self, path, snap=None):
+        """
+        Prometheus のテキスト形式（node_exporter の textfile collector 用）で書く。書き込みは置き換えで行う。
+        """
+        snap = snap or self.snapshot()
+        lines = []
+        for name, value in snap["counters"].items():
+            lines.append(f"# TYPE volvocine_{name}_total counter")
+            lines.append(f"volvocine_{name}_total {value}")
+        for key in ("packets", "records", "duplicates"):
+            lines.append(f"# TYPE volvocine_agent_{key}_total counter")
+            for agent, v in snap["agents"].items():
+                lines.append(f'volvocine_agent_{key}_total{{agent="{agent}"}} {v[key]}')
+        for name, value in snap["gauges"].items():
+            if value is not None:
+                lines.append(f"# TYPE volvocine_{name} gauge")
+                lines.append(f"volvocine_{name} {value}")
+        for name, h in self.histograms.items():
+            lines.append(f"# HELP volvocine_{name}_seconds {HISTOGRAMS[name]}")
+            lines.append(f"# TYPE volvocine_{name}_seconds histogram")
+            with h._lock:
+                counts, count, total = list(h.counts), h.count, h.total
+            cumulative = 0
+            for bound, n in zip(h.buckets, counts):
+                cumulative += n
+                lines.append(f'volvocine_{name}_seconds_bucket{{le="{bound:g}"}} {cumulative}')
+            lines.append(f'volvocine_{name}_seconds_bucket{{le="+Inf"}} {count}')
+            lines.append(f"volvocine_{name}_seconds_sum {total}")
+            lines.append(f"volvocine_{name}_seconds_count {count}")
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, path)
+
+
+def record_saved_file(metrics, path):
+    metrics.inc("chunks_written")
+    try:
+        metrics.inc("bytes_written", os.path.getsize(path))
+    except OSError:
+        pass
+
+
+class MetricsReporter:
+    """
+    report() のたびに状態行を表示し、指定があれば JSON lines と Prometheus ファイルに書く
+    （サーバーはイベントループのタイマーで STATUS_INTERVAL ごとに呼ぶ）。
+    """
+
+    def __init__(self, metrics, json_path=None, prom_path=None):
+        self.metrics = metrics
+        self.json_path = json_path
+        self.prom_path = prom_path
+
+    def report(self):
+        snap = self.metrics.snapshot()
+        print(self.metrics.status_line(snap))
+        try:
+            if self.json_path:
+                self.metrics.write_json_line(self.json_path, snap)
+            if self.prom_path:
+                self.metrics.write_prometheus(self.prom_path, snap)
+        except OSError as e:
+            print(f"[WARN] Could not write metrics: {e}")
+
+
+class SampledLog:
+    """
+    レベルで絞り、さらに every 件に1件だけ出すログ。msg は文字列を返す関数で、出さないときは呼ばない。
+    """
+
+    def __init__(self, level="INFO", every=1):
+        self.level = LOG_LEVELS[level]
+        self.every = max(1, every)
+        self.seen = 0
+        self.suppressed = 0
+
+    def log(self, level, msg):
+        if LOG_LEVELS[level] < self.level:
+            return
+        self.seen += 1
+        if (self.seen - 1) % self.every == 0:
+            print(f"[{level}] {msg()}")
+        else:
+            self.suppressed += 1
+
+    def debug(self, msg):
+        self.log("DEBUG", msg)
+
+
+# ---------------------------
+# ベンチマーク（1パケットあたりのコスト）
+# ---------------------------
+def _terminal():
+    """
+    端末相当の出力先（行バッファの pty を別スレッドで読み捨てる）。pty が無ければ /dev/null。
+    """
+    try:
+        master, slave = os.openpty()
+    except (AttributeError, OSError):
+        return open(os.devnull, "w")
+
+    def drain():
+        while True:
+            try:
+                if not os.read(master, 65536):
+                    break
+            except OSError:
+                break
+
+    threading.Thread(target=drain, daemon=True).start()
+    return os.fdopen(slave, "w", buffering=1)
+
+
+def benchmark(n=100000):
+    out = _terminal()
+    t0 = time.perf_counter()
+    for i in range(n):
+        print(f"[DEBUG] Agent={i & 7}, send_micros={i * 977}, recv_time={1.7e9 + i:.6f}, offset_sec={0.5:.6f}",
+              file=out)
+    t_print = time.perf_counter() - t0
+    out.close()
+
+    metrics = ServerMetrics()
+    log = SampledLog("INFO")
+    t0 = time.perf_counter()
+    for i in range(n):
+        metrics.packet(i & 7, 509, 84)
+        metrics.observe("decode", 3e-5)
+        metrics.observe("ack_turnaround", 1e-4)
+        log.debug(lambda: f"Agent={i & 7}")
+    t_metrics = time.perf_counter() - t0
+    print(f"[BENCH] per packet: [DEBUG] print to a terminal {t_print / n * 1e6:.2f} us, "
+          f"metrics (counters + 2 histograms + gated log) {t_metrics / n * 1e6:.2f} us")
+    print(metrics.status_line())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the per-packet cost of the server metrics.")
+    parser.add_argument("--packets", type=int, default=100000)
+    args = parser.parse_args()
+    benchmark(args.packets)
@@ -0,0 +1,298 @@
+import queue
+import socket
+import threading
+import time
+
+from ServerResponse import handle_handshake, handle_parameter_request
+from ClockSync import BootSequence, ClockSyncEstimator
+from PacketDecoder import HEADER_SIZE, RECORD_SIZE, AgentChunkBuffer, parse_header, decode_records, last_micros24, build_ack
+from RetransmitFilter import RetransmitFilter
+from ChunkScheduler import FLUSH_TICK_SEC, MAX_BACKLOG, WRITER_THREADS, ChunkWriterPool, FlushScheduler
+from ServerMetrics import ServerMetrics
+from ScheduledControl import REPLY_PREFIXES
+
+# ---------------------------
+# パイプライン型サーバー
+#   受信/ACKスレッド -> (エージェント別に振り分けた有界キュー) -> デコードスレッド
+#   -> 保存スレッドプール (ChunkWriterPool)
+#   受信/ACKスレッドは FLUSH_TICK_SEC ごとにデコードスレッドへ _TICK を送り、
+#   黙ったエージェントのチャンクは次のパケットを待たずに CHUNK_TIMEOUT で締める。
+# 受信スレッドはヘッダだけ見てすぐACKを返すので、デコードやCSV書き出しが
+# 詰まっても Pico の waitForAck (1000 ms) を待たせない。
+# ---------------------------
+DECODE_QUEUE_SIZE = 4096
+NUM_DECODE_WORKERS = 2
+
+_FLUSH = object()
+_STOP = object()
+_TICK = object()
+_RESET = object()  # (_RESET, agent_id): Pico の再起動。前のチャンクを締めて時計同期をやり直す
+
+
+def _save_chunk(agent_id, columns, send_list, recv_list, clock=None, chunk_time=None):
+    from ChunkProcessor import build_dataframe_for_chunk  # pandas は最初のチャンクを保存するときに書き出しスレッドで読み込む
+    _, saved_file = build_dataframe_for_chunk(agent_id, columns, send_list, recv_list, clock=clock,
+                                              chunk_time=chunk_time)
+    return saved_file
+
+
+def _offer(q, item):
+    try:
+        q.put_nowait(item)
+    except queue.Full:
+        return False
+    return True
+
+
+class ServerPipeline:
+    """
+    受信/ACK・デコード・保存を別スレッドで動かすサーバー本体。
+    同じエージェントのパケットは常に同じデコードスレッドに入るので、チャンク内の順序は保たれる。
+    """
+
+    def __init__(self, sock, agent_addrs, chunk_timeout, num_workers=NUM_DECODE_WORKERS,
+                 decode_queue_size=DECODE_QUEUE_SIZE, max_backlog=MAX_BACKLOG, receiver=None,
+                 chunk_sink=None, record_sink=None, metrics=None, journal=None, control_sink=None):
+        self.sock = sock
+        self.receiver = receiver  # BatchReceiver を渡すと recvmmsg でまとめて受信する
+        # chunk_sink(agent_id, columns, send_list, recv_list, clock, chunk_time) -> 保存ファイルパス or None
+        self.chunk_sink = chunk_sink or _save_chunk
+        # record_sink(agent_id, send_micros, recv_time, records): デコード直後に呼ぶ（ライブモニタ用、ブロックしないこと）
+        self.record_sink = record_sink
+        # control_sink(data, addr, recv_time): 予約コマンドへの返事（SYNC: / ACK:）を渡す先（ScheduledControl.CommandFanout）
+        self.control_sink = control_sink
+        self.agent_addrs = agent_addrs
+        self.chunk_timeout = chunk_timeout
+        self.metrics = metrics or ServerMetrics()
+        self.retransmits = RetransmitFilter()  # 受信/ACKスレッドだけが触る
+        self.boots = BootSequence()  # 受信/ACKスレッドだけが触る
+        self.clocks = {}  # agent_id -> ClockSyncEstimator（そのエージェントのデコードスレッドだけが更新する）
+        self.journal = journal  # SessionJournal.Journal: 受け付けたパケットを ACK の前に追記する
+        self._running = False
+
+        self.decode_queues = [queue.Queue(maxsize=decode_queue_size) for _ in range(num_workers)]
+        self.writer = ChunkWriterPool(self.chunk_sink, self.metrics, WRITER_THREADS, max_backlog)
+
+        self._threads = [threading.Thread(target=self._recv_loop, name="rx-ack", daemon=True)]
+        for i, q in enumerate(self.decode_queues):
+            self._threads.append(threading.Thread(target=self._decode_loop, args=(q,), name=f"decode-{i}", daemon=True))
+        self.metrics.gauge("decode_queue", lambda: sum(q.qsize() for q in self.decode_queues))
+
+    # ---------------------------
+    # 外部API
+    # ---------------------------
+    def start(self):
+        self._running = True
+        for t in self._threads:
+            t.start()
+
+    def stop(self):
+        """
+        受信を止め、残りのバッファをすべて保存してからスレッドを終了する。
+        """
+        self._running = False
+        self._threads[0].join()
+        for q in self.decode_queues:
+            q.put(_STOP)
+        for t in self._threads[1:]:
+            t.join()
+        self.writer.close()
+
+    def flush_all(self):
+        """
+        全エージェントのチャンクを締めて保存し、保存済みファイルの一覧を返す（呼び出し後は空になる）。
+        """
+        self._request_flush()
+        return self._wait_flushed()
+
+    def end_session(self):
+        """
+        手動フラッシュ（セッションの区切り）。ジャーナルを次のファイルに移すのと同じロックの中でフラッシュを積み、
+        (保存済みファイル, 閉じたジャーナルのパス) を返す。閉じたジャーナルのパケットはちょうどこのチャンクたちに入る。
+        """
+        if self.journal is None:
+            return self.flush_all(), None
+        session_journal = self.journal.rotate(self._request_flush)
+        return self._wait_flushed(), session_journal
+
+    def _request_flush(self):
+        for q in self.decode_queues:
+            q.put(_FLUSH)
+
+    def _wait_flushed(self):
+        for q in self.decode_queues:
+            q.join()
+        self.writer.wait()
+        return self.take_saved_files()
+
+    def take_saved_files(self):
+        return self.writer.take_saved_files()
+
+    def take_failed(self):
+        """
+        前回から保存に失敗したチャンクの数（その間のジャーナルは消さずに残すこと）。
+        """
+        return self.writer.take_failed()
+
+    def status_line(self):
+        line = self.metrics.status_line()
+        if self.receiver is not None:
+            line += "\n" + self.receiver.drop_summary()
+        return line
+
+    # ---------------------------
+    # 受信/ACKスレッド
+    # ---------------------------
+    def _recv_loop(self):
+        sock = self.sock
+        receiver = self.receiver
+        next_tick = time.time() + FLUSH_TICK_SEC
+        while self._running:
+            # 受信の合間（アイドル時は受信タイムアウトごと）にデコードスレッドへ締め切りの確認を頼む
+            now = time.time()
+            if now >= next_tick:
+                self._tick()
+                next_tick = now + FLUSH_TICK_SEC
+
+            if receiver is not None:
+                try:
+                    batch = receiver.recv_batch()
+                except OSError:
+                    break
+                recv_time = time.time()
+                for data, addr in batch:
+                    self._handle_datagram(data, addr, recv_time)
+                continue
+
+            try:
+                data, addr = sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self._handle_datagram(data, addr, time.time())
+
+    def _tick(self):
+        for q in self.decode_queues:
+            try:
+                q.put_nowait(_TICK)
+            except queue.Full:
+                pass  # 詰まっているならパケットが流れているので、締め切りは touch の側で判定される
+
+    def _handle_datagram(self, data, addr, recv_time):
+        sock = self.sock
+        metrics = self.metrics
+        if data.startswith(b"REQUEST_PARAMS"):
+            agent_id = handle_parameter_request(sock, data, addr)
+            if agent_id is not None:
+                self.agent_addrs[agent_id] = addr
+                if self.boots.params_request(addr):
+                    try:
+                        self.decode_queues[agent_id % len(self.decode_queues)].put_nowait((_RESET, agent_id))
+                    except queue.Full:
+                        pass  # 時計の推定器が offset の跳びで再起動に気づく
+            return
+        if data.startswith(b"HELLO"):
+            handle_handshake(sock, data, addr)
+            self.boots.hello(addr)
+            return
+        if self.control_sink is not None and data.startswith(REPLY_PREFIXES):
+            self.control_sink(data, addr, recv_time)
+            return
+        if len(data) < HEADER_SIZE + RECORD_SIZE or data[0] == 0 or (len(data) - HEADER_SIZE) % RECORD_SIZE:
+            metrics.inc("malformed")
+            return
+
+        agent_id = data[0]
+        self.boots.log_packet(addr)
+        gap = self.retransmits.check(data, recv_time)
+        if gap is not None:
+            # 前の ACK が届かなかった再送。デコードせずに ACK だけ返し直す
+            metrics.duplicate(agent_id, gap)
+            sock.sendto(build_ack(agent_id, last_micros24(data)), addr)
+            metrics.inc("acks")
+            return
+
+        metrics.packet(agent_id, len(data))
+        q = self.decode_queues[agent_id % len(self.decode_queues)]
+        item = (data, addr, recv_time)
+        if self.journal is not None:
+            # キューに積むのと追記をジャーナルのロックの中でまとめて行い、rotate() の区切りとずれないようにする
+            accepted = self.journal.append(data, recv_time, lambda: _offer(q, item))
+        else:
+            accepted = _offer(q, item)
+        if not accepted:
+            # ACKを返さなければ Pico 側が再送するので、ここでは捨てるだけでよい
+            metrics.inc("dropped_full")
+            return
+        metrics.track_max("decode_queue", q.qsize())
+        self.retransmits.add(data, recv_time)
+
+        sock.sendto(build_ack(agent_id, last_micros24(data)), addr)
+        metrics.inc("acks")
+        metrics.observe("ack_turnaround", time.time() - recv_time)
+
+    # ---------------------------
+    # デコードスレッド
+    # ---------------------------
+    def _decode_loop(self, q):
+        buffers = {}
+        clocks = self.clocks
+        scheduler = FlushScheduler(self.chunk_timeout)
+        metrics = self.metrics
+        while True:
+            item = q.get()
+            try:
+                if item is _TICK:
+                    for agent_id in scheduler.due(time.time()):
+                        if len(buffers[agent_id]):
+                            print(f"[INFO] Agent {agent_id} idle for {self.chunk_timeout:g} s: sealing chunk.")
+                            metrics.inc("idle_seals")
+                        self._seal(agent_id, buffers[agent_id], clocks[agent_id])
+                    continue
+                if item is _STOP:
+                    self._seal_all(buffers, clocks)
+                    return
+                if item is _FLUSH:
+                    self._seal_all(buffers, clocks)
+                    continue
+                if item[0] is _RESET:
+                    agent_id = item[1]
+                    if agent_id in buffers:
+                        self._seal(agent_id, buffers[agent_id], clocks[agent_id])
+                        clocks[agent_id] = ClockSyncEstimator()
+                        print(f"[INFO] Agent {agent_id} rebooted: restarting clock sync.")
+                    continue
+
+                data, addr, recv_time = item
+                t0 = time.time()
+                metrics.observe("queue_wait", t0 - recv_time)
+                agent_id, send_micros = parse_header(data)
+                records = decode_records(data)
+
+                buf = buffers.get(agent_id)
+                if buf is None:
+                    buf = buffers[agent_id] = AgentChunkBuffer()
+                    clocks[agent_id] = ClockSyncEstimator()
+                if scheduler.touch(agent_id, recv_time):
+                    print(f"[INFO] Agent {agent_id} chunk timeout.")
+                    self._seal(agent_id, buf, clocks[agent_id])
+
+                clocks[agent_id].update(send_micros, recv_time)
+                buf.append_records(records, send_micros, recv_time)
+                if self.record_sink is not None:
+                    self.record_sink(agent_id, send_micros, recv_time, records)
+                metrics.records(agent_id, len(records))
+                metrics.observe("decode", time.time() - t0)
+            finally:
+                q.task_done()
+
+    def _seal(self, agent_id, buf, clock):
+        if len(buf):
+            # 書き出し待ちが MAX_BACKLOG を超えた場合だけデコード側が待つ（受信/ACKは止まらない）
+            self.writer.submit(agent_id, buf.columns(), buf.send_micros, buf.recv_times, clock.snapshot())
+        buf.reset()
+
+    def _seal_all(self, buffers, clocks):
+        for agent_id, buf in buffers.items():
+            self._seal(agent_id, buf, clocks[agent_id])
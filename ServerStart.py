@@ -0,0 +1,224 @@
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+from BatchReceiver import SOCKET_RCVBUF, configure_socket
+from ServerResponse import handle_handshake, handle_parameter_request
+
+# ---------------------------
+# すぐに受け付けを始めるサーバーの入口
+#   python ServerStart.py [--pipeline | --shards N] [--headless]
+#   最初に UDP ポートへ bind し、ServerTest（numpy・受信パイプラインなど）を読み込んでいる間は
+#   EarlyResponder のスレッドが HELLO / REQUEST_PARAMS にだけ答える。読み込みが終わったら
+#   ソケットとその間に登録したエージェントを ServerTest に引き継ぐ。
+#   その間に届いたログパケットは ACK を返さずに捨てる（Pico は ACK が来なければ同じパケットを送り直す）。
+#   pandas はチャンクを保存するとき、matplotlib はプロット（別プロセス）やライブモニタを使うときに初めて読み込む。
+#   --headless では端末を触らず、操作は制御ソケットで行う（python ServerLoop.py send start|stop|flush|quit）。
+# ---------------------------
+UDP_PORT = 5000  # ServerTest.UDP_PORT と同じ
+RESPONDER_POLL_SEC = 0.05  # EarlyResponder が停止要求を確認する間隔
+
+
+class EarlyResponder:
+    """
+    サーバー本体が読み込まれるまで、受信ソケットで HELLO / REQUEST_PARAMS に答えるスレッド。
+    """
+
+    def __init__(self, sock, poll_sec=RESPONDER_POLL_SEC):
+        self.sock = sock
+        self.agent_addrs = {}  # 読み込み中にパラメータを要求したエージェント
+        self.answered = 0
+        self.dropped = 0
+        self.started = time.time()
+        self._stop = threading.Event()
+        sock.settimeout(poll_sec)
+        self._thread = threading.Thread(target=self._run, name="early-responder", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        sock = self.sock
+        while not self._stop.is_set():
+            try:
+                data, addr = sock.recvfrom(1024)
+            except (socket.timeout, ConnectionResetError):
+                continue
+            if data.startswith(b"REQUEST_PARAMS"):
+                agent_id = handle_parameter_request(sock, data, addr)
+                if agent_id is not None:
+                    self.agent_addrs[agent_id] = addr
+                self.answered += 1
+            elif data.startswith(b"HELLO"):
+                handle_handshake(sock, data, addr)
+                self.answered += 1
+            else:
+                self.dropped += 1
+
+    def _join(self):
+        self._stop.set()
+        self._thread.join()
+        print(f"[INFO] Early responder: answered {self.answered} requests, dropped {self.dropped} packets "
+              f"in {time.time() - self.started:.2f} s.")
+
+    def handover(self, agent_addrs):
+        """
+        スレッドを止めてソケットを返す。読み込み中に登録したエージェントは agent_addrs に足す。
+        """
+        self._join()
+        agent_addrs.update(self.agent_addrs)
+        self.sock.settimeout(None)
+        return self.sock
+
+    def close(self):
+        """
+        スレッドを止めてソケットを閉じる（シャードモードでワーカーが受け付けを始めたとき）。
+        """
+        self._join()
+        self.sock.close()
+
+
+def bind_early(port=UDP_PORT, reuseport=False):
+    if reuseport:
+        from ShardedServer import _bind_shard_socket  # シャードのワーカーと同じ SO_REUSEPORT のグループに入る
+        return _bind_shard_socket(port)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    configure_socket(sock, SOCKET_RCVBUF)
+    sock.bind(("0.0.0.0", port))
+    return sock
+
+
+def start_server(port=UDP_PORT, pipeline=False, shards=None, headless=False, control_port=None):
+    """
+    bind して EarlyResponder を動かしてから ServerTest を読み込み、設定を上書きして run() に渡す。
+    shards / control_port が None のときは ServerTest の設定のまま。
+    """
+    t0 = time.perf_counter()
+    reuseport = shards is not None and shards > 1
+    responder = EarlyResponder(bind_early(port, reuseport)).start()
+    print(f"[INFO] UDP:{port} bound in {(time.perf_counter() - t0) * 1e3:.1f} ms; "
+          f"answering HELLO/REQUEST_PARAMS while the server loads.")
+    try:
+        import ServerTest
+    except BaseException:
+        responder.close()
+        raise
+    print(f"[INFO] Server modules loaded in {(time.perf_counter() - t0) * 1e3:.0f} ms.")
+
+    ServerTest.UDP_PORT = port
+    if pipeline:
+        ServerTest.PIPELINE_MODE = True
+    if shards is not None:
+        ServerTest.SHARDS = shards
+    if headless:
+        ServerTest.KEYBOARD = False
+    if control_port is not None:
+        ServerTest.CONTROL_PORT = control_port
+    if ServerTest.SHARDS > 1 and not reuseport:
+        # SHARDS を ServerTest.py で設定した場合: このソケットがあるとワーカーが bind できない
+        print("[WARN] SHARDS is set in ServerTest.py; pass --shards to keep answering while the workers start.")
+        responder.close()
+        responder = None
+    ServerTest.run(responder)
+
+
+# ---------------------------
+# ベンチマーク（モジュールの読み込み時間と、起動してから HELLO に READY が返るまでの時間）
+# ---------------------------
+IMPORT_TARGETS = ("Plotter", "ChunkProcessor", "LiveMonitor", "ServerTest", "ServerStart")
+
+
+def _import_time(module, env):
+    import subprocess
+
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    out = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def _time_to_ready(cmd, port, control_port, env, cwd, timeout=60.0):
+    """
+    cmd を起動し、(HELLO に READY が返るまで, 制御ソケットが答えるまで) の秒数を返す。最後に quit で止める。
+    """
+    import subprocess
+    from ServerLoop import send_command
+
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.settimeout(0.002)
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(cmd, env=env, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    ready = loaded = None
+    try:
+        while ready is None and time.perf_counter() - t0 < timeout:
+            probe.sendto(b"HELLO", ("127.0.0.1", port))
+            try:
+                if probe.recv(64) == b"READY":
+                    ready = time.perf_counter() - t0
+            except OSError:
+                pass  # まだ bind されていない（ICMP port unreachable）かタイムアウト
+        while loaded is None and time.perf_counter() - t0 < timeout:
+            if send_command("quit", control_port, timeout=0.01) is not None:
+                loaded = time.perf_counter() - t0
+        proc.wait(timeout)
+    finally:
+        probe.close()
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+    return ready, loaded
+
+
+def benchmark(port=5700, control_port=5701, repeats=3):
+    import statistics
+    import tempfile
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=here + os.pathsep + os.environ.get("PYTHONPATH", ""))
+
+    print(f"[BENCH] import time in a fresh interpreter (median of {repeats}):")
+    for module in IMPORT_TARGETS:
+        t = statistics.median(_import_time(module, env) for _ in range(repeats))
+        print(f"[BENCH]   import {module:15s} {t * 1e3:8.1f} ms")
+
+    settings = f"s.UDP_PORT = {port}; s.CONTROL_PORT = {control_port}; s.KEYBOARD = False; s.run()"
+    cases = [
+        # 以前の ServerTest.py は Plotter・ChunkProcessor・LiveMonitor を読み込んでから bind していた
+        ("before: eager imports + ServerTest.py",
+         [sys.executable, "-c", "import Plotter, ChunkProcessor, LiveMonitor, ServerTest as s; " + settings]),
+        ("lazy imports: ServerTest.py", [sys.executable, "-c", "import ServerTest as s; " + settings]),
+        ("ServerStart.py (bind first)",
+         [sys.executable, os.path.join(here, "ServerStart.py"), "--port", str(port), "--control-port",
+          str(control_port), "--headless"]),
+    ]
+    print(f"[BENCH] process start -> first READY / server loop running (median of {repeats}):")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, cmd in cases:
+            runs = [_time_to_ready(cmd, port, control_port, env, tmp) for _ in range(repeats)]
+            ready = statistics.median(r for r, _ in runs)
+            loaded = statistics.median(l for _, l in runs)
+            print(f"[BENCH]   {name:38s} READY {ready * 1e3:8.1f} ms   loop {loaded * 1e3:8.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Start the server: bind first and answer HELLO/REQUEST_PARAMS "
+                                                 "while the rest loads. 'bench' measures startup time.")
+    parser.add_argument("--port", type=int, default=UDP_PORT)
+    parser.add_argument("--pipeline", action="store_true", help="run the pipelined server (ServerTest.PIPELINE_MODE)")
+    parser.add_argument("--shards", type=int, default=None, help="shard worker processes (ServerTest.SHARDS)")
+    parser.add_argument("--headless", action="store_true", help="no keyboard; control with ServerLoop.py send")
+    parser.add_argument("--control-port", type=int, default=None)
+    sub = parser.add_subparsers(dest="command")
+    p = sub.add_parser("bench")
+    p.add_argument("--port", dest="bench_port", type=int, default=5700, help="UDP port (control socket: port + 1)")
+    p.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == "bench":
+        benchmark(args.bench_port, args.bench_port + 1, args.repeats)
+    else:
+        start_server(args.port, args.pipeline, args.shards, args.headless, args.control_port)
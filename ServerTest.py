@@ -1,11 +1,22 @@
 import socket
-import struct
+import subprocess
+import sys
 import time
-from Plotter import plot_chunks
-from keyinput import check_key
 import os  # フォルダ作成用にosモジュールをインポート
 from ServerResponse import handle_handshake, handle_parameter_request  # 新しいモジュールをインポート
-from ChunkProcessor import build_dataframe_for_chunk, merge_and_save_chunks  # 新しいモジュールをインポート
+from PacketDecoder import AgentChunkBuffer, parse_header, decode_records, last_micros24, build_ack
+from ServerPipeline import ServerPipeline
+from BatchReceiver import BatchReceiver, configure_socket
+from ClockSync import BootSequence, ClockSyncEstimator
+from RetransmitFilter import RetransmitFilter
+from ServerMetrics import MetricsReporter, SampledLog, ServerMetrics
+from ChunkScheduler import FLUSH_TICK_SEC, ChunkWriterPool, FlushScheduler
+from SessionJournal import Journal, finish_session, warn_unfinished
+from ServerLoop import CONTROL_PORT, ServerLoop
+from ShardedServer import ShardCoordinator
+from ScheduledControl import REPLY_PREFIXES, CommandFanout
+# pandas（ChunkProcessor）・matplotlib（Plotter / LiveMonitor）は起動時には読み込まない（読み込みに数秒かかり、
+# その間 isServerReady が失敗した Pico は serverIP2 に切り替えてしまう）。最短で受け付けるには ServerStart.py から起動する
 
 
 # ---------------------------
@@ -15,9 +26,21 @@ UDP_PORT = 5000
 BUFFER_SIZE = 1024
 SOCKET_TIMEOUT = 1.0
 CHUNK_TIMEOUT = 5.0
-
-STRUCT_FORMAT = "<6B"  # micros24 (3バイト), a0, a1, a2
-RECORD_SIZE = struct.calcsize(STRUCT_FORMAT)  # 6 bytes
+PIPELINE_MODE = False  # True: 受信/ACK・デコード・保存を別スレッドで処理する
+SHARDS = 1  # 2以上: SO_REUSEPORT で同じポートを SHARDS 個のプロセスに分けて受信する（Linux）
+STATUS_INTERVAL = 5.0  # パイプラインモードでの状態表示間隔 (秒)
+BATCH_RECV = True  # パイプラインモードで recvmmsg による一括受信を使う
+SOCKET_RCVBUF = 8 * 1024 * 1024  # STOP直後の一斉送信を受け止める受信バッファ (バイト)
+LIVE_MONITOR = False  # True: 受信したデータをその場で描画する（パイプラインモードで動かす）
+MONITOR_POLL_SEC = 0.05  # ライブモニタの描画・GUIイベント処理を呼ぶ間隔
+LOG_LEVEL = "INFO"  # "DEBUG" にするとパケットごとのログを出す（PACKET_LOG_EVERY 件に1件）
+PACKET_LOG_EVERY = 100
+METRICS_JSONL = None  # STATUS_INTERVAL ごとに計測値を1行ずつ追記するファイル（例: "server_metrics.jsonl"、None で無効）
+METRICS_PROM = None  # Prometheus テキスト形式の出力先（textfile collector 用、None で無効）
+SCHEDULED_COMMANDS = True  # True: START/STOP を START_AT/STOP_AT で時刻を決めて送り、届いたか確かめる（ScheduledControl.py）
+JOURNAL = True  # 受け付けたパケットを journal/ に追記し、落ちても SessionJournal.py recover で復元できるようにする
+KEYBOARD = None  # None: 端末があればキー入力、無ければヘッドレス / False: 常にヘッドレス（制御ソケットだけで操作）
+PLOTTER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Plotter.py")  # 保存後のプロットを開く別プロセス
 
 SAVE_FOLDER = "saved_chunks"  # 保存用フォルダ名
 
@@ -25,13 +48,18 @@ SAVE_FOLDER = "saved_chunks"  # 保存用フォルダ名
 if not os.path.exists(SAVE_FOLDER):
     os.makedirs(SAVE_FOLDER)
 
-agent_buffers = {}  # agent_id -> (chunk_data, send_micros_list, recv_time_list)
-agent_lastrecv_time = {}
+agent_buffers = {}  # agent_id -> AgentChunkBuffer (列データ, send_micros, recv_time)
+agent_clocks = {}  # agent_id -> ClockSyncEstimator
 current_chunk_files = []
 
 # グローバル変数として追加
 agent_addrs = {}  # agent_id -> addr
 
+metrics = ServerMetrics()
+packet_log = SampledLog(LOG_LEVEL, PACKET_LOG_EVERY)
+retransmits = RetransmitFilter()
+boot_sequences = BootSequence()  # 起動直後の REQUEST_PARAMS で時計同期をやり直す
+
 
 # ---------------------------
 # チャンク処理
@@ -43,125 +71,254 @@ def is_valid_log_packet(data):
 def send_control_command(sock, addr, cmd):
     sock.sendto(cmd.encode(), addr)
 
+def save_chunk(agent_id, columns, send_list, recv_list, clock, chunk_time):
+    from ChunkProcessor import build_dataframe_for_chunk  # pandas は最初のチャンクを保存するときに書き出しスレッドで読み込む
+    _, saved_file = build_dataframe_for_chunk(agent_id, columns, send_list, recv_list, clock=clock,
+                                              chunk_time=chunk_time)
+    return saved_file
+
+chunk_writer = ChunkWriterPool(save_chunk, metrics)  # 保存は別スレッド（受信ループは pandas/ファイルを待たない）
+flush_scheduler = FlushScheduler(CHUNK_TIMEOUT)  # 黙ったエージェントのチャンクを時間どおりに締める
+
+def flush_agent_buffer(agent_id):
+    """
+    エージェントのバッファをチャンクとして締めて書き出しに回し、空に戻す。
+    保存されたファイルは chunk_writer.take_saved_files() で受け取る。
+    """
+    buf = agent_buffers[agent_id]
+    if len(buf):
+        clock = agent_clocks.get(agent_id)
+        chunk_writer.submit(agent_id, buf.columns(), buf.send_micros, buf.recv_times,
+                            clock.snapshot() if clock is not None else None)
+    buf.reset()
+
+def restart_clock(agent_id):
+    """
+    Pico が再起動した: 前の起動のチャンクをその時計で締めてから、時計同期を最初からやり直す。
+    """
+    if agent_id in agent_buffers:
+        flush_agent_buffer(agent_id)
+    if agent_clocks.pop(agent_id, None) is not None:
+        print(f"[INFO] Agent {agent_id} rebooted: restarting clock sync.")
+
+def flush_idle_agents():
+    """
+    CHUNK_TIMEOUT 以上黙っているエージェントのチャンクを締める（タイマーから呼ぶ）。
+    """
+    for agent_id in flush_scheduler.due(time.time()):
+        if agent_id in agent_buffers and len(agent_buffers[agent_id]):
+            print(f"[INFO] Agent {agent_id} idle for {CHUNK_TIMEOUT:g} s: sealing chunk.")
+            metrics.inc("idle_seals")
+            flush_agent_buffer(agent_id)
+
+def flush_all_agents():
+    """
+    全エージェントのチャンクを締めて書き出しに回し、その区切り（chunk_writer.mark()）を返す。
+    書き出しは待たない（保存済みファイルは chunk_writer.after_written / take_saved_files で受け取る）。
+    """
+    for ag_id in list(agent_buffers.keys()):
+        flush_agent_buffer(ag_id)
+    return chunk_writer.mark()
+
+def merge_chunks(chunk_files):
+    """
+    チャンクを1つのファイルにまとめて保存する（ChunkProcessor.merge_and_save_chunks）。
+    """
+    if not chunk_files:
+        print("[INFO] No chunk files provided. Skipping merge process.")
+        return None
+    from ChunkProcessor import merge_and_save_chunks
+    return merge_and_save_chunks(chunk_files)
+
+def is_headless():
+    return KEYBOARD is False or (KEYBOARD is None and not (sys.stdin is not None and sys.stdin.isatty()))
+
+def show_plot(files):
+    """
+    保存したファイルを別プロセス（python Plotter.py）で表示する。サーバーは描画を待たずに受信を続ける。
+    ヘッドレスでは表示先が無いので、あとで表示するコマンドだけを出す。
+    """
+    if not files:
+        return
+    if isinstance(files, str):
+        files = [files]
+    if is_headless():
+        print(f"[INFO] Headless: plot later with  python Plotter.py {' '.join(files)}")
+        return
+    subprocess.Popen([sys.executable, PLOTTER_SCRIPT] + list(files))
+
+def open_server_socket(responder=None):
+    """
+    UDP_PORT の受信ソケットを開く。ServerStart.py から起動したときは、読み込み中に
+    HELLO / REQUEST_PARAMS に答えていたソケットとその間に登録したエージェントを引き継ぐ。
+    """
+    if responder is not None:
+        return responder.handover(agent_addrs)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    configure_socket(sock, SOCKET_RCVBUF)
+    sock.bind(("0.0.0.0", UDP_PORT))
+    return sock
+
+def open_journal():
+    """
+    JOURNAL が有効ならジャーナルを開く。前回落ちたときの未復元ジャーナルがあれば知らせる。
+    """
+    if not JOURNAL:
+        return None
+    warn_unfinished()
+    return Journal(CHUNK_TIMEOUT)
+
+def handle_control_key(sock, key, fanout=None):
+    """
+    START/STOP/CALIBRATE のキー操作を処理する。処理したら True。
+    fanout (CommandFanout) を渡すと START/STOP は時刻を予約して送る。
+    """
+    if key in ('s', 't') and fanout is not None:
+        fanout.schedule("START" if key == 's' else "STOP", list(agent_addrs))
+
+    elif key == 's':
+        print("[INFO] Sending START command.")
+        for  i in range(1, 5):
+            for id, addr in list(agent_addrs.items()):  # パイプラインの受信スレッドが登録を足すことがある
+                send_control_command(sock, addr, "START")
+
+    elif key == 't':
+        print("[INFO] Sending STOP command.")
+        for i in range(1, 5):
+            for id, addr in list(agent_addrs.items()):  # パイプラインの受信スレッドが登録を足すことがある
+                send_control_command(sock, addr, "STOP")
+
+    elif key == 'c':
+        print("[INFO] Sending CALIBRATE command to IMU agent_id=99.")
+        if 99 in agent_addrs:
+            send_control_command(sock, agent_addrs[99], "CALIBRATE")
+        else:
+            print("[WARN] IMU agent_id=99 not found.")
+    else:
+        return False
+    return True
+
 # ---------------------------
 # メイン受信ループ
 # ---------------------------
-def main():
+def main(responder=None):
     print(f"[INFO] Start listening UDP:{UDP_PORT}")
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(("0.0.0.0", UDP_PORT))
-    sock.settimeout(SOCKET_TIMEOUT)
+    sock = open_server_socket(responder)
+    reporter = MetricsReporter(metrics, METRICS_JSONL, METRICS_PROM)
+    journal = open_journal()
+    fanout = None
+    if SCHEDULED_COMMANDS:
+        fanout = CommandFanout(lambda agent_id, text: send_control_command(sock, agent_addrs[agent_id], text),
+                               agent_clocks)
+
+    def on_datagram(data, addr, recv_time):
+        # 予約コマンドへの返事（SYNC: / ACK:）
+        if fanout is not None and data.startswith(REPLY_PREFIXES):
+            fanout.on_reply(data, addr, recv_time)
+            return
+
+        # パラメータリクエストの処理
+        if data.startswith(b"REQUEST_PARAMS"):  # パラメータリクエストの識別文字列
+            agent_id = handle_parameter_request(sock, data, addr)  # ←引数を3つに修正
+            if agent_id is not None:  # 解釈できないリクエストは登録しない
+                agent_addrs[agent_id] = addr  # ★ここで登録
+                if boot_sequences.params_request(addr):
+                    restart_clock(agent_id)
+            return
+
+        # ハンドシェイクメッセージの処理
+        if data.startswith(b"HELLO"):  # バイト列で比較
+            handle_handshake(sock, data, addr)
+            boot_sequences.hello(addr)
+            return
+
+        if not is_valid_log_packet(data):
+            metrics.inc("malformed")
+            packet_log.debug(lambda: f"Ignored dummy or malformed packet from {addr}, length={len(data)}")
+            return
+        elif len(data) < 5:
+            metrics.inc("malformed")
+            print(f"[WARN] Short packet from {addr}")
+            return
+        boot_sequences.log_packet(addr)
+
+        gap = retransmits.check(data, recv_time)
+        if gap is not None:
+            # 前の ACK が届かなかった再送。チャンクには積まず ACK だけ返し直す
+            metrics.duplicate(data[0], gap)
+            sock.sendto(build_ack(data[0], last_micros24(data)), addr)
+            metrics.inc("acks")
+            return
+
+        t_decode = time.time()
+        agent_id, send_micros = parse_header(data)
+        try:
+            records = decode_records(data)
+        except ValueError:
+            metrics.inc("malformed")
+            print(f"[WARN] Invalid record size from {addr}")
+            return
+        decode_sec = time.time() - t_decode
+
+        if flush_scheduler.touch(agent_id, recv_time) and agent_id in agent_buffers:
+            print(f"[INFO] Agent {agent_id} chunk timeout.")
+            flush_agent_buffer(agent_id)
+
+        if agent_id not in agent_buffers:
+            agent_buffers[agent_id] = AgentChunkBuffer()
+        if agent_id not in agent_clocks:
+            agent_clocks[agent_id] = ClockSyncEstimator()
+        agent_clocks[agent_id].update(send_micros, recv_time)
+
+        packet_log.debug(lambda: f"Agent={agent_id}, send_micros={send_micros}, recv_time={recv_time:.6f}, "
+                                 f"offset_sec={recv_time - ((((send_micros >> 8) % 16777216) << 8) / 1e6):.6f}")
+
+        # 構造化dtypeで一括デコードし、列バッファへ直接追記
+        t_append = time.time()
+        agent_buffers[agent_id].append_records(records, send_micros, recv_time)
+        metrics.observe("decode", decode_sec + time.time() - t_append)
+        metrics.packet(agent_id, len(data), len(records))
+
+        # ACK を返す前にジャーナルへ追記する（ACK 済みのパケットは落ちても復元できる）
+        if journal is not None:
+            journal.append(data, recv_time)
+        retransmits.add(data, recv_time)
+
+        # 最後のレコードの micros24 を取得してACK送信
+        if len(records):
+            sock.sendto(build_ack(agent_id, last_micros24(data)), addr)
+            metrics.inc("acks")
+            metrics.observe("ack_turnaround", time.time() - recv_time)
+
+    def merge_session(chunk_files, failed, session_journal):
+        # 書き出しスレッドで動く（受信ループはマージを待たない）。表示だけループのスレッドに返す
+        merged_path = merge_chunks(chunk_files)
+        print("[INFO] Merged and saved chunks.")
+        if session_journal:
+            finish_session(session_journal, merged_path, failed)
+        loop.call_soon_threadsafe(lambda: show_plot(merged_path))
+
+    def on_key(key):
+        if key in ('\r', '\n'):
+            print("[INFO] Manual chunk flush.")
+            session_journal = journal.rotate() if journal is not None else None
+            chunk_writer.after_written(lambda files, failed: merge_session(files, failed, session_journal),
+                                       flush_all_agents())
+        elif key == 'q':
+            loop.stop()
+        else:
+            handle_control_key(sock, key, fanout)
+
+    # ソケット・キー入力（端末が無ければ制御ソケット）・状態表示をイベントループでまとめて待つ
+    loop = ServerLoop(on_key, keyboard=KEYBOARD, control_port=CONTROL_PORT)
+    loop.add_socket(sock, on_datagram, BUFFER_SIZE)
+    if fanout is not None:
+        fanout.attach(loop)
+    loop.call_every(STATUS_INTERVAL, reporter.report)
+    loop.call_every(FLUSH_TICK_SEC, flush_idle_agents)
 
     try:
-        while True:
-            try:
-                data, addr = sock.recvfrom(BUFFER_SIZE)
-                recv_time = time.time()
-
-                # パラメータリクエストの処理
-                if data.startswith(b"REQUEST_PARAMS"):  # パラメータリクエストの識別文字列
-                    agent_id = handle_parameter_request(sock, data, addr)  # ←引数を3つに修正
-                    agent_addrs[agent_id] = addr  # ★ここで登録
-                    continue
-
-                # ハンドシェイクメッセージの処理
-                if data.startswith(b"HELLO"):  # バイト列で比較
-                    handle_handshake(sock, data, addr)
-                    continue
-
-                if not is_valid_log_packet(data):
-                    print(f"[INFO] Ignored dummy or malformed packet from {addr}, length={len(data)}")
-                    continue
-                elif len(data) < 5:
-                    print(f"[WARN] Short packet from {addr}")
-                    continue
-
-                agent_id = data[0]
-                send_micros = struct.unpack("<I", data[1:5])[0]
-                raw = data[5:]
-
-                if len(raw) % RECORD_SIZE != 0:
-                    print(f"[WARN] Invalid record size from {addr}")
-                    continue
-
-                if agent_id in agent_lastrecv_time:
-                    if (recv_time - agent_lastrecv_time[agent_id]) > CHUNK_TIMEOUT:
-                        print(f"[INFO] Agent {agent_id} chunk timeout.")
-                        chunk_data, send_list, recv_list = agent_buffers[agent_id]
-                        if chunk_data:
-                            _, saved_file = build_dataframe_for_chunk(agent_id, chunk_data, send_list, recv_list)
-                            if saved_file:
-                                current_chunk_files.append(saved_file)  # 保存されたファイルを追跡
-                        agent_buffers[agent_id] = ([], [], [])
-
-                if agent_id not in agent_buffers:
-                    agent_buffers[agent_id] = ([], [], [])
-
-                chunk_data, send_list, recv_list = agent_buffers[agent_id]
-
-                offset_sec = recv_time - ((((send_micros >> 8) % 16777216) << 8) / 1e6)
-                print(f"[DEBUG] Agent={agent_id}, send_micros={send_micros}, "
-                      f"recv_time={recv_time:.6f}, offset_sec={offset_sec:.6f}")
-
-                for i in range(len(raw) // RECORD_SIZE):
-                    record = raw[i*RECORD_SIZE:(i+1)*RECORD_SIZE]
-                    b0, b1, b2, a0, a1, a2 = struct.unpack(STRUCT_FORMAT, record)
-                    micros24 = b0 | (b1 << 8) | (b2 << 16)
-                    # 3バイトのタイムスタンプを32ビットに拡張
-                    micros32 = micros24 & 0xFFFFFF  # 下位24ビットを取得
-                    chunk_data.append((micros32, a0, a1, a2))
-
-                send_list.append(send_micros)
-                recv_list.append(recv_time)
-                agent_buffers[agent_id] = (chunk_data, send_list, recv_list)
-                # 最後のレコードの micros24 を取得してACK送信
-                if len(raw) >= RECORD_SIZE:
-                    last_record = raw[-RECORD_SIZE:]
-                    b0, b1, b2, *_ = struct.unpack(STRUCT_FORMAT, last_record)
-                    last_micros24 = b0 | (b1 << 8) | (b2 << 16)
-
-                    ack = bytearray()
-                    ack.append(agent_id)
-                    ack += last_micros24.to_bytes(3, 'little')
-                    sock.sendto(ack, addr)
-                agent_lastrecv_time[agent_id] = recv_time
-
-            except socket.timeout:
-                pass
-
-            key = check_key()
-            if key in ('\r', '\n'):
-                print("[INFO] Manual chunk flush.")
-                for ag_id in list(agent_buffers.keys()):
-                    data, send_list, recv_list = agent_buffers[ag_id]
-                    if data:
-                        _, saved_file = build_dataframe_for_chunk(ag_id, data, send_list, recv_list)
-                        if saved_file:
-                            current_chunk_files.append(saved_file)  # 保存されたファイルを追跡
-                    agent_buffers[ag_id] = ([], [], [])
-                merged_path = merge_and_save_chunks(current_chunk_files)
-                print("[INFO] Merged and saved chunks.")
-                plot_chunks(merged_path)
-                current_chunk_files.clear()
-                print("[DEBUG] current_chunk_files cleared.")
-            elif key == 's':
-                print("[INFO] Sending START command.")
-                for  i in range(1, 5):
-                    for id in agent_addrs:
-                        send_control_command(sock, agent_addrs[id], "START")
-
-            elif key == 't':
-                print("[INFO] Sending STOP command.")
-                for i in range(1, 5):
-                    for id in agent_addrs:
-                        send_control_command(sock, agent_addrs[id], "STOP")
-
-            elif key == 'c':
-                print("[INFO] Sending CALIBRATE command to IMU agent_id=99.")
-                if 99 in agent_addrs:
-                    send_control_command(sock, agent_addrs[99], "CALIBRATE")
-                else:
-                    print("[WARN] IMU agent_id=99 not found.")
+        loop.run()
 
     except KeyboardInterrupt:
         print("[INFO] Interrupted by user.")
@@ -170,15 +327,173 @@ def main():
         sock.close()
         print("[INFO] Socket closed.")
 
-        for ag_id, (data, send_list, recv_list) in agent_buffers.items():
-            if data:
-                build_dataframe_for_chunk(ag_id, data, send_list, recv_list)
+        session_journal = journal.close() if journal is not None else None
+        flush_all_agents()
+        chunk_writer.close()  # 手動フラッシュのマージが残っていれば、それも終わるまで待つ
+        loop.run_pending()  # そのマージの表示（call_soon_threadsafe で頼まれた分）
+        loop.close()
+
+        merged_path = merge_chunks(chunk_writer.take_saved_files())
+        if session_journal:
+            finish_session(session_journal, merged_path, chunk_writer.take_failed())
+        show_plot(merged_path)
+        print("[INFO] Exit complete.")
+
+# ---------------------------
+# パイプラインモード（受信/ACKスレッド + デコード/保存ワーカー）
+# ---------------------------
+def main_pipelined(responder=None):
+    print(f"[INFO] Start listening UDP:{UDP_PORT} (pipeline mode)")
+    sock = open_server_socket(responder)
+    sock.settimeout(SOCKET_TIMEOUT)
 
-        plot_chunks(current_chunk_files)
-        merge_and_save_chunks(current_chunk_files)
+    receiver = BatchReceiver(sock, timeout=SOCKET_TIMEOUT) if BATCH_RECV else None
+    monitor = None
+    if LIVE_MONITOR:
+        from LiveMonitor import LiveMonitor  # matplotlib はライブモニタを使うときだけ読み込む
+        monitor = LiveMonitor()
+        monitor.start()
+    journal = open_journal()
+    pipeline = ServerPipeline(sock, agent_addrs, CHUNK_TIMEOUT, receiver=receiver,
+                              record_sink=monitor.offer if monitor else None, metrics=metrics, journal=journal)
+    fanout = None
+    if SCHEDULED_COMMANDS:
+        fanout = CommandFanout(lambda agent_id, text: send_control_command(sock, agent_addrs[agent_id], text),
+                               pipeline.clocks)
+        pipeline.control_sink = fanout.on_reply
+    pipeline.start()
+    reporter = MetricsReporter(metrics, METRICS_JSONL, METRICS_PROM)
+
+    def on_key(key):
+        if key in ('\r', '\n'):
+            print("[INFO] Manual chunk flush.")
+            files, session_journal = pipeline.end_session()
+            current_chunk_files.extend(files)
+            merged_path = merge_chunks(current_chunk_files)
+            print("[INFO] Merged and saved chunks.")
+            if session_journal:
+                finish_session(session_journal, merged_path, pipeline.take_failed())
+            print(pipeline.status_line())
+            if monitor is None:
+                show_plot(merged_path)
+            current_chunk_files.clear()
+            print("[DEBUG] current_chunk_files cleared.")
+        elif key == 'q':
+            loop.stop()
+        else:
+            handle_control_key(sock, key, fanout)
+
+    def report():
+        reporter.report()
+        if monitor is not None:
+            print(monitor.status_line())
+
+    # 受信は pipeline のスレッドが行うので、ここではキー入力・制御ソケット・タイマーだけを待つ
+    loop = ServerLoop(on_key, keyboard=KEYBOARD, control_port=CONTROL_PORT)
+    if fanout is not None:
+        fanout.attach(loop)
+    loop.call_every(STATUS_INTERVAL, report)
+    if monitor is not None:
+        loop.call_every(MONITOR_POLL_SEC, monitor.poll)
+
+    try:
+        loop.run()
+
+    except KeyboardInterrupt:
+        print("[INFO] Interrupted by user.")
+
+    finally:
+        loop.close()
+        pipeline.stop()
+        sock.close()
+        print("[INFO] Socket closed.")
+        print(pipeline.status_line())
+        session_journal = journal.close() if journal is not None else None
+
+        current_chunk_files.extend(pipeline.take_saved_files())
+        merged_path = merge_chunks(current_chunk_files)
+        if session_journal:
+            finish_session(session_journal, merged_path, pipeline.take_failed())
+        show_plot(merged_path)
         current_chunk_files.clear()
         print("[DEBUG] current_chunk_files cleared.")
         print("[INFO] Exit complete.")
 
+# ---------------------------
+# シャードモード（SHARDS 個のワーカープロセス + コーディネーター）
+# ---------------------------
+def main_sharded(responder=None):
+    print(f"[INFO] Start listening UDP:{UDP_PORT} ({SHARDS} shards)")
+    coordinator = ShardCoordinator(SHARDS, UDP_PORT, CHUNK_TIMEOUT, journal=JOURNAL, status_interval=STATUS_INTERVAL)
+    coordinator.start()
+    if responder is not None:
+        # ワーカーが受け付けを始めたので仮のソケットを閉じる（登録は Pico の次のパラメータ要求でワーカーが受け取る）
+        responder.close()
+    fanout = None
+    if SCHEDULED_COMMANDS:
+        # ClockSync の推定はシャードの中にあるので、毎回 SYNC で換算を作る
+        fanout = CommandFanout(lambda agent_id, text: coordinator.send_command(text, [agent_id]))
+        coordinator.on_reply = fanout.on_reply
+
+    def merge_session(files, journals):
+        merged_path = merge_chunks(files)
+        for session_journal, failed in journals:
+            finish_session(session_journal, merged_path, failed)
+        return merged_path
+
+    def on_key(key):
+        if key in ('\r', '\n'):
+            print("[INFO] Manual chunk flush.")
+            merged_path = merge_session(*coordinator.flush())
+            print("[INFO] Merged and saved chunks.")
+            show_plot(merged_path)
+        elif key == 'q':
+            loop.stop()
+        elif key in ('s', 't') and fanout is not None:
+            fanout.schedule("START" if key == 's' else "STOP", list(coordinator.agent_addrs))
+        elif key == 's':
+            print("[INFO] Sending START command.")
+            for i in range(1, 5):
+                coordinator.send_command("START")
+        elif key == 't':
+            print("[INFO] Sending STOP command.")
+            for i in range(1, 5):
+                coordinator.send_command("STOP")
+        elif key == 'c':
+            print("[INFO] Sending CALIBRATE command to IMU agent_id=99.")
+            if 99 in coordinator.agent_addrs:
+                coordinator.send_command("CALIBRATE", [99])
+            else:
+                print("[WARN] IMU agent_id=99 not found.")
+
+    loop = ServerLoop(on_key, keyboard=KEYBOARD, control_port=CONTROL_PORT)
+    coordinator.attach(loop)
+    if fanout is not None:
+        fanout.attach(loop)
+
+    try:
+        loop.run()
+
+    except KeyboardInterrupt:
+        print("[INFO] Interrupted by user.")
+
+    finally:
+        loop.close()
+        files, journals = coordinator.stop()
+        print("[INFO] Shards stopped.")
+        show_plot(merge_session(files, journals))
+        print("[INFO] Exit complete.")
+
+def run(responder=None):
+    """
+    設定（SHARDS / PIPELINE_MODE / LIVE_MONITOR）に合わせたモードでサーバーを動かす。
+    """
+    if SHARDS > 1:
+        main_sharded(responder)
+    elif PIPELINE_MODE or LIVE_MONITOR:
+        main_pipelined(responder)
+    else:
+        main(responder)
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    run()
\ No newline at end of file
@@ -0,0 +1,115 @@
+import numpy as np
+
+from PhaseAnalysis import PHASE_PERIOD, unwrap_phase_counts
+
+# ---------------------------
+# セッション解析（描画なし）
+#   読み込み (SessionLoader) → 100Hz 共通時間軸への再サンプル → 同期指標 を計算する。
+#   Plotter.plot_relativePhase と BatchAnalysis の両方から使う。
+# ---------------------------
+IMU_AGENT_ID = 99
+RESAMPLE_HZ = 100.0
+LOCK_WINDOW_SEC = 5.0  # 位相ロック判定で相対位相の変化を見る窓
+LOCK_RATE = 0.1  # 窓内の相対位相の変化率がこれ未満 (rad/s) ならロックとみなす
+SYNC_R = 0.9  # 秩序変数がこれ以上の時間を「同期」として数える
+
+
+def overlap_window(df):
+    """
+    全エージェントの記録が重なっている時間範囲 (min_time, max_time)。
+    """
+    bounds = df.groupby("agent_id")["time_pc_sec_abs"].agg(["min", "max"])
+    return bounds["min"].max(), bounds["max"].min()
+
+
+def phase_tracks(df):
+    """
+    Agent 99 以外のエージェントごとに、時刻順に並べた (time_pc_sec_abs, アンラップ済み a0) を返す。
+    """
+    tracks = {}
+    for agent_id, sub in df[df["agent_id"] != IMU_AGENT_ID].groupby("agent_id"):
+        sub = sub.sort_values("time_pc_sec_abs")
+        tracks[agent_id] = (sub["time_pc_sec_abs"].to_numpy(dtype=np.float64),
+                            unwrap_phase_counts(sub["a0"].to_numpy()))
+    return tracks
+
+
+def resample_tracks(tracks, min_time, max_time, rate=RESAMPLE_HZ):
+    """
+    [min_time, max_time) を rate [Hz] の共通時間軸にして各トラックを線形補間する。
+    戻り値: (time, {agent_id: 位相カウント})。time は min_time からの秒。
+    """
+    new_time_series = np.arange(min_time, max_time, 1.0 / rate) - min_time  # 最小値を基準にシフト
+    phases = {agent_id: np.interp(new_time_series + min_time, t, a0) for agent_id, (t, a0) in tracks.items()}
+    return new_time_series, phases
+
+
+def resample_phases(df, rate=RESAMPLE_HZ):
+    """
+    重なり区間を rate [Hz] の共通時間軸にし、Agent 99 以外の a0 をアンラップしてから線形補間する。
+    戻り値: (time, min_time, {agent_id: 位相カウント}) 。time は min_time からの秒。重なりが無ければ None。
+    """
+    min_time, max_time = overlap_window(df)
+    if min_time >= max_time:
+        print(f"[INFO] No overlapping time range for agents. min_time={min_time}, max_time={max_time}")
+        return None
+    new_time_series, phases = resample_tracks(phase_tracks(df), min_time, max_time, rate)
+    return new_time_series, min_time, phases
+
+
+def _longest_run(mask):
+    """
+    True が続く最長の長さ（サンプル数）。
+    """
+    if not mask.any():
+        return 0
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return int((np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)).max())
+
+
+def session_metrics(time, phases, rate=RESAMPLE_HZ, lock_window_sec=LOCK_WINDOW_SEC, lock_rate=LOCK_RATE,
+                    sync_r=SYNC_R):
+    """
+    再サンプル済みの位相から同期指標を計算する。
+      order_mean / order_final : Kuramoto の秩序変数 R(t) = |mean exp(iθ)| の平均と最後の 10% の平均
+      sync_fraction            : R ≥ sync_r の時間の割合
+      lock_longest_sec / lock_fraction :
+          全エージェントの相対位相（基準 = 最小 agent_id）の変化率が lock_rate 未満の最長連続時間と割合
+      drift_mean / drift_max   : 相対位相の一次近似の傾きの絶対値 (rad/s) の平均と最大
+      freq_mean / freq_spread  : 各エージェントの平均角周波数 (rad/s) の平均と最大−最小
+    """
+    agents = sorted(phases)
+    duration = float(time[-1] - time[0]) if len(time) > 1 else 0.0
+    out = {"agents": len(agents), "duration_sec": duration}
+    if not agents or len(time) < 2:
+        return out
+
+    theta = np.vstack([phases[a] for a in agents]) * (2 * np.pi / PHASE_PERIOD)
+    order = np.abs(np.exp(1j * theta).mean(axis=0))
+    tail = max(1, len(order) // 10)
+    out["order_mean"] = float(order.mean())
+    out["order_final"] = float(order[-tail:].mean())
+    out["sync_fraction"] = float((order >= sync_r).mean())
+
+    freqs = (theta[:, -1] - theta[:, 0]) / duration
+    out["freq_mean"] = float(freqs.mean())
+    out["freq_spread"] = float(freqs.max() - freqs.min())
+
+    if len(agents) < 2:
+        return out
+    # アンラップ済みなので差をそのまま取れば連続な相対位相になる
+    relative = theta[1:] - theta[0]
+    slopes = np.polyfit(time, relative.T, 1)[0]
+    out["drift_mean"] = float(np.abs(slopes).mean())
+    out["drift_max"] = float(np.abs(slopes).max())
+
+    w = max(1, int(round(lock_window_sec * rate)))
+    if relative.shape[1] > w:
+        change = np.abs(relative[:, w:] - relative[:, :-w]) / (w / rate)
+        locked = (change < lock_rate).all(axis=0)
+        out["lock_longest_sec"] = _longest_run(locked) / rate
+        out["lock_fraction"] = float(locked.mean())
+    else:
+        out["lock_longest_sec"] = 0.0
+        out["lock_fraction"] = 0.0
+    return out
@@ -0,0 +1,360 @@
+import argparse
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from ChunkStorage import format_for_path, list_data_files, load_chunk_file
+from TimeAnomalies import GROUP_KEYS, TIME_COLUMN, scan_time_anomalies
+
+# ---------------------------
+# セッションインデックス
+#   merged_chunks 内の各ファイルについて、ファイル単位・チャンク単位のメタデータ
+#   （エージェント、行数、time_pc_sec_abs の開始/終了、時刻異常の件数、CSV内のバイト位置）を
+#   SQLite に保存しておき、データファイルを開かずに一覧・検索できるようにする。
+#   ファイルのサイズと更新時刻が変わったものだけを読み直す（増分更新）。
+# ---------------------------
+MERGED_FOLDER = "merged_chunks"
+INDEX_FILENAME = "session_index.sqlite"
+SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,      -- ディレクトリ内のファイル名
+    format TEXT,
+    size INTEGER,
+    mtime REAL,
+    rows INTEGER,
+    chunks INTEGER,
+    agents TEXT,                -- カンマ区切りの agent_id
+    start REAL,
+    end REAL,
+    anomalies INTEGER,          -- 異常のあるチャンク数
+    indexed_at REAL
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    file TEXT,
+    agent_id INTEGER,
+    chunk_id TEXT,
+    rows INTEGER,
+    start REAL,
+    end REAL,
+    first_row INTEGER,
+    last_row INTEGER,
+    byte_start INTEGER,         -- CSV でチャンクの行が連続しているときだけ（それ以外は NULL）
+    byte_end INTEGER,
+    reversals INTEGER,
+    jumps INTEGER,
+    overflow INTEGER,
+    PRIMARY KEY (file, agent_id, chunk_id)
+);
+CREATE INDEX IF NOT EXISTS chunks_agent_time ON chunks (agent_id, start, end);
+"""
+
+
+def index_path(directory=MERGED_FOLDER):
+    return os.path.join(directory, INDEX_FILENAME)
+
+
+def connect(directory=MERGED_FOLDER):
+    conn = sqlite3.connect(index_path(directory))
+    conn.executescript(_SCHEMA)
+    row = conn.execute("SELECT value FROM meta WHERE key = 'schema'").fetchone()
+    if row is None:
+        conn.execute("INSERT INTO meta VALUES ('schema', ?)", (str(SCHEMA_VERSION),))
+    elif int(row[0]) != SCHEMA_VERSION:
+        # 形式が変わったら作り直す（中身はデータファイルから再生成できる）
+        conn.executescript("DELETE FROM files; DELETE FROM chunks;")
+        conn.execute("UPDATE meta SET value = ? WHERE key = 'schema'", (str(SCHEMA_VERSION),))
+    conn.commit()
+    return conn
+
+
+@contextmanager
+def session(directory=MERGED_FOLDER):
+    """
+    索引への接続。ブロックを抜けるときにコミットして閉じる（例外時はロールバック）。
+    """
+    conn = connect(directory)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+# ---------------------------
+# メタデータの抽出
+# ---------------------------
+def _csv_line_offsets(path):
+    """
+    CSV のデータ行 i の先頭バイト位置 starts[i] と、末尾（改行の次）ends[i]。
+    """
+    with open(path, "rb") as f:
+        buf = np.frombuffer(f.read(), dtype=np.uint8)
+    line_ends = np.flatnonzero(buf == ord("\n")) + 1
+    if len(buf) and buf[-1] != ord("\n"):
+        line_ends = np.append(line_ends, len(buf))
+    # 先頭行はヘッダ
+    return line_ends[:-1], line_ends[1:]
+
+
+def describe_file(path):
+    """
+    1ファイル分の (files 行の辞書, chunks 表の DataFrame) を作る。
+    """
+    st = os.stat(path)
+    fmt = format_for_path(path)
+    try:
+        df = load_chunk_file(path, columns=GROUP_KEYS + [TIME_COLUMN])
+    except (pd.errors.EmptyDataError, ValueError, KeyError):
+        df = pd.DataFrame(columns=GROUP_KEYS + [TIME_COLUMN])
+
+    summary = scan_time_anomalies(df).reset_index() if len(df) else pd.DataFrame(
+        columns=GROUP_KEYS + ["rows", "start", "end", "first_row", "last_row", "reversals", "jumps", "overflow"])
+    chunks = summary[GROUP_KEYS + ["rows", "start", "end", "first_row", "last_row", "reversals", "jumps", "overflow"]].copy()
+    chunks["chunk_id"] = chunks["chunk_id"].astype(str)
+    chunks["byte_start"] = None
+    chunks["byte_end"] = None
+    if fmt == "csv" and len(chunks):
+        line_starts, line_ends = _csv_line_offsets(path)
+        # 行数が合わない（引用符内の改行など）ときはバイト位置を記録しない
+        if len(line_starts) == len(df):
+            first = chunks["first_row"].to_numpy()
+            last = chunks["last_row"].to_numpy()
+            contiguous = last - first + 1 == chunks["rows"].to_numpy()
+            chunks.loc[contiguous, "byte_start"] = line_starts[first[contiguous]]
+            chunks.loc[contiguous, "byte_end"] = line_ends[last[contiguous]]
+
+    bad = (chunks["reversals"] > 0) | (chunks["jumps"] > 0) | (chunks["overflow"] > 0)
+    agents = sorted(int(a) for a in chunks["agent_id"].unique())
+    entry = {
+        "name": os.path.basename(path),
+        "format": fmt,
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        "rows": int(len(df)),
+        "chunks": int(len(chunks)),
+        "agents": ",".join(str(a) for a in agents),
+        "start": float(chunks["start"].min()) if len(chunks) else None,
+        "end": float(chunks["end"].max()) if len(chunks) else None,
+        "anomalies": int(bad.sum()),
+        "indexed_at": time.time(),
+    }
+    return entry, chunks
+
+
+def _store(conn, entry, chunks):
+    name = entry["name"]
+    conn.execute("DELETE FROM chunks WHERE file = ?", (name,))
+    conn.execute("INSERT OR REPLACE INTO files VALUES (:name, :format, :size, :mtime, :rows, :chunks, :agents, "
+                 ":start, :end, :anomalies, :indexed_at)", entry)
+    rows = [(name, int(r.agent_id), r.chunk_id, int(r.rows), float(r.start), float(r.end),
+             int(r.first_row), int(r.last_row),
+             None if r.byte_start is None else int(r.byte_start), None if r.byte_end is None else int(r.byte_end),
+             int(r.reversals), int(r.jumps), int(r.overflow))
+            for r in chunks.itertuples(index=False)]
+    conn.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+# ---------------------------
+# 更新
+# ---------------------------
+def index_file(path, directory=None):
+    """
+    1ファイルを索引に追加（または更新）する。merge_and_save_chunks の保存直後に呼ぶ。
+    """
+    directory = directory or os.path.dirname(path) or "."
+    with session(directory) as conn:
+        entry, chunks = describe_file(path)
+        _store(conn, entry, chunks)
+    return entry
+
+
+def update_index(directory=MERGED_FOLDER, verbose=False):
+    """
+    ディレクトリと索引を突き合わせ、追加・変更されたファイルだけを読み直し、消えたファイルを索引から外す。
+    (追加/更新した数, 削除した数) を返す。データファイルは stat するだけで、変化がなければ開かない。
+    """
+    if not os.path.isdir(directory):
+        return 0, 0
+    on_disk = {}
+    for path in list_data_files(directory):
+        st = os.stat(path)
+        on_disk[os.path.basename(path)] = (st.st_size, st.st_mtime)
+
+    with session(directory) as conn:
+        known = {name: (size, mtime) for name, size, mtime in conn.execute("SELECT name, size, mtime FROM files")}
+        stale = [name for name in known if name not in on_disk]
+        for name in stale:
+            conn.execute("DELETE FROM files WHERE name = ?", (name,))
+            conn.execute("DELETE FROM chunks WHERE file = ?", (name,))
+        changed = [name for name, sig in on_disk.items() if known.get(name) != sig]
+        for name in sorted(changed):
+            entry, chunks = describe_file(os.path.join(directory, name))
+            _store(conn, entry, chunks)
+            if verbose:
+                print(f"[INFO] Indexed {name}: {entry['rows']} rows, {entry['chunks']} chunks, agents {entry['agents']}")
+    return len(changed), len(stale)
+
+
+# ---------------------------
+# 問い合わせ
+# ---------------------------
+def _to_epoch(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, datetime):
+        return value.timestamp()
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def list_files(directory=MERGED_FOLDER, refresh=True):
+    """
+    索引にあるファイルの一覧（ファイル名の降順 = 新しい順）。
+    """
+    if refresh:
+        update_index(directory)
+    with session(directory) as conn:
+        df = pd.read_sql_query("SELECT * FROM files ORDER BY name DESC", conn)
+    df["path"] = [os.path.join(directory, n) for n in df["name"]]
+    return df
+
+
+def nth_latest_file(n, directory=MERGED_FOLDER, refresh=True):
+    """
+    新しい方から n 番目（1始まり）のファイルの索引情報（Series）。範囲外なら None。
+    """
+    files = list_files(directory, refresh)
+    if n < 1 or n > len(files):
+        return None
+    return files.iloc[n - 1]
+
+
+def find_chunks(agent_id=None, start=None, end=None, directory=MERGED_FOLDER, refresh=True):
+    """
+    条件に合うチャンクを返す。start/end は UNIX 秒・ISO 形式の文字列・datetime のいずれか。
+    時間範囲はチャンクの [start, end] と重なるものを選ぶ。
+    """
+    if refresh:
+        update_index(directory)
+    where, params = [], []
+    if agent_id is not None:
+        where.append("agent_id = ?")
+        params.append(int(agent_id))
+    if start is not None:
+        where.append("end >= ?")
+        params.append(_to_epoch(start))
+    if end is not None:
+        where.append("start <= ?")
+        params.append(_to_epoch(end))
+    sql = "SELECT * FROM chunks"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY start"
+    with session(directory) as conn:
+        df = pd.read_sql_query(sql, conn, params=params)
+    df["path"] = [os.path.join(directory, f) for f in df["file"]]
+    return df
+
+
+def find_runs(agent_id=None, start=None, end=None, directory=MERGED_FOLDER, refresh=True):
+    """
+    条件に合うチャンクを含むファイル（= 1回の実験）の一覧。例: find_runs(99, "2025-06-09 18:00", "2025-06-09 20:00")
+    """
+    chunks = find_chunks(agent_id, start, end, directory, refresh)
+    files = list_files(directory, refresh=False)
+    return files[files["name"].isin(chunks["file"])].sort_values("start").reset_index(drop=True)
+
+
+def describe_entry(entry):
+    """
+    files 行を1行の文字列にする（表示用）。
+    """
+    if entry["start"] is None or pd.isna(entry["start"]):
+        span = "empty"
+    else:
+        span = (f"{datetime.fromtimestamp(entry['start']):%Y-%m-%d %H:%M:%S} "
+                f"+{entry['end'] - entry['start']:.0f}s")
+    return (f"{entry['name']}: {entry['rows']} rows, {entry['chunks']} chunks, agents [{entry['agents']}], "
+            f"{span}, anomalous chunks {entry['anomalies']}")
+
+
+# ---------------------------
+# ベンチマーク
+# ---------------------------
+def benchmark(directory=MERGED_FOLDER, agent_id=99):
+    path = index_path(directory)
+    if os.path.exists(path):
+        os.remove(path)
+    t0 = time.perf_counter()
+    added, _ = update_index(directory)
+    t_build = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    update_index(directory)
+    t_noop = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    runs = find_runs(agent_id, directory=directory, refresh=False)
+    t_query = time.perf_counter() - t0
+
+    # 索引なしで同じ問い合わせ（全ファイルを読む）
+    t0 = time.perf_counter()
+    hits = []
+    for p in list_data_files(directory):
+        try:
+            df = pd.read_csv(p, usecols=["agent_id"]) if format_for_path(p) == "csv" else load_chunk_file(p, ["agent_id"])
+        except pd.errors.EmptyDataError:
+            continue
+        if (df["agent_id"] == agent_id).any():
+            hits.append(p)
+    t_scan = time.perf_counter() - t0
+
+    print(f"[BENCH] {added} files indexed in {t_build:.2f} s ({os.path.getsize(path) / 1e3:.0f} kB index); "
+          f"incremental no-op update {t_noop * 1e3:.1f} ms")
+    print(f"[BENCH] runs with agent {agent_id}: index {len(runs)} in {t_query * 1e3:.1f} ms, "
+          f"full scan {len(hits)} in {t_scan * 1e3:.0f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Session index over merged_chunks.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("update", help="index new or changed files")
+    p.add_argument("directory", nargs="?", default=MERGED_FOLDER)
+    p = sub.add_parser("list", help="list indexed files, newest first")
+    p.add_argument("directory", nargs="?", default=MERGED_FOLDER)
+    p.add_argument("-n", type=int, default=20)
+    p = sub.add_parser("query", help="find runs by agent and time range")
+    p.add_argument("directory", nargs="?", default=MERGED_FOLDER)
+    p.add_argument("--agent", type=int)
+    p.add_argument("--start", help="UNIX seconds or ISO time")
+    p.add_argument("--end", help="UNIX seconds or ISO time")
+    p.add_argument("--chunks", action="store_true", help="list matching chunks instead of files")
+    p = sub.add_parser("bench", help="compare index lookups with scanning every file")
+    p.add_argument("directory", nargs="?", default=MERGED_FOLDER)
+    p.add_argument("--agent", type=int, default=99)
+    args = parser.parse_args()
+
+    if args.command == "update":
+        added, removed = update_index(args.directory, verbose=True)
+        print(f"[INFO] {added} files indexed, {removed} removed.")
+    elif args.command == "list":
+        for _, entry in list_files(args.directory).head(args.n).iterrows():
+            print(describe_entry(entry))
+    elif args.command == "query":
+        if args.chunks:
+            found = find_chunks(args.agent, args.start, args.end, args.directory)
+            print(found.drop(columns=["path"]).to_string(index=False))
+        else:
+            for _, entry in find_runs(args.agent, args.start, args.end, args.directory).iterrows():
+                print(describe_entry(entry))
+    else:
+        benchmark(args.directory, args.agent)
@@ -0,0 +1,344 @@
+import argparse
+import glob
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime
+
+# ---------------------------
+# セッションジャーナル（追記専用の受信ログ）
+#   受け付けたログパケットを、受信時刻付きでそのままバイナリファイルに追記する。
+#   チャンクはサーバーのメモリ上にしかないので、落ちたときはこのファイルから
+#   チャンクとマージファイルを作り直す（python SessionJournal.py recover）。
+#   書き込みはバッファ付きファイルへの write 1回だけで、fsync は別スレッドが FSYNC_INTERVAL ごとに行う。
+#   手動フラッシュ（セッションの区切り）で rotate() して次のファイルに移り、
+#   前のファイルはマージが済んでから finish() で消す（JOURNAL_KEEP なら .done に改名して残す）。
+#
+#   ファイル形式:
+#     ヘッダ   MAGIC(4) + <dd (開始時刻, CHUNK_TIMEOUT)
+#     レコード <BdHI (種類 = 1: ログパケット, 受信時刻, 長さ, CRC32) + データグラム
+#   末尾が書きかけ・CRC 不一致のレコードはそこで読むのをやめる。
+# ---------------------------
+JOURNAL_FOLDER = "journal"
+JOURNAL_EXT = ".wal"
+JOURNAL_KEEP = False
+FSYNC_INTERVAL = 1.0  # [s]
+WRITE_BUFFER = 1 << 20
+
+MAGIC = b"VPJ1"
+_HEADER = struct.Struct("<dd")
+_RECORD = struct.Struct("<BdHI")
+KIND_PACKET = 1
+
+
+class Journal:
+    """
+    サーバーのジャーナル。append() は受信スレッドから、sync() は fsync スレッドから呼ばれる。
+    """
+
+    def __init__(self, chunk_timeout, folder=JOURNAL_FOLDER, fsync_interval=FSYNC_INTERVAL):
+        self.chunk_timeout = chunk_timeout
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.packets = 0
+        self.bytes = 0
+        self.syncs = 0
+        self.path = None
+        self._file = self._open()
+        self._syncer = None
+        if fsync_interval:
+            self._syncer = threading.Thread(target=self._sync_loop, args=(fsync_interval,), name="journal-fsync",
+                                            daemon=True)
+            self._syncer.start()
+
+    def _open(self):
+        # シャードのワーカーは同じフォルダに別々のジャーナルを開くので、PID も名前に入れる。
+        # "xb" なので万一名前が重なっても他のジャーナルを切り詰めず、例外になる
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        self.path = os.path.join(self.folder, f"session_{stamp}_{os.getpid()}{JOURNAL_EXT}")
+        f = open(self.path, "xb", buffering=WRITE_BUFFER)
+        f.write(MAGIC + _HEADER.pack(time.time(), self.chunk_timeout))
+        return f
+
+    @staticmethod
+    def _close(f):
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+    def append(self, data, recv_time, accept=None):
+        """
+        パケットを追記する。accept を渡すとロックを持ったまま先に呼び、False なら追記しない（戻り値も同じ）。
+        受信スレッドがデコードキューへ積むのをここで行えば、rotate() の区切りとキューの区切りが一致する。
+        """
+        record = _RECORD.pack(KIND_PACKET, recv_time, len(data), zlib.crc32(data)) + data
+        with self._lock:
+            if accept is not None and not accept():
+                return False
+            self._file.write(record)
+            self.packets += 1
+            self.bytes += len(record)
+        return True
+
+    def sync(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.flush()
+            fd = self._file.fileno()
+        try:
+            os.fsync(fd)  # 書き込みを止めないようにロックの外で待つ
+            self.syncs += 1
+        except OSError:
+            pass  # 直後に rotate/close で閉じられた（そちらでも fsync する）
+
+    def _sync_loop(self, interval):
+        while not self._stop.wait(interval):
+            self.sync()
+
+    def rotate(self, boundary=None):
+        """
+        今のファイルを閉じて次のファイルに移り、閉じたファイルのパスを返す（セッションの区切り）。
+        boundary を渡すと append() と同じロックの中で呼ぶ（デコードキューにフラッシュを積むなど）。
+        これより前に追記したパケットは閉じたファイルに、後のパケットは次のファイルに入る。
+        """
+        with self._lock:
+            old_file, old_path = self._file, self.path
+            self._file = self._open()
+            if boundary is not None:
+                boundary()
+        self._close(old_file)
+        return old_path
+
+    def close(self):
+        """
+        fsync スレッドを止めてファイルを閉じ、そのパスを返す。
+        """
+        self._stop.set()
+        if self._syncer is not None:
+            self._syncer.join()
+        with self._lock:
+            if not self._file.closed:
+                self._close(self._file)
+        return self.path
+
+    @staticmethod
+    def finish(path, keep=JOURNAL_KEEP):
+        """
+        マージが済んだセッションのファイルを消す（keep なら .done に改名する）。
+        """
+        try:
+            if keep:
+                os.replace(path, path + ".done")
+            else:
+                os.remove(path)
+        except OSError as e:
+            print(f"[WARN] Could not finish journal {path}: {e}")
+
+
+def is_empty(path):
+    """
+    ヘッダだけで、パケットを1つも書いていないジャーナルなら True。
+    """
+    return os.path.getsize(path) <= len(MAGIC) + _HEADER.size
+
+
+def finish_session(path, merged, failed=0, keep=JOURNAL_KEEP):
+    """
+    セッションのマージが済んだジャーナルを finish() で片付ける。チャンクの保存に失敗したときや、
+    パケットがあるのにマージできなかったときは、ACK 済みのデータの唯一の写しなので残す
+    （recover() と同じく merged or not packets のときだけ片付ける）。片付けたら True。
+    """
+    if failed or not (merged or is_empty(path)):
+        print(f"[WARN] Keeping journal {path} ({failed} chunk(s) failed to save, merged: {merged}). "
+              f"Rebuild the session with 'python SessionJournal.py recover'.")
+        return False
+    Journal.finish(path, keep)
+    return True
+
+
+def find_unfinished(folder=JOURNAL_FOLDER):
+    """
+    完了していない（マージ前に落ちた）ジャーナルの一覧。
+    """
+    return sorted(glob.glob(os.path.join(folder, "*" + JOURNAL_EXT)))
+
+
+def warn_unfinished(folder=JOURNAL_FOLDER):
+    files = find_unfinished(folder)
+    if files:
+        print(f"[WARN] {len(files)} unfinished journal(s) in {folder}/ (server did not exit cleanly). "
+              f"Run 'python SessionJournal.py recover' to rebuild their chunks.")
+    return files
+
+
+# ---------------------------
+# 読み出しと復元
+# ---------------------------
+def read_journal(path):
+    """
+    (開始時刻, CHUNK_TIMEOUT, [(受信時刻, データグラム), ...]) を返す。
+    """
+    with open(path, "rb") as f:
+        blob = f.read()
+    if blob[:len(MAGIC)] != MAGIC or len(blob) < len(MAGIC) + _HEADER.size:
+        raise ValueError(f"{path}: not a session journal")
+    started, chunk_timeout = _HEADER.unpack_from(blob, len(MAGIC))
+    pos = len(MAGIC) + _HEADER.size
+    entries = []
+    view = memoryview(blob)
+    while pos + _RECORD.size <= len(blob):
+        kind, recv_time, length, crc = _RECORD.unpack_from(blob, pos)
+        start = pos + _RECORD.size
+        data = bytes(view[start:start + length])
+        if kind != KIND_PACKET or len(data) < length or zlib.crc32(data) != crc:
+            print(f"[WARN] {path}: torn or corrupt record at byte {pos}; ignoring the rest "
+                  f"({len(blob) - pos} bytes).")
+            break
+        entries.append((recv_time, data))
+        pos = start + length
+    else:
+        if pos != len(blob):
+            print(f"[WARN] {path}: truncated record at byte {pos}; ignoring {len(blob) - pos} bytes.")
+    return started, chunk_timeout, entries
+
+
+def rebuild_chunks(entries, chunk_timeout, chunk_sink):
+    """
+    サーバーと同じ規則（CHUNK_TIMEOUT、ファイルの終わりで全エージェントを締める）でチャンクを切り直し、
+    chunk_sink(agent_id, columns, send_list, recv_list, clock, chunk_time) に渡す。戻り値は sink の戻り値のリスト。
+    """
+    from ClockSync import ClockSyncEstimator
+    from PacketDecoder import AgentChunkBuffer, decode_records, parse_header
+    from RetransmitFilter import RetransmitFilter
+
+    buffers, clocks, last_recv, results = {}, {}, {}, []
+    retransmits = RetransmitFilter()
+
+    def seal(agent_id):
+        buf = buffers[agent_id]
+        if len(buf):
+            chunk_time = datetime.fromtimestamp(buf.recv_times[-1])
+            results.append(chunk_sink(agent_id, buf.columns(), buf.send_micros, buf.recv_times,
+                                      clocks[agent_id].snapshot(), chunk_time))
+        buf.reset()
+
+    for recv_time, data in entries:
+        if retransmits.check(data, recv_time) is not None:
+            continue
+        retransmits.add(data, recv_time)
+        agent_id, send_micros = parse_header(data)
+        buf = buffers.get(agent_id)
+        if buf is None:
+            buf = buffers[agent_id] = AgentChunkBuffer()
+            clocks[agent_id] = ClockSyncEstimator()
+        elif recv_time - last_recv[agent_id] > chunk_timeout:
+            seal(agent_id)
+        clocks[agent_id].update(send_micros, recv_time)
+        buf.append_records(decode_records(data), send_micros, recv_time)
+        last_recv[agent_id] = recv_time
+    for agent_id in buffers:
+        seal(agent_id)
+    return results
+
+
+def recover(path, keep=True):
+    """
+    ジャーナルからチャンクを作り直してマージする。マージできたらジャーナルを .recovered に改名する。
+    """
+    from ChunkProcessor import build_dataframe_for_chunk, merge_and_save_chunks
+
+    started, chunk_timeout, entries = read_journal(path)
+    packets = len(entries)
+    print(f"[INFO] {path}: session started {datetime.fromtimestamp(started):%Y-%m-%d %H:%M:%S}, "
+          f"{packets} packets, chunk_timeout={chunk_timeout:g} s")
+
+    def save(agent_id, columns, send_list, recv_list, clock, chunk_time):
+        _, saved_file = build_dataframe_for_chunk(agent_id, columns, send_list, recv_list, clock=clock,
+                                                  chunk_time=chunk_time)
+        return saved_file
+
+    chunk_files = [f for f in rebuild_chunks(entries, chunk_timeout, save) if f]
+    merged = merge_and_save_chunks(chunk_files)
+    if merged or not packets:
+        if keep:
+            os.replace(path, path + ".recovered")
+        else:
+            os.remove(path)
+    return merged
+
+
+# ---------------------------
+# ベンチマーク（1パケットあたりの書き込みコストと復元の正しさ）
+# ---------------------------
+def benchmark(num_packets=200000, num_agents=10, records_per_packet=84):
+    import numpy as np
+    from LoadGenerator import build_log_packet
+
+    rng = np.random.default_rng(0)
+    packets = []
+    t = np.zeros(num_agents, dtype=np.int64)
+    for i in range(num_packets):
+        agent_id = i % num_agents + 1
+        micros = (t[agent_id - 1] + np.arange(records_per_packet) * 10000) & 0xFFFFFF
+        t[agent_id - 1] += records_per_packet * 10000
+        a = rng.integers(0, 256, (3, records_per_packet), dtype=np.uint8)
+        packets.append(build_log_packet(agent_id, int(t[agent_id - 1]), micros, *a))
+    base = time.time()
+    recv_times = [base + i * 1e-4 for i in range(num_packets)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        journal = Journal(5.0, tmp, FSYNC_INTERVAL)
+        t0 = time.perf_counter()
+        for data, recv_time in zip(packets, recv_times):
+            journal.append(data, recv_time)
+        t_append = time.perf_counter() - t0
+        # 受信と同じ間隔で書いたときの fsync 回数を見るため、1秒分だけ fsync スレッドを回す
+        time.sleep(FSYNC_INTERVAL * 1.5)
+        t0 = time.perf_counter()
+        path = journal.close()
+        t_close = time.perf_counter() - t0
+        size = os.path.getsize(path)
+        print(f"[BENCH] {num_packets} packets x {len(packets[0])} bytes: append {t_append / num_packets * 1e6:.2f} "
+              f"us/packet, journal {size / 1e6:.1f} MB ({size / sum(map(len, packets)) - 1:+.1%} overhead), "
+              f"background fsyncs={journal.syncs}, final flush+fsync {t_close * 1e3:.1f} ms")
+
+        # 書きかけの末尾を作ってから復元し、全レコードが元通りになるか
+        with open(path, "ab") as f:
+            f.write(_RECORD.pack(KIND_PACKET, base, 500, 0) + b"\x01" * 100)
+        t0 = time.perf_counter()
+        _, chunk_timeout, entries = read_journal(path)
+        chunks = rebuild_chunks(entries, chunk_timeout, lambda agent_id, columns, *_: (agent_id, columns))
+        t_read = time.perf_counter() - t0
+        ok = len(entries) == num_packets
+        for agent_id, columns in chunks:
+            expected = np.concatenate([np.frombuffer(p, np.uint8, offset=5).reshape(-1, 6)[:, 3]
+                                       for p in packets[agent_id - 1::num_agents]])
+            ok &= np.array_equal(columns["a0"], expected)
+        print(f"[BENCH] read + rebuild {len(chunks)} chunks: {t_read:.2f} s, records identical: {bool(ok)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recover sessions from the server journal, or benchmark it.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("recover", help="rebuild chunks and merged files from unfinished journals")
+    p.add_argument("files", nargs="*", help=f"journal files (default: all unfinished in {JOURNAL_FOLDER}/)")
+    p.add_argument("--delete", action="store_true", help="delete journals after a successful merge")
+    p = sub.add_parser("bench")
+    p.add_argument("--packets", type=int, default=200000)
+    args = parser.parse_args()
+
+    if args.command == "recover":
+        files = args.files or find_unfinished()
+        if not files:
+            print(f"[INFO] No unfinished journals in {JOURNAL_FOLDER}/.")
+        for path in files:
+            merged = recover(path, keep=not args.delete)
+            print(f"[RESULT] {path} -> {merged}")
+    else:
+        benchmark(args.packets)
@@ -0,0 +1,219 @@
+import argparse
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from ChunkMerge import BLOCK_ROWS, make_synthetic_session, measure, stream_merge
+from ChunkStorage import NARROW_DTYPES, format_for_path, load_chunk_file
+
+# ---------------------------
+# 長いセッションの省メモリ読み込み
+#   ファイルを BLOCK_ROWS 行ずつ読み、値が範囲に収まることを確かめてからブロックごとに狭い型にする
+#   （time_pc_sec_abs だけ float64、a0..a2 / agent_id は uint8、chunk_id はカテゴリ）。
+#   ブロックは列ごとの配列に溜めて最後に1回だけ連結するので、
+#   int64/object の中間表現や pd.concat によるコピーがピークメモリに乗らない。
+#   step / reduce を渡すと表示用に間引き・集約しながら読む。
+# ---------------------------
+PLOT_COLUMNS = ["agent_id", "chunk_id", "time_pc_sec_abs", "a0", "a1", "a2"]
+
+
+def _narrow_block(block, columns, path, warned):
+    """
+    block の数値列を NARROW_DTYPES に縮める。値が型の範囲に収まらない列（0..255 を超える a0 など）は
+    そのブロックだけ読んだときの型のまま残し、ファイルごと・列ごとに1回だけ警告する。
+    """
+    for col in columns:
+        dtype = NARROW_DTYPES.get(col)
+        if dtype is None or col == "chunk_id":
+            continue
+        values = block[col].to_numpy()
+        target = np.dtype(dtype)
+        if values.dtype == target:
+            continue
+        if target.kind in "iu" and len(values):
+            info = np.iinfo(target)
+            if values.dtype.kind == "f":
+                fits = bool(np.isfinite(values).all() and (values == np.floor(values)).all())
+            else:
+                fits = values.dtype.kind in "iu"
+            fits = fits and values.min() >= info.min and values.max() <= info.max
+            if not fits:
+                if col not in warned:
+                    warned.add(col)
+                    print(f"[WARN] {path}: {col} has values outside {target.name} "
+                          f"({values.min()}..{values.max()}); keeping {values.dtype.name} for those blocks.")
+                continue
+        block[col] = values.astype(target)
+    return block
+
+
+def iter_narrow_blocks(path, columns=PLOT_COLUMNS, block_rows=BLOCK_ROWS):
+    """
+    1ファイルを最大 block_rows 行ずつ、狭い型の DataFrame として順に返す。
+    columns のうち1つでも欠けていれば何も返さない。
+    """
+    warned = set()
+    if format_for_path(path) == "csv":
+        try:
+            header = pd.read_csv(path, nrows=0).columns
+        except pd.errors.EmptyDataError:
+            return
+        if not all(col in header for col in columns):
+            return
+        # read_csv に uint8 を渡すと 300 -> 44 のように黙って折り返すので、ブロックは既定の型で読んで範囲を確かめてから縮める
+        dtype = {"chunk_id": "category"} if "chunk_id" in columns else None
+        for block in pd.read_csv(path, usecols=columns, dtype=dtype, chunksize=block_rows):
+            yield _narrow_block(block[columns], columns, path, warned)
+        return
+
+    df = load_chunk_file(path, columns=columns)
+    if not all(col in df.columns for col in columns):
+        return
+    for start in range(0, len(df), block_rows):
+        yield _narrow_block(df.iloc[start:start + block_rows][columns].copy(), columns, path, warned)
+
+
+class _ColumnAccumulator:
+    """
+    ブロックを列ごとの配列リストに溜める。chunk_id はファイル全体で共通のカテゴリ表に揃えたコードで持つ。
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.parts = {col: [] for col in columns}
+        self.categories = {}
+        self.rows = 0
+
+    def add(self, block):
+        for col in self.columns:
+            values = block[col]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                cats = values.cat.categories.astype(str)
+                remap = np.array([self.categories.setdefault(c, len(self.categories)) for c in cats], dtype=np.int32)
+                codes = values.cat.codes.to_numpy()
+                self.parts[col].append(remap[codes] if len(remap) else codes.astype(np.int32))
+            elif values.dtype == object:
+                self.parts[col].append(self._codes_for(values.astype(str).to_numpy()))
+            else:
+                self.parts[col].append(values.to_numpy())
+        self.rows += len(block)
+
+    def _codes_for(self, strings):
+        uniq, inverse = np.unique(strings, return_inverse=True)
+        remap = np.array([self.categories.setdefault(c, len(self.categories)) for c in uniq], dtype=np.int32)
+        return remap[inverse]
+
+    def frame(self):
+        data = {}
+        for col in self.columns:
+            parts = self.parts.pop(col)  # 連結したら元のブロックはすぐ手放す
+            values = np.concatenate(parts) if parts else np.empty(0)
+            del parts
+            if col == "chunk_id":
+                categories = np.array(list(self.categories), dtype=str)
+                values = pd.Categorical.from_codes(values, categories=categories)
+            data[col] = values
+        return pd.DataFrame(data)
+
+
+def decimate_block(block, step, counts):
+    """
+    エージェントごとに step 行に1行だけ残す。counts はエージェントごとの通し行数で、
+    ブロックやファイルをまたいでも間引きの位相がずれないように更新していく。
+    """
+    agent = block["agent_id"].to_numpy()
+    position = block.groupby(agent, sort=False).cumcount().to_numpy()
+    offset = np.zeros(len(agent), dtype=np.int64)
+    for a, n in pd.Series(agent).value_counts(sort=False).items():
+        mask = agent == a
+        offset[mask] = counts.get(a, 0)
+        counts[a] = counts.get(a, 0) + n
+    return block[(position + offset) % step == 0]
+
+
+def load_session_files(file_list, columns=PLOT_COLUMNS, block_rows=BLOCK_ROWS, step=1, reduce=None):
+    """
+    ファイル群をブロックごとに狭い型で読み込んで1つの DataFrame にする。読めないファイルは警告して飛ばす。
+    step > 1 ならエージェントごとに step 行に1行へ間引き、reduce(block) を渡せば各ブロックを集約してから溜める。
+    有効なデータが無ければ None。
+    """
+    acc = _ColumnAccumulator(columns)
+    counts = {}
+    loaded = 0
+    for file in file_list:
+        if not os.path.isfile(file):
+            print(f"[WARN] File not found: {file}")
+            continue
+
+        try:
+            for block in iter_narrow_blocks(file, columns, block_rows):
+                if step > 1:
+                    block = decimate_block(block, step, counts)
+                if reduce is not None:
+                    block = reduce(block)
+                acc.add(block)
+            loaded += 1
+        except Exception as e:
+            print(f"[WARN] Failed to load {file}: {e}")
+
+    if not loaded or acc.rows == 0:
+        return None
+    return acc.frame()
+
+
+# ---------------------------
+# ベンチマーク（ピークメモリ）
+# ---------------------------
+def _legacy_load(file_list, columns=PLOT_COLUMNS):
+    """
+    以前の読み方（既定の int64/float64/object 型で全体を読み pd.concat）。
+    """
+    dfs = [load_chunk_file(f, columns=columns) for f in file_list]
+    return pd.concat([df[columns] for df in dfs], ignore_index=True)
+
+
+def benchmark(file_list=None, num_chunks=100, rows_per_chunk=28000, step=10):
+    if not file_list:
+        with tempfile.TemporaryDirectory() as tmp:
+            chunks = make_synthetic_session(tmp, num_chunks, rows_per_chunk)
+            merged, _ = stream_merge(chunks, os.path.join(tmp, "merged"), "csv")
+            for c in chunks:
+                os.remove(c)
+            print(f"[BENCH] synthetic session: {num_chunks} chunks x {rows_per_chunk} rows "
+                  f"({os.path.getsize(merged) / 1e6:.0f} MB csv)")
+            return benchmark([merged], step=step)
+
+    def rows_and_bytes(fn):
+        def run():
+            df = fn()
+            return (len(df), int(df.memory_usage(deep=True).sum()))
+        return run
+
+    cases = [
+        ("legacy full load + concat", rows_and_bytes(lambda: _legacy_load(file_list))),
+        ("narrow streamed", rows_and_bytes(lambda: load_session_files(file_list))),
+        (f"narrow streamed, step={step}", rows_and_bytes(lambda: load_session_files(file_list, step=step))),
+    ]
+    for name, fn in cases:
+        (rows, frame_bytes), elapsed, peak = measure(fn)
+        print(f"[BENCH] {name:28s} rows={rows:9d} time={elapsed:6.2f} s  frame={frame_bytes / 1e6:7.1f} MB  "
+              f"peak_rss_delta={peak / 1e6:7.1f} MB")
+
+    old = _legacy_load(file_list)
+    new = load_session_files(file_list)
+    same = all(np.array_equal(old[c].astype(str if c == "chunk_id" else old[c].dtype).to_numpy(),
+                              new[c].astype(str if c == "chunk_id" else old[c].dtype).to_numpy())
+               for c in PLOT_COLUMNS)
+    print(f"[BENCH] identical values: {same}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure peak memory of session loading.")
+    parser.add_argument("files", nargs="*", help="merged files (default: a synthetic session)")
+    parser.add_argument("--chunks", type=int, default=100)
+    parser.add_argument("--rows", type=int, default=28000)
+    parser.add_argument("--step", type=int, default=10, help="decimation step for the display case")
+    args = parser.parse_args()
+    benchmark(args.files, args.chunks, args.rows, args.step)
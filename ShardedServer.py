@@ -0,0 +1,247 @@
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+
+from BatchReceiver import SOCKET_RCVBUF, BatchReceiver, configure_socket
+
+# ---------------------------
+# シャード化したサーバー（複数プロセスで同じポートを受信する）
+#   各ワーカープロセスは SO_REUSEPORT で同じ UDP ポートに bind し、ServerPipeline を1つ動かす。
+#   カーネルは送信元 (IP, ポート) のハッシュでデータグラムを振り分けるので、
+#   1台の Pico（HELLO・REQUEST_PARAMS・ログを同じローカルポートから送る）は常に同じワーカーに入り、
+#   デコード・ACK・チャンク化はそのワーカーの中で完結する。
+#   コーディネーター（元のプロセス）はパイプでワーカーとつながり、
+#     - agent_addrs の登録をまとめて持つ
+#     - START/STOP/CALIBRATE をワーカー経由で各エージェントに送る（送信元はポート UDP_PORT のまま）
+#       予約コマンドへの返事（SYNC: / ACK:）はワーカーから受信時刻つきでそのまま回してもらう
+#     - 手動フラッシュで全ワーカーのチャンクを集めて1つのマージファイルにする
+#   SO_REUSEPORT が無い環境（Windows など）では使えない。
+# ---------------------------
+WORKER_POLL_SEC = 0.2  # ワーカーがパイプと登録を確認する間隔
+STATUS_INTERVAL = 5.0
+
+
+def reuseport_available():
+    return hasattr(socket, "SO_REUSEPORT")
+
+
+def _bind_shard_socket(port, host="0.0.0.0", rcvbuf=SOCKET_RCVBUF):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    configure_socket(sock, rcvbuf)
+    sock.bind((host, port))
+    sock.settimeout(WORKER_POLL_SEC)
+    return sock
+
+
+def shard_worker(index, conn, port, chunk_timeout, host="0.0.0.0", save_chunks=True, journal=True,
+                 status_interval=STATUS_INTERVAL):
+    """
+    1シャード分のサーバー（子プロセスで動く）。Ctrl+C はコーディネーターが受けて stop を送る。
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from ServerMetrics import ServerMetrics
+    from ServerPipeline import ServerPipeline
+    from SessionJournal import Journal
+
+    sock = _bind_shard_socket(port, host)
+    metrics = ServerMetrics()
+    agent_addrs = {}
+    stored = [0]
+    sink = None
+    if not save_chunks:
+        def sink(agent_id, columns, *_):
+            stored[0] += len(columns["micros24"])
+    wal = Journal(chunk_timeout) if journal else None
+    send_lock = threading.Lock()  # 返事は受信スレッドから送るので、パイプへの書き込みをまとめて守る
+
+    def send(msg):
+        with send_lock:
+            conn.send(msg)
+
+    pipeline = ServerPipeline(sock, agent_addrs, chunk_timeout, receiver=BatchReceiver(sock, timeout=WORKER_POLL_SEC),
+                              chunk_sink=sink, metrics=metrics, journal=wal,
+                              control_sink=lambda data, addr, recv_time: send(("reply", index, data, addr, recv_time)))
+    pipeline.start()
+    send(("ready", index, os.getpid()))
+
+    known = {}
+    next_status = time.time() + status_interval
+    try:
+        while True:
+            if conn.poll(WORKER_POLL_SEC):
+                msg = conn.recv()
+                if msg[0] == "command":
+                    _, text, agent_ids = msg
+                    for agent_id, addr in list(agent_addrs.items()):
+                        if agent_ids is None or agent_id in agent_ids:
+                            sock.sendto(text.encode(), addr)
+                elif msg[0] == "flush":
+                    files, session_journal = pipeline.end_session()
+                    send(("flushed", index, files, session_journal, pipeline.take_failed()))
+                elif msg[0] == "stop":
+                    break
+
+            for agent_id, addr in list(agent_addrs.items()):
+                if known.get(agent_id) != addr:
+                    known[agent_id] = addr
+                    send(("agent", index, agent_id, addr))
+
+            now = time.time()
+            if now >= next_status:
+                send(("status", index, pipeline.status_line()))
+                next_status = now + status_interval
+    finally:
+        pipeline.stop()
+        sock.close()
+        session_journal = wal.close() if wal is not None else None
+        send(("stopped", index, pipeline.take_saved_files(), session_journal, pipeline.take_failed(), stored[0],
+              metrics.snapshot()["counters"]))
+        conn.close()
+
+
+class ShardCoordinator:
+    """
+    ワーカープロセスの起動・登録の集約・コマンドの配布・チャンクの回収。
+    """
+
+    def __init__(self, num_shards, port, chunk_timeout, host="0.0.0.0", save_chunks=True, journal=True,
+                 status_interval=STATUS_INTERVAL):
+        if not reuseport_available():
+            raise RuntimeError("SO_REUSEPORT is not available on this platform; run with SHARDS = 1.")
+        self.num_shards = num_shards
+        self.args = (port, chunk_timeout, host, save_chunks, journal, status_interval)
+        self.agent_addrs = {}  # agent_id -> (シャード番号, addr)
+        self.conns = []
+        self.procs = []
+        self.records_counted = 0  # save_chunks=False のときに数えたレコード数（stop 後）
+        self.counters = []  # シャードごとの最終カウンタ（stop 後）
+        self.on_reply = None  # on_reply(data, addr, recv_time): 予約コマンドへの返事の渡し先（CommandFanout.on_reply）
+
+    def start(self):
+        for index in range(self.num_shards):
+            parent, child = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=shard_worker, args=(index, child) + self.args,
+                                           name=f"shard-{index}", daemon=True)
+            proc.start()
+            child.close()
+            self.conns.append(parent)
+            self.procs.append(proc)
+        for conn in self.conns:
+            self._wait_for(conn, "ready")
+        print(f"[INFO] {self.num_shards} shard workers listening on UDP:{self.args[0]} (SO_REUSEPORT)")
+
+    def attach(self, loop):
+        """
+        ServerLoop にワーカーのパイプを登録し、登録や状態の通知をその場で処理する。
+        """
+        for conn in self.conns:
+            loop.add_reader(conn, lambda conn=conn: self._handle(conn.recv()))
+
+    def _handle(self, msg):
+        kind = msg[0]
+        if kind == "agent":
+            _, index, agent_id, addr = msg
+            self.agent_addrs[agent_id] = (index, addr)
+            print(f"[INFO] Agent {agent_id} registered on shard {index} ({addr[0]}:{addr[1]})")
+        elif kind == "status":
+            _, index, line = msg
+            print(f"[SHARD {index}] " + line.replace("\n", f"\n[SHARD {index}] "))
+        elif kind == "reply" and self.on_reply is not None:
+            _, index, data, addr, recv_time = msg
+            self.on_reply(data, addr, recv_time)
+        return msg
+
+    def _wait_for(self, conn, kind):
+        while True:
+            msg = self._handle(conn.recv())
+            if msg[0] == kind:
+                return msg
+
+    def send_command(self, text, agent_ids=None):
+        for conn in self.conns:
+            conn.send(("command", text, agent_ids))
+
+    def flush(self):
+        """
+        全シャードのチャンクを締めて保存させ、(保存ファイル, [(閉じたジャーナル, そのシャードで保存に失敗したチャンク数)]) を返す。
+        """
+        for conn in self.conns:
+            conn.send(("flush",))
+        files, journals = [], []
+        for conn in self.conns:
+            _, _, shard_files, session_journal, failed = self._wait_for(conn, "flushed")
+            files.extend(shard_files)
+            if session_journal:
+                journals.append((session_journal, failed))
+        return files, journals
+
+    def stop(self):
+        """
+        全シャードを止め、残りのチャンクを保存させて flush() と同じ (保存ファイル, [(ジャーナル, 失敗数)]) を返す。
+        """
+        files, journals = [], []
+        self.records_counted = 0
+        self.counters = []
+        for conn in self.conns:
+            conn.send(("stop",))
+        for conn in self.conns:
+            _, _, shard_files, session_journal, failed, stored, counters = self._wait_for(conn, "stopped")
+            files.extend(shard_files)
+            if session_journal:
+                journals.append((session_journal, failed))
+            self.records_counted += stored
+            self.counters.append(counters)
+        for proc in self.procs:
+            proc.join(timeout=5.0)
+        return files, journals
+
+
+# ---------------------------
+# ベンチマーク（ループバック、シャード数ごとの受信パケット/秒）
+# ---------------------------
+def _load_process(target, num_agents, seconds, first_agent, out):
+    from ServerLoop import _agents
+    result = {}
+    _agents(target, num_agents, seconds, result, first_agent)
+    out.put(result["acked"])
+
+
+def benchmark(shard_counts=(1, 2, 4), senders=4, agents_per_sender=8, seconds=3.0, port=5600):
+    print(f"[BENCH] {os.cpu_count()} CPU(s); load: {senders} processes x {agents_per_sender} stop-and-wait agents, "
+          f"{seconds:g} s per case")
+    base = None
+    for shards in shard_counts:
+        coordinator = ShardCoordinator(shards, port, 60.0, host="127.0.0.1", save_chunks=False, journal=False,
+                                       status_interval=3600.0)
+        coordinator.start()
+        out = multiprocessing.Queue()
+        loads = [multiprocessing.Process(target=_load_process, args=(("127.0.0.1", port), agents_per_sender,
+                                                                      seconds, 1 + i * agents_per_sender, out))
+                 for i in range(senders)]
+        for p in loads:
+            p.start()
+        acked = sum(out.get() for _ in loads)
+        for p in loads:
+            p.join()
+        coordinator.stop()
+        per_shard = [c["packets"] for c in coordinator.counters]
+        rate = acked / seconds
+        base = base or rate
+        print(f"[BENCH] shards={shards}: {rate:8.0f} packets/s acked ({rate / base:.2f}x)  "
+              f"records stored={coordinator.records_counted}  packets per shard={per_shard}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Loopback scaling test of the sharded (SO_REUSEPORT) server.")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--senders", type=int, default=4, help="load generator processes")
+    parser.add_argument("--agents", type=int, default=8, help="stop-and-wait agents per load process")
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--port", type=int, default=5600)
+    args = parser.parse_args()
+    benchmark(args.shards, args.senders, args.agents, args.seconds, args.port)
@@ -0,0 +1,221 @@
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from TimeReconstruction import T_OVERFLOW
+
+# ---------------------------
+# 時刻異常の検出
+#   全 (agent_id, chunk_id) グループを1回のソートと np.diff でまとめて調べる。
+#   差分は各グループ内の行の並び（受信順）で取り、グループ境界をまたぐ差分は捨てる。
+#   検出するもの:
+#     reversals : 前の行より時刻が戻った点（再送・重複など）
+#     jumps     : threshold_sec より大きく進んだ点
+#     overflow  : 2^32 µs（≒ 4294.97 秒）± T_TOL の前進 = micros() 一周の候補
+# ---------------------------
+GROUP_KEYS = ["agent_id", "chunk_id"]
+TIME_COLUMN = "time_pc_sec_abs"
+JUMP_THRESHOLD_SEC = 1.0
+T_TOL = 5.0  # オーバーフロー判定の許容誤差（秒）
+MAX_POSITIONS = 5  # 要約表に載せるオーバーフロー位置の最大数
+
+
+class GroupedTimes:
+    """
+    df の行をグループごとに連続するよう並べた時刻列と、グループ内での差分。
+    order[i] は並べ替え後の i 番目に対応する元の行番号。
+    """
+
+    def __init__(self, df, time_column=TIME_COLUMN):
+        grouped = df.groupby(GROUP_KEYS, sort=True, observed=True)
+        codes = grouped.ngroup().to_numpy()
+        self.keys = grouped.size().index
+        self.num_groups = len(self.keys)
+
+        # ngroup はキーが NaN の行に -1 を返すので除外する
+        valid = np.flatnonzero(codes >= 0)
+        order = valid[np.argsort(codes[valid], kind="stable")]
+        self.order = order
+        self.codes = codes[order]
+        self.times = df[time_column].to_numpy(dtype=np.float64)[order]
+        self.starts = np.searchsorted(self.codes, np.arange(self.num_groups))
+        self.position = np.arange(len(order)) - self.starts[self.codes]
+
+        n = len(order)
+        self.diff = np.full(n, np.nan)
+        if n > 1:
+            d = np.diff(self.times)
+            d[self.codes[1:] != self.codes[:-1]] = np.nan
+            self.diff[1:] = d
+
+    def rows(self):
+        return np.bincount(self.codes, minlength=self.num_groups)
+
+    def bounds(self):
+        """
+        グループごとの (最小時刻, 最大時刻)。
+        """
+        if self.num_groups == 0:
+            return np.empty(0), np.empty(0)
+        return np.minimum.reduceat(self.times, self.starts), np.maximum.reduceat(self.times, self.starts)
+
+    def row_span(self):
+        """
+        グループごとの (最初の行番号, 最後の行番号)。last − first + 1 == 行数 なら連続している。
+        """
+        if self.num_groups == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        ends = np.append(self.starts[1:], len(self.order)) - 1
+        return self.order[self.starts], self.order[ends]
+
+    def count(self, mask):
+        return np.bincount(self.codes[mask], minlength=self.num_groups)
+
+    def extreme(self, mask, ufunc):
+        out = np.full(self.num_groups, np.nan)
+        ufunc.at(out, self.codes[mask], self.diff[mask])
+        return out
+
+    def first_position(self, mask):
+        out = np.full(self.num_groups, -1, dtype=np.int64)
+        hit = np.flatnonzero(mask)
+        groups, first = np.unique(self.codes[hit], return_index=True)
+        out[groups] = self.position[hit[first]]
+        return out
+
+
+def scan_time_anomalies(df, threshold_sec=JUMP_THRESHOLD_SEC, overflow_sec=T_OVERFLOW, tol=T_TOL):
+    """
+    全グループの時刻異常を1パスで数え、(agent_id, chunk_id) ごとの要約表を返す。
+    位置 (first_reversal, first_jump, overflow_positions) はグループ内の行番号（0始まり、無ければ -1）、
+    first_row / last_row は df 全体での行番号。
+    """
+    g = GroupedTimes(df)
+    d = g.diff
+    with np.errstate(invalid="ignore"):
+        reversed_ = d < 0
+        jumps = d > threshold_sec
+        overflow = np.abs(d - overflow_sec) <= tol
+
+    start, end = g.bounds()
+    first_row, last_row = g.row_span()
+    summary = pd.DataFrame({
+        "rows": g.rows(),
+        "start": start,
+        "end": end,
+        "first_row": first_row,
+        "last_row": last_row,
+        "reversals": g.count(reversed_),
+        "worst_reversal": g.extreme(reversed_, np.fmin),
+        "first_reversal": g.first_position(reversed_),
+        "jumps": g.count(jumps),
+        "max_jump": g.extreme(jumps, np.fmax),
+        "first_jump": g.first_position(jumps),
+        "overflow": g.count(overflow),
+    }, index=g.keys)
+
+    positions = [()] * g.num_groups
+    hit = np.flatnonzero(overflow)
+    for code in np.unique(g.codes[hit]):
+        in_group = hit[g.codes[hit] == code]
+        positions[code] = tuple(int(p) for p in g.position[in_group[:MAX_POSITIONS]])
+    summary["overflow_positions"] = positions
+    return summary
+
+
+def anomalous_groups(summary):
+    """
+    何らかの異常があるグループだけの要約表。
+    """
+    return summary[(summary["reversals"] > 0) | (summary["jumps"] > 0) | (summary["overflow"] > 0)]
+
+
+def format_anomaly_summary(summary, threshold_sec=JUMP_THRESHOLD_SEC):
+    bad = anomalous_groups(summary)
+    if bad.empty:
+        return f"[INFO] No time anomalies in {len(summary)} chunks."
+    shown = bad.drop(columns=["start", "end", "first_row", "last_row"]).reset_index()
+    header = (f"[WARN] Time anomalies in {len(bad)} of {len(summary)} chunks "
+              f"(reversed {int(bad['reversals'].sum())}, jumps > {threshold_sec:.1f}s {int(bad['jumps'].sum())}, "
+              f"overflow candidates {int(bad['overflow'].sum())}):")
+    return header + "\n" + shown.to_string(index=False, float_format=lambda x: f"{x:.6f}")
+
+
+def correct_overflow_jumps(df, threshold_sec=T_OVERFLOW - T_TOL, jump_sec=T_OVERFLOW):
+    """
+    全グループについて、前の行から threshold_sec より大きく進んだ位置以降を jump_sec ずつ戻す。
+    （グループごとに TimeReconstruction.remove_forward_jumps を掛けたのと同じ結果）
+    (補正後の df, ジャンプした行のインデックスラベル) を返す。行の並びは変えない。
+    """
+    g = GroupedTimes(df)
+    with np.errstate(invalid="ignore"):
+        jumps = g.diff > threshold_sec
+    if not jumps.any():
+        return df, df.index[:0]
+
+    # グループ先頭の diff は NaN なので、累積和からグループ先頭の値を引けばグループ内の累積になる
+    total = np.cumsum(jumps)
+    within = total - total[g.starts[g.codes]]
+    times = df[TIME_COLUMN].to_numpy(dtype=np.float64).copy()
+    times[g.order] = g.times - within * jump_sec
+
+    df = df.copy()
+    df[TIME_COLUMN] = times
+    return df, df.index[g.order[jumps]]
+
+
+def chunk_start_times(df):
+    """
+    チャンクごとの開始時刻（Series, index = (agent_id, chunk_id)）と、各行のグループ番号。
+    """
+    g = GroupedTimes(df)
+    start, _ = g.bounds()
+    codes = np.full(len(df), -1, dtype=np.int64)
+    codes[g.order] = g.codes
+    return pd.Series(start, index=g.keys, name="start"), codes
+
+
+# ---------------------------
+# ベンチマーク（merged_chunks の実データ）
+# ---------------------------
+def _loop_scan(df, threshold_sec=JUMP_THRESHOLD_SEC):
+    # Plotter.detect_time_anomalies の従来実装から print を除いたもの
+    found = 0
+    for _, sub in df.groupby(GROUP_KEYS):
+        sub = sub.sort_values(TIME_COLUMN).reset_index(drop=True)
+        time_diff = sub[TIME_COLUMN].diff().fillna(0)
+        found += len(sub[time_diff < 0]) + len(sub.index[time_diff > threshold_sec])
+    return found
+
+
+def benchmark(files):
+    from ChunkStorage import load_chunk_file
+
+    dfs = [load_chunk_file(p, columns=GROUP_KEYS + [TIME_COLUMN]) for p in files]
+    df = pd.concat(dfs, ignore_index=True)
+    groups = df.groupby(GROUP_KEYS).ngroups
+
+    t0 = time.perf_counter()
+    _loop_scan(df)
+    t_loop = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    summary = scan_time_anomalies(df)
+    t_vec = time.perf_counter() - t0
+
+    print(format_anomaly_summary(summary))
+    print(f"[BENCH] {len(files)} files, {len(df)} rows, {groups} chunks")
+    print(f"[BENCH] per-group loop {t_loop * 1e3:9.1f} ms  one-pass scan {t_vec * 1e3:7.1f} ms  "
+          f"(x{t_loop / max(t_vec, 1e-12):.0f})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scan merged files for time anomalies and benchmark the scan.")
+    parser.add_argument("directory", nargs="?", default="merged_chunks")
+    parser.add_argument("--files", type=int, default=20, help="number of newest files to use")
+    args = parser.parse_args()
+    paths = sorted(p for p in glob.glob(os.path.join(args.directory, "*.csv")) if os.path.getsize(p) > 1)
+    benchmark(paths[-args.files:])
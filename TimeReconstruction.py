@@ -0,0 +1,89 @@
+import numpy as np
+
+# ---------------------------
+# タイムスタンプ再構成
+#   Pico は micros() >> 8 の下位24ビット (micros24) を記録する。
+#   ここでは 24ビットの折り返し展開、ローカル時刻・PC時刻への変換、
+#   2^32 µs オーバーフローで未来に飛んだ時刻の補正を NumPy でまとめて行う。
+# ---------------------------
+MICROS24_WRAP = 1 << 24              # 16777216
+MICROS_SHIFT = 8                     # micros24 = micros >> 8
+T_OVERFLOW = 2**32 / 1e6             # micros() の一周 ≒ 4294.967296 秒
+
+
+def unwrap_micros24(micros24):
+    """
+    24ビットカウンタの折り返し（値が前より小さくなった所）ごとに 2^24 を足して単調化する。
+    """
+    m = np.asarray(micros24, dtype=np.int64)
+    if len(m) == 0:
+        return m
+    wraps = np.empty(len(m), dtype=np.int64)
+    wraps[0] = 0
+    np.cumsum(m[1:] < m[:-1], out=wraps[1:])
+    return m + wraps * MICROS24_WRAP
+
+
+def micros_to_local_sec(micros32):
+    """
+    展開済みカウンタから (micros32_raw, time_local_sec) を返す。
+    """
+    micros32_raw = np.asarray(micros32, dtype=np.int64) << MICROS_SHIFT
+    return micros32_raw, micros32_raw / 1e6
+
+
+def wrapped_send_seconds(send_micros):
+    """
+    送信時刻 (32ビット micros) を記録側と同じ24ビット折り返しの秒に変換する。
+    """
+    s = np.asarray(send_micros, dtype=np.int64)
+    return (((s >> MICROS_SHIFT) % MICROS24_WRAP) << MICROS_SHIFT) / 1e6
+
+
+def mean_clock_offset(send_micros, recv_times):
+    """
+    PC受信時刻 − 送信時刻 の平均（秒）。
+    """
+    offsets = np.asarray(recv_times, dtype=np.float64) - wrapped_send_seconds(send_micros)
+    return float(offsets.mean())
+
+
+def reconstruct_chunk_times(micros24, offset):
+    """
+    チャンクの micros24 列から micros32 / micros32_raw / time_local_sec / time_pc_sec_abs を作る。
+    """
+    micros32 = unwrap_micros24(micros24)
+    micros32_raw, time_local_sec = micros_to_local_sec(micros32)
+    return {
+        "micros32": micros32,
+        "micros32_raw": micros32_raw,
+        "time_local_sec": time_local_sec,
+        "time_pc_sec_abs": time_local_sec + offset,
+    }
+
+
+def remove_forward_jumps(times, threshold_sec, jump_sec):
+    """
+    前サンプルから threshold_sec より大きく進んだ位置以降を jump_sec ずつ戻す。
+    (補正後の時刻, ジャンプ位置の配列) を返す。ジャンプ判定は補正前の差分で行う。
+    """
+    t = np.asarray(times, dtype=np.float64)
+    if len(t) < 2:
+        return t.copy(), np.empty(0, dtype=np.int64)
+    jumps = np.diff(t) > threshold_sec
+    positions = np.flatnonzero(jumps) + 1
+    if len(positions) == 0:
+        return t.copy(), positions
+    shift = np.zeros(len(t), dtype=np.float64)
+    shift[1:] = np.cumsum(jumps) * jump_sec
+    return t - shift, positions
+
+
+def future_chunk_mask(chunk_starts, threshold_sec):
+    """
+    各チャンク開始時刻が全チャンクの中央値より threshold_sec 以上未来にあるかを返す。
+    """
+    starts = np.asarray(chunk_starts, dtype=np.float64)
+    if len(starts) == 0:
+        return np.zeros(0, dtype=bool)
+    return starts - np.median(starts) > threshold_sec
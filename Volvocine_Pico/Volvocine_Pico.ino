@@ -52,6 +52,12 @@ unsigned long startLoggingMillis = 0;
 unsigned long startLoggingMicros = 0;
 float t_delay;
 
+// 予約された START/STOP（サーバーの START_AT:<micros> / STOP_AT:<micros>、ScheduledControl.py）
+bool startScheduled = false;
+bool stopScheduled = false;
+unsigned long scheduledStartMicros = 0;
+unsigned long scheduledStopMicros = 0;
+
 unsigned long prevLoopEndTime = 0;
 unsigned long prevLoopEndTime2 = 0;
 float phi = 0;
@@ -328,26 +334,81 @@ void setup() {
   Serial.println("[INFO] System is paused. Press the button to start.");
 }
 
+// 記録開始（START / 予約した START_AT の時刻）
+void startLogging() {
+  paused = false;
+  startScheduled = false;
+  startLoggingMillis = millis(); // ログ開始時刻を記録
+  startLoggingMicros = micros(); // ログ開始時刻を記録
+  t_delay = (rand() / (float)RAND_MAX) * wait_max;
+  startLoggingMicros += (unsigned long)(t_delay * 1e6f);
+}
+
+// 記録停止とログ送信（STOP / 予約した STOP_AT の時刻）
+void stopLogging() {
+  paused = true;
+  stopScheduled = false;
+  sendLogBuffer();
+  logIndex = 0;
+  kappa_now = kappa_init;
+}
+
+// 予約コマンドへの返事（送ってきたアドレスへ、受信した時点の micros() を添えて返す）
+void replyControl(const char* reply) {
+  udp.beginPacket(udp.remoteIP(), udp.remotePort());
+  udp.write((const uint8_t*)reply, strlen(reply));
+  udp.endPacket();
+}
+
 // UDPコマンド受信処理
 void checkControlCommand() {
   int packetSize = udp.parsePacket();
   if (packetSize > 0) {
-    char buf[16] = {0};
+    unsigned long rxMicros = micros();
+    char buf[32] = {0};
+    char reply[64];
+    unsigned long value = 0;
     udp.read(buf, sizeof(buf) - 1);
     if (strcmp(buf, "START") == 0 && paused == true) {
-      paused = false;
-      startLoggingMillis = millis(); // ログ開始時刻を記録
-      startLoggingMicros = micros(); // ログ開始時刻を記録
       Serial.println("[INFO] Received START command from server.");
-      t_delay = (rand() / (float)RAND_MAX) * wait_max;
-      startLoggingMicros += (unsigned long)(t_delay * 1e6f);
+      startLogging();
     } else if (strcmp(buf, "STOP") == 0 && paused == false) {
-      paused = true;
       Serial.println("[INFO] Received STOP command from server.");
-      sendLogBuffer();
-      logIndex = 0;
-      kappa_now = kappa_init;
+      stopLogging();
+    } else if (sscanf(buf, "SYNC:%lu", &value) == 1) {
+      snprintf(reply, sizeof(reply), "SYNC:%d:%lu:%lu", agent_id, value, rxMicros);
+      replyControl(reply);
+    } else if (sscanf(buf, "START_AT:%lu", &value) == 1) {
+      snprintf(reply, sizeof(reply), "ACK:START_AT:%d:%lu:%lu", agent_id, value, rxMicros);
+      replyControl(reply);
+      if (paused) {  // 再送で届いた値でも上書きしてよい（1 μs しか違わない）
+        startScheduled = true;
+        scheduledStartMicros = value;
+      }
+    } else if (sscanf(buf, "STOP_AT:%lu", &value) == 1) {
+      snprintf(reply, sizeof(reply), "ACK:STOP_AT:%d:%lu:%lu", agent_id, value, rxMicros);
+      replyControl(reply);
+      if (!paused) {
+        stopScheduled = true;
+        scheduledStopMicros = value;
+      }
+    }
+  }
+
+  // 予約した時刻になったら切り替える（micros() の折り返しをまたいでも差の符号で判定できる）
+  if (startScheduled && (long)(micros() - scheduledStartMicros) >= 0) {
+    if (paused) {
+      Serial.println("[INFO] Scheduled START.");
+      startLogging();
+    }
+    startScheduled = false;
+  }
+  if (stopScheduled && (long)(micros() - scheduledStopMicros) >= 0) {
+    if (!paused) {
+      Serial.println("[INFO] Scheduled STOP.");
+      stopLogging();
     }
+    stopScheduled = false;
   }
 }
 
@@ -413,8 +474,8 @@ void loop() {
   }
   lastButtonState = currentButtonState;
 
-  // ポーズ中に一定間隔でパラメータをリクエスト
-  if (paused && millis() - lastRequestTime >= 10000) {
+  // ポーズ中に一定間隔でパラメータをリクエスト（START を予約中は応答待ちで開始が遅れないよう後回し）
+  if (paused && !startScheduled && millis() - lastRequestTime >= 10000) {
     while (WiFi.status() != WL_CONNECTED) {
       connectToWiFi(ssid, password);
     }
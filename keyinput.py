@@ -18,21 +18,26 @@ else:
     import termios
 
     # ファイルディスクリプタと元の端末設定を保存
-    fd = sys.stdin.fileno()
-    old_settings = termios.tcgetattr(fd)
+    # 端末が無い（サービス・パイプ・nohup など）ときは何もしない。check_key() は常に None を返す
+    fd = None
+    if sys.stdin is not None and sys.stdin.isatty():
+        fd = sys.stdin.fileno()
+        old_settings = termios.tcgetattr(fd)
 
-    # 一度だけ cbreak モードに切り替え
-    tty.setcbreak(fd)
+        # 一度だけ cbreak モードに切り替え
+        tty.setcbreak(fd)
 
-    def restore_terminal():
-        """終了時に元の端末設定へ戻す"""
-        termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
+        def restore_terminal():
+            """終了時に元の端末設定へ戻す"""
+            termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
 
-    # プログラム終了時（例: Ctrl+C）に復元
-    atexit.register(restore_terminal)
+        # プログラム終了時（例: Ctrl+C）に復元
+        atexit.register(restore_terminal)
 
     def check_key():
         """Linux: タイムアウト付きでキー入力を検出"""
+        if fd is None:
+            return None
         dr, _, _ = select.select([sys.stdin], [], [], 0.05)
         if dr:
             return sys.stdin.read(1)
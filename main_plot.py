@@ -1,5 +1,6 @@
 import os
 from Plotter import plot_chunks, plot_relativePhase
+from SessionIndex import nth_latest_file, describe_entry, find_runs
 
 def plot_nth_latest_file_in_merged_chunks(n, directory="merged_chunks"):
     # ディレクトリが存在するか確認
@@ -7,26 +8,31 @@ def plot_nth_latest_file_in_merged_chunks(n, directory="merged_chunks"):
         print(f"[ERROR] Directory not found: {directory}")
         return
 
-    # ディレクトリ内のCSVファイルを取得
-    csv_files = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".csv")]
-    if not csv_files:
-        print(f"[INFO] No CSV files found in directory: {directory}")
+    # セッションインデックスから新しい順に n 番目を引く（変化のないファイルは開かない）
+    entry = nth_latest_file(n, directory)
+    if entry is None:
+        print(f"[ERROR] Invalid value for n: {n}, or no data files found in directory: {directory}")
         return
 
-    # ファイル名でソート（逆順）
-    csv_files.sort(key=lambda f: os.path.basename(f), reverse=True)
-
-    # n番目のファイルを取得
-    if n > len(csv_files) or n < 1:
-        print(f"[ERROR] Invalid value for n: {n}. There are only {len(csv_files)} files.")
-        return
-
-    nth_file = csv_files[n - 1]
-    print(f"[INFO] {n}th latest file found: {nth_file}")
+    nth_file = entry["path"]
+    print(f"[INFO] {n}th latest file found: {describe_entry(entry)}")
 
     # プロット関数を呼び出し
     plot_relativePhase(nth_file)
 
+def plot_runs_with_agent(agent_id, start=None, end=None, directory="merged_chunks"):
+    """
+    agent_id を含み、[start, end] と重なる実験をインデックスで探して順にプロットする。
+    start / end は UNIX 秒または "2025-06-09 18:00" のような ISO 形式。
+    """
+    runs = find_runs(agent_id, start, end, directory)
+    if runs.empty:
+        print(f"[INFO] No runs with agent {agent_id} in the given range.")
+        return
+    for _, entry in runs.iterrows():
+        print(f"[INFO] {describe_entry(entry)}")
+        plot_relativePhase(entry["path"])
+
 if __name__ == "__main__":
     # ファイル選択モードを有効にするかどうか
     select_file_mode = False  # Trueなら選択モード、Falseなら最新ファイルをプロット
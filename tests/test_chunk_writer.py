@@ -0,0 +1,71 @@
+import threading
+import time
+
+from ChunkScheduler import ChunkWriterPool
+from ServerLoop import ServerLoop
+
+
+def _slow_save(delays, stamps):
+    def save(agent_id, columns, send_list, recv_list, clock, chunk_time):
+        time.sleep(delays[agent_id])
+        stamps[agent_id] = chunk_time
+        return f"chunk_{agent_id}"
+    return save
+
+
+def test_saved_files_in_seal_order_with_seal_time():
+    delays = {1: 0.2, 2: 0.0, 3: 0.1, 4: 0.0}
+    stamps = {}
+    pool = ChunkWriterPool(_slow_save(delays, stamps), workers=4)
+    sealed = {}
+    for agent_id in delays:
+        sealed[agent_id] = time.time()
+        pool.submit(agent_id, {}, [], [])
+    pool.wait()
+    assert pool.take_saved_files() == ["chunk_1", "chunk_2", "chunk_3", "chunk_4"]
+    for agent_id, t in sealed.items():
+        assert abs(stamps[agent_id].timestamp() - t) < 0.05  # 書き終わった時刻ではなく締めた時刻
+    pool.close()
+
+
+def test_after_written_merges_each_session_separately():
+    delays = {1: 0.2, 2: 0.0, 3: 0.0}
+    pool = ChunkWriterPool(_slow_save(delays, {}), workers=3)
+    merged = []
+    pool.submit(1, {}, [], [])
+    pool.after_written(lambda files, failed: merged.append(files))
+    pool.submit(2, {}, [], [])
+    pool.submit(3, {}, [], [])
+    pool.after_written(lambda files, failed: merged.append(files))
+    pool.close()
+    assert sorted(merged) == [["chunk_1"], ["chunk_2", "chunk_3"]]
+
+
+def test_call_soon_threadsafe_runs_on_loop_thread():
+    loop = ServerLoop(lambda key: None, keyboard=False, control_port=None)
+    ran = []
+    loop.call_later(5.0, loop.stop)  # 起こされなければ5秒で止まる
+    threading.Timer(0.05, lambda: loop.call_soon_threadsafe(
+        lambda: (ran.append(threading.current_thread()), loop.stop()))).start()
+    t0 = time.monotonic()
+    loop.run()
+    loop.close()
+    assert ran == [threading.main_thread()]
+    assert time.monotonic() - t0 < 1.0
+
+
+def test_merges_run_one_at_a_time():
+    pool = ChunkWriterPool(_slow_save({1: 0.0, 2: 0.0}, {}), workers=2)
+    active, overlaps = [], []
+
+    def merge(files, failed):
+        active.append(files)
+        overlaps.append(len(active))
+        time.sleep(0.05)
+        active.remove(files)
+
+    for agent_id in (1, 2):
+        pool.submit(agent_id, {}, [], [])
+        pool.after_written(merge)
+    pool.close()
+    assert overlaps == [1, 1]
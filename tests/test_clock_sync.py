@@ -0,0 +1,92 @@
+import numpy as np
+
+import ChunkProcessor
+from ClockSync import SEND_PERIOD_SEC, BootSequence, ClockSyncEstimator, simulate_session
+from TimeReconstruction import mean_clock_offset, reconstruct_chunk_times
+
+
+def _feed(clock, chunk):
+    _, _, send_micros, recv = chunk
+    for s, r in zip(send_micros, recv):
+        clock.update(int(s), float(r))
+
+
+def _retime_error(clock, chunk):
+    rec_micros24, true_pc, _, _ = chunk
+    local = reconstruct_chunk_times(rec_micros24, 0.0)["time_local_sec"]
+    return np.abs(clock.retime(local) - true_pc).max()
+
+
+def _rebooted_session():
+    """
+    4チャンク送ったあと Pico が再起動し、micros() が 0 から数え直した2つ目の起動のチャンク。
+    """
+    before = simulate_session(num_chunks=4, seed=0)
+    after = simulate_session(num_chunks=2, seed=1)
+    shift = before[-1][3][-1] - after[0][3][0] + 30.0  # 30 秒後に起動し直して送り始める
+    after = [(m, true_pc + shift, s, recv + shift) for m, true_pc, s, recv in after]
+    return before, after
+
+
+def test_reboot_restarts_clock_sync():
+    before, after = _rebooted_session()
+    clock = ClockSyncEstimator()
+    for chunk in before:
+        _feed(clock, chunk)
+    assert _retime_error(clock, before[-1]) < 0.01
+
+    fresh = ClockSyncEstimator()
+    for chunk in after:
+        _feed(clock, chunk)
+        _feed(fresh, chunk)
+        # 以前は 2つの起動を混ぜて数百秒ずれていた。やり直した後は新しい推定器と同じ結果になる
+        local = reconstruct_chunk_times(chunk[0], 0.0)["time_local_sec"]
+        assert np.array_equal(clock.retime(local), fresh.retime(local))
+        assert _retime_error(clock, chunk) < 0.05
+    assert clock.resets == 1
+
+
+def test_long_session_crosses_send_wrap_without_reset():
+    chunks = simulate_session(num_chunks=16, seed=2)
+    assert chunks[-1][3][-1] - chunks[0][3][0] > SEND_PERIOD_SEC  # micros() が一周する
+    clock = ClockSyncEstimator()
+    for chunk in chunks:
+        _feed(clock, chunk)
+    assert clock.resets == 0
+    assert _retime_error(clock, chunks[-1]) < 0.01
+
+
+def test_boot_sequence():
+    boots = BootSequence()
+    pico = ("192.168.13.20", 4210)
+    assert not boots.params_request(pico)  # ポーズ中の定期的な要求
+
+    boots.hello(pico)  # 起動: HELLO → REQUEST_PARAMS
+    assert boots.params_request(pico)
+    assert not boots.params_request(pico)
+
+    boots.hello(pico)  # 送信: HELLO → ログ → ... → REQUEST_PARAMS
+    boots.log_packet(pico)
+    assert not boots.params_request(pico)
+
+
+def test_chunk_falls_back_to_mean_offset_for_a_stale_clock(tmp_path, monkeypatch):
+    monkeypatch.setattr(ChunkProcessor, "SAVE_FOLDER", str(tmp_path))
+    before, after = _rebooted_session()
+    stale = ClockSyncEstimator()
+    for chunk in before:
+        _feed(stale, chunk)
+
+    rec_micros24, true_pc, send_micros, recv = after[0]
+    n = len(rec_micros24)
+    columns = {"micros24": rec_micros24.astype(np.uint32), "a0": np.zeros(n, np.uint8),
+               "a1": np.zeros(n, np.uint8), "a2": np.zeros(n, np.uint8)}
+    df, _ = ChunkProcessor.build_dataframe_for_chunk(3, columns, send_micros.tolist(), recv.tolist(), clock=stale)
+    expected = reconstruct_chunk_times(rec_micros24, mean_clock_offset(send_micros, recv))["time_pc_sec_abs"]
+    assert np.array_equal(df["time_pc_sec_abs"].to_numpy(), expected)
+    assert np.abs(df["time_pc_sec_abs"].to_numpy() - true_pc).max() < 0.2
+
+    fresh = ClockSyncEstimator()
+    _feed(fresh, after[0])
+    df, _ = ChunkProcessor.build_dataframe_for_chunk(3, columns, send_micros.tolist(), recv.tolist(), clock=fresh)
+    assert np.abs(df["time_pc_sec_abs"].to_numpy() - true_pc).max() < 0.05
@@ -0,0 +1,78 @@
+import struct
+
+import numpy as np
+import pytest
+
+from PacketDecoder import AgentChunkBuffer, build_ack, decode_records, last_micros24, parse_header
+
+STRUCT_FORMAT = "<6B"
+RECORD_SIZE = struct.calcsize(STRUCT_FORMAT)
+
+
+# ---------------------------
+# 従来実装（ServerTest.main の受信ループ）
+# ---------------------------
+def _loop_decode(data):
+    agent_id = data[0]
+    send_micros = struct.unpack("<I", data[1:5])[0]
+    raw = data[5:]
+    chunk_data = []
+    for i in range(len(raw) // RECORD_SIZE):
+        b0, b1, b2, a0, a1, a2 = struct.unpack(STRUCT_FORMAT, raw[i * RECORD_SIZE:(i + 1) * RECORD_SIZE])
+        chunk_data.append(((b0 | (b1 << 8) | (b2 << 16)) & 0xFFFFFF, a0, a1, a2))
+    return agent_id, send_micros, chunk_data
+
+
+def _loop_ack(data):
+    b0, b1, b2, *_ = struct.unpack(STRUCT_FORMAT, data[-RECORD_SIZE:])
+    ack = bytearray()
+    ack.append(data[0])
+    ack += (b0 | (b1 << 8) | (b2 << 16)).to_bytes(3, "little")
+    return bytes(ack)
+
+
+def _packet(agent_id, send_micros, records):
+    return bytes([agent_id]) + struct.pack("<I", send_micros) + b"".join(
+        bytes([m & 0xFF, (m >> 8) & 0xFF, (m >> 16) & 0xFF, a0, a1, a2]) for m, a0, a1, a2 in records)
+
+
+def _random_packets(seed=0, count=20):
+    rng = np.random.default_rng(seed)
+    packets = []
+    micros = 0xFFFF00  # 24ビットの折り返し直前から始める
+    for k in range(count):
+        n = int(rng.integers(1, 84))
+        records = []
+        for _ in range(n):
+            micros = (micros + int(rng.integers(30, 50))) & 0xFFFFFF
+            records.append((micros, *(int(v) for v in rng.integers(0, 256, 3))))
+        packets.append(_packet(7, (0xFFFFF000 + k * 40000) & 0xFFFFFFFF, records))
+    return packets
+
+
+def test_decode_matches_struct_loop():
+    buf = AgentChunkBuffer(capacity=16)  # 途中で拡張させる
+    expected, sends = [], []
+    for data in _random_packets():
+        agent_id, send_micros, ref = _loop_decode(data)
+        assert parse_header(data) == (agent_id, send_micros)
+        buf.append_records(decode_records(data), send_micros, 1.0)
+        expected.extend(ref)
+        sends.append(send_micros)
+
+    cols = buf.columns()
+    got = list(zip(cols["micros24"].tolist(), cols["a0"].tolist(), cols["a1"].tolist(), cols["a2"].tolist()))
+    assert got == expected
+    assert buf.send_micros == sends
+    assert (np.diff(cols["micros24"].astype(np.int64)) < 0).any()  # 24ビットの折り返しを含む
+
+
+def test_ack_matches_struct_loop():
+    for data in _random_packets(seed=1):
+        assert build_ack(data[0], last_micros24(data)) == _loop_ack(data)
+
+
+def test_decode_rejects_partial_record():
+    data = _random_packets(count=1)[0]
+    with pytest.raises(ValueError):
+        decode_records(data + b"\x00")
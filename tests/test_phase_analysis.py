@@ -0,0 +1,41 @@
+import numpy as np
+
+from PhaseAnalysis import _loop_relative, _loop_unwrap, relative_phase_radians, unwrap_phase_counts
+
+
+def _phase_counts(seed, n=5000, speed=3.0):
+    # a0 と同じ 0..255 の量子化位相（速さの違う2つの振動子と、半周期近い跳びを含む）
+    rng = np.random.default_rng(seed)
+    steps = speed + rng.normal(0, 1.5, n)
+    steps[rng.integers(0, n, 20)] = rng.choice([-127, 127, -129, 129], 20)
+    return np.round(np.cumsum(steps)).astype(np.int64) % 256
+
+
+def test_unwrap_matches_loop():
+    for seed in range(5):
+        a0 = _phase_counts(seed)
+        got = unwrap_phase_counts(a0)
+        assert np.array_equal(got, _loop_unwrap(a0))
+        assert np.abs(np.diff(got)).max() <= 128
+
+
+def test_unwrap_edge_cases():
+    for a0 in (np.array([], dtype=np.int64), np.array([5]), np.array([255, 0, 255, 0]), np.array([0, 128, 0, 129])):
+        assert np.array_equal(unwrap_phase_counts(a0), _loop_unwrap(a0))
+
+
+def test_unwrap_uint8_input():
+    # SessionLoader / LiveMonitor は a0 を uint8 で渡す
+    assert np.array_equal(unwrap_phase_counts(np.array([250, 5], dtype=np.uint8)), [250, 261])
+    a0 = _phase_counts(1)
+    assert np.array_equal(unwrap_phase_counts(a0.astype(np.uint8)), unwrap_phase_counts(a0))
+
+
+def test_relative_phase_matches_loop():
+    base = unwrap_phase_counts(_phase_counts(10)).astype(np.float64)
+    for seed in range(3):
+        phase = unwrap_phase_counts(_phase_counts(seed, speed=3.2)).astype(np.float64)
+        got = relative_phase_radians(phase, base)
+        ref = _loop_relative(phase, base)
+        assert np.isnan(got).any()  # 折り返し点を含む
+        assert np.array_equal(got, ref, equal_nan=True)
@@ -0,0 +1,86 @@
+import numpy as np
+
+from LoadGenerator import build_log_packet
+from PacketDecoder import AgentChunkBuffer, decode_records
+from RetransmitFilter import DEDUP_WINDOW, RetransmitFilter, packet_key
+
+RECORDS = 84
+STEP_MICROS = 10000
+
+
+def _session(seed=0, num_packets=60, num_agents=3, dup_rate=0.3):
+    """
+    (元のパケット列, ACK が落ちて send_micros だけ違う再送を混ぜた受信列)。
+    """
+    rng = np.random.default_rng(seed)
+    originals, received = [], []
+    t = np.zeros(num_agents, dtype=np.int64)
+    for i in range(num_packets):
+        agent_id = i % num_agents + 1
+        micros = (t[agent_id - 1] + np.arange(RECORDS) * STEP_MICROS) & 0xFFFFFF  # 約17秒ごとに一周する
+        t[agent_id - 1] += RECORDS * STEP_MICROS
+        a = rng.integers(0, 256, (3, RECORDS), dtype=np.uint8)
+        data = build_log_packet(agent_id, i * 977, micros, *a)
+        originals.append(data)
+        received.append(data)
+        while rng.random() < dup_rate:
+            received.append(build_log_packet(agent_id, i * 977 + 1100000, micros, *a))
+    return originals, received
+
+
+def _stored(packets, f=None):
+    buffers = {}
+    for i, data in enumerate(packets):
+        if f is not None:
+            if f.check(data, float(i)) is not None:
+                continue
+            f.add(data, float(i))
+        buf = buffers.setdefault(data[0], AgentChunkBuffer(capacity=16))
+        buf.append_records(decode_records(data), 0, float(i))
+    return {agent_id: buf.columns() for agent_id, buf in buffers.items()}
+
+
+def test_filtered_stream_matches_stream_without_retransmits():
+    originals, received = _session()
+    assert len(received) > len(originals)
+    f = RetransmitFilter()
+    got = _stored(received, f)
+    want = _stored(originals)
+    assert got.keys() == want.keys()
+    for agent_id in want:
+        for name, values in want[agent_id].items():
+            np.testing.assert_array_equal(got[agent_id][name], values)
+    assert f.total() == len(received) - len(originals)
+
+
+def test_packet_key_matches_decoded_records():
+    originals, _ = _session(num_packets=5)
+    for data in originals:
+        m = decode_records(data)["micros"].astype(np.uint32)
+        micros24 = m[:, 0] | (m[:, 1] << 8) | (m[:, 2] << 16)
+        assert packet_key(data) == (micros24[0], micros24[-1], len(micros24))
+
+
+def test_key_collision_after_wrap_is_accepted():
+    # micros24 が一周して同じキーになってもペイロードが違えば新しいパケット
+    micros = np.arange(RECORDS) * STEP_MICROS
+    first = build_log_packet(1, 0, micros, np.zeros(RECORDS), np.zeros(RECORDS), np.zeros(RECORDS))
+    later = build_log_packet(1, 16777216, micros, np.ones(RECORDS), np.zeros(RECORDS), np.zeros(RECORDS))
+    assert packet_key(first) == packet_key(later)
+    f = RetransmitFilter()
+    f.add(first, 0.0)
+    assert f.check(later, 16.8) is None
+    assert f.total() == 0
+
+
+def test_retransmit_gap_and_window():
+    originals, _ = _session(num_packets=DEDUP_WINDOW + 2, num_agents=1, dup_rate=0.0)
+    f = RetransmitFilter()
+    for i, data in enumerate(originals):
+        f.add(data, float(i))
+    resend = bytes(originals[-1][:1]) + b"\xff\xff\xff\xff" + originals[-1][5:]
+    assert f.check(resend, 20.5) == 20.5 - (len(originals) - 1)
+    assert f.suppressed[1] == 1
+    # 窓から外れた古いパケットはもう覚えていない
+    assert f.check(originals[0], 30.0) is None
+    assert f.check(originals[len(originals) - DEDUP_WINDOW], 30.0) is not None
@@ -0,0 +1,102 @@
+import os
+import threading
+
+import numpy as np
+
+from ChunkProcessor import merge_and_save_chunks
+from ChunkScheduler import ChunkWriterPool
+from LoadGenerator import build_log_packet
+from SessionJournal import Journal, finish_session, read_journal, rebuild_chunks
+
+RECORDS = 84
+
+
+def _packets(num_packets=40, num_agents=2, seed=0):
+    rng = np.random.default_rng(seed)
+    packets = []
+    for i in range(num_packets):
+        agent_id = i % num_agents + 1
+        micros = (i // num_agents * RECORDS + np.arange(RECORDS)) * 10000 & 0xFFFFFF
+        a = rng.integers(0, 256, (3, RECORDS), dtype=np.uint8)
+        packets.append((100.0 + i * 0.1, build_log_packet(agent_id, i * 977, micros, *a)))
+    return packets
+
+
+def test_round_trip_and_torn_tail(tmp_path):
+    packets = _packets()
+    journal = Journal(5.0, folder=str(tmp_path), fsync_interval=0)
+    for recv_time, data in packets:
+        assert journal.append(data, recv_time)
+    path = journal.close()
+    with open(path, "ab") as f:
+        f.write(b"\x01\x00\x00")  # 書きかけのレコード
+
+    _, chunk_timeout, entries = read_journal(path)
+    assert chunk_timeout == 5.0
+    assert entries == packets
+
+
+def test_rejected_packet_is_not_written(tmp_path):
+    journal = Journal(5.0, folder=str(tmp_path), fsync_interval=0)
+    (t0, first), (t1, second) = _packets(2)
+    assert journal.append(first, t0, lambda: True)
+    assert not journal.append(second, t1, lambda: False)  # デコードキューが満杯だった
+    assert read_journal(journal.close())[2] == [(t0, first)]
+
+
+def test_rotate_boundary_matches_queue(tmp_path):
+    # 受信スレッドが追記している最中に rotate しても、前のファイルの中身は区切りより前にキューへ積んだパケットと一致する
+    packets = _packets(2000)
+    journal = Journal(5.0, folder=str(tmp_path), fsync_interval=0)
+    queued, boundaries = [], []
+
+    def rx():
+        for recv_time, data in packets:
+            journal.append(data, recv_time, lambda: queued.append(data) or True)
+
+    t = threading.Thread(target=rx)
+    t.start()
+    paths = []
+    while t.is_alive() and len(paths) < 5:
+        paths.append(journal.rotate(lambda: boundaries.append(len(queued))))
+    t.join()
+    paths.append(journal.close())
+
+    bounds = [0] + boundaries + [len(queued)]
+    for path, start, end in zip(paths, bounds, bounds[1:]):
+        assert [data for _, data in read_journal(path)[2]] == queued[start:end]
+
+
+def test_rebuild_drops_retransmits_and_keeps_records(tmp_path):
+    packets = _packets()
+    resent = packets[:5] + [(packets[4][0] + 1.0, packets[4][1][:1] + b"\0\0\0\0" + packets[4][1][5:])] + packets[5:]
+    chunks = rebuild_chunks(resent, 5.0, lambda agent_id, columns, *_: (agent_id, columns))
+
+    for agent_id in (1, 2):
+        got = np.concatenate([c["a0"] for a, c in chunks if a == agent_id])
+        want = np.concatenate([np.frombuffer(d[5:], dtype=np.uint8)[3::6] for _, d in packets if d[0] == agent_id])
+        np.testing.assert_array_equal(got, want)
+
+
+def test_journal_is_kept_when_chunks_fail_to_save(tmp_path):
+    # 保存に失敗したセッションのジャーナルは ACK 済みデータの唯一の写しなので消さない
+    def save(agent_id, *_):
+        raise OSError("disk full")
+
+    journal = Journal(5.0, folder=str(tmp_path), fsync_interval=0)
+    (recv_time, data), = _packets(1)
+    journal.append(data, recv_time)
+    path = journal.rotate()
+    pool = ChunkWriterPool(save)
+    pool.submit(1, {}, [], [])
+    results = []
+    pool.after_written(lambda files, failed: results.append(finish_session(path, merge_and_save_chunks(files), failed)))
+    pool.close()
+    assert results == [False]
+    assert os.path.exists(path)
+
+    # 空のセッションと、マージできたセッションは片付ける
+    empty = journal.rotate()
+    assert finish_session(empty, None) and not os.path.exists(empty)
+    assert finish_session(journal.close(), "merged.csv")
+    assert os.listdir(tmp_path) == [os.path.basename(path)]
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+from SessionLoader import iter_narrow_blocks, load_session_files
+
+
+def _session_frame(rows, a0=None):
+    t = np.arange(rows) * 0.001
+    return pd.DataFrame({
+        "agent_id": np.full(rows, 3),
+        "chunk_id": [f"3_{i // 4}" for i in range(rows)],
+        "time_pc_sec_abs": t,
+        "a0": np.arange(rows) % 256 if a0 is None else a0,
+        "a1": np.full(rows, 7),
+        "a2": np.full(rows, 9),
+    })
+
+
+def test_csv_is_narrowed_to_uint8(tmp_path):
+    path = tmp_path / "merged.csv"
+    _session_frame(10).to_csv(path, index=False)
+    df = load_session_files([str(path)])
+    assert df["a0"].dtype == np.uint8
+    assert df["agent_id"].dtype == np.uint8
+    np.testing.assert_array_equal(df["a0"], np.arange(10))
+
+
+def test_out_of_range_csv_keeps_values_without_repeating_blocks(tmp_path, capsys):
+    # read_csv(dtype=uint8) は 300 を 44 に折り返していた
+    a0 = np.arange(10)
+    a0[6] = 300
+    path = tmp_path / "merged.csv"
+    _session_frame(10, a0=a0).to_csv(path, index=False)
+
+    blocks = list(iter_narrow_blocks(str(path), block_rows=4))
+    assert [len(b) for b in blocks] == [4, 4, 2]
+    assert blocks[0]["a0"].dtype == np.uint8  # 範囲外の値を含まないブロックはそのまま縮める
+    assert blocks[1]["a0"].dtype != np.uint8
+    assert capsys.readouterr().out.count("[WARN]") == 1
+
+    df = load_session_files([str(path)], block_rows=4)
+    assert len(df) == 10
+    np.testing.assert_array_equal(df["a0"], a0)
+    np.testing.assert_allclose(df["time_pc_sec_abs"], np.arange(10) * 0.001)
+
+
+def test_npz_out_of_range_is_not_wrapped(tmp_path):
+    # ChunkStorage は uint8 で保存するが、手で書き出した npz には広い型が入り得る
+    a0 = np.arange(10)
+    a0[2] = 1000
+    path = str(tmp_path / "merged.npz")
+    np.savez(path, time_pc_sec_abs=np.arange(10) * 0.001, a0=a0, a1=np.full(10, 7), a2=np.full(10, 9),
+             agent_id=np.full(10, 3), chunk_codes=np.zeros(10, dtype=np.int32), chunk_categories=np.array(["3_0"]))
+    df = load_session_files([path])
+    np.testing.assert_array_equal(df["a0"], a0)
+    assert df["a1"].dtype == np.uint8
@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+
+from TimeAnomalies import T_TOL, chunk_start_times, correct_overflow_jumps
+from TimeReconstruction import (MICROS24_WRAP, T_OVERFLOW, future_chunk_mask, mean_clock_offset,
+                                reconstruct_chunk_times, remove_forward_jumps)
+
+
+# ---------------------------
+# 従来実装（ChunkProcessor.build_dataframe_for_chunk と Plotter の補正ループ）
+# ---------------------------
+def _loop_offset(send_micros, recv_times):
+    wrapped = [(((s >> 8) % 16777216) << 8) / 1e6 for s in send_micros]
+    offsets = [recv - send for send, recv in zip(wrapped, recv_times)]
+    return sum(offsets) / len(offsets)
+
+
+def _loop_times(micros_list, offset):
+    extended = [0] * len(micros_list)
+    wrap_offset = 0
+    prev = micros_list[0]
+    extended[0] = prev
+    for i in range(1, len(micros_list)):
+        curr = micros_list[i]
+        if curr < prev:
+            wrap_offset += 16777216
+        extended[i] = curr + wrap_offset
+        prev = curr
+    raw = [val << 8 for val in extended]
+    local = [val / 1e6 for val in raw]
+    return extended, raw, local, [t + offset for t in local]
+
+
+def _loop_large_jump(sub, threshold_sec=T_OVERFLOW - T_TOL, jump_sec=T_OVERFLOW):
+    sub = sub.copy()
+    time_diff = sub["time_pc_sec_abs"].diff().fillna(0)
+    for idx in sub.index[time_diff > threshold_sec]:
+        sub.loc[idx:, "time_pc_sec_abs"] -= jump_sec
+    return sub
+
+
+def _loop_chunk_starts(df, threshold_sec=4000.0, jump_sec=T_OVERFLOW):
+    median_start = df.groupby(["agent_id", "chunk_id"])["time_pc_sec_abs"].min().median()
+    out = df.copy()
+    for _, sub in df.groupby(["agent_id", "chunk_id"]):
+        if sub["time_pc_sec_abs"].min() - median_start > threshold_sec:
+            out.loc[sub.index, "time_pc_sec_abs"] -= jump_sec
+    return out
+
+
+def _wrapping_micros24(n=30000, start=MICROS24_WRAP - 2000, step=39):
+    # 1チャンクに 24ビットの折り返しを2回含む（1周 ≒ 4295 秒 / 256）
+    return (start + np.arange(n, dtype=np.int64) * step * 16) % MICROS24_WRAP
+
+
+def test_reconstruct_matches_loop_across_24bit_wrap():
+    micros24 = _wrapping_micros24()
+    assert (np.diff(micros24) < 0).sum() >= 2
+    send_micros = [(0xFFFFF000 + k * 3_000_000) & 0xFFFFFFFF for k in range(40)]  # 32ビットも折り返す
+    recv_times = [1.75e9 + k * 3.0 + 0.001 * (k % 5) for k in range(40)]
+
+    offset = mean_clock_offset(send_micros, recv_times)
+    assert np.isclose(offset, _loop_offset(send_micros, recv_times), rtol=0, atol=1e-6)
+
+    got = reconstruct_chunk_times(micros24, offset)
+    micros32, raw, local, pc = _loop_times(micros24.tolist(), offset)
+    assert got["micros32"].tolist() == micros32
+    assert got["micros32_raw"].tolist() == raw
+    assert np.array_equal(got["time_local_sec"], np.array(local))
+    assert np.allclose(got["time_pc_sec_abs"], pc, rtol=0, atol=1e-6)
+
+
+def _chunks_with_overflow():
+    rng = np.random.default_rng(0)
+    frames = []
+    for agent_id, chunk_id, jumps_at in ((1, "a", [400]), (1, "b", []), (2, "a", [100, 700])):
+        t = 1.75e9 + np.cumsum(rng.uniform(0.005, 0.015, 1000))
+        for j in jumps_at:
+            t[j:] += T_OVERFLOW  # micros() の 2^32 μs オーバーフローで未来に飛んだ区間
+        frames.append(pd.DataFrame({"agent_id": agent_id, "chunk_id": chunk_id, "time_pc_sec_abs": t}))
+    return pd.concat(frames, ignore_index=True)
+
+
+def test_overflow_jumps_match_loop():
+    df = _chunks_with_overflow()
+    fixed, jumped = correct_overflow_jumps(df)
+    expected = pd.concat([_loop_large_jump(sub) for _, sub in df.groupby(["agent_id", "chunk_id"])])
+    assert np.allclose(fixed["time_pc_sec_abs"], expected.sort_index()["time_pc_sec_abs"], rtol=0, atol=1e-6)
+    assert sorted(jumped.tolist()) == [400, 2100, 2700]
+
+    t = df[df["chunk_id"] == "b"]["time_pc_sec_abs"].to_numpy().copy()
+    t[500:] += T_OVERFLOW
+    got, positions = remove_forward_jumps(t, T_OVERFLOW - T_TOL, T_OVERFLOW)
+    ref = _loop_large_jump(pd.DataFrame({"time_pc_sec_abs": t}))["time_pc_sec_abs"].to_numpy()
+    assert positions.tolist() == [500]
+    assert np.allclose(got, ref, rtol=0, atol=1e-6)
+
+
+def test_future_chunks_match_loop():
+    df = _chunks_with_overflow()
+    df, _ = correct_overflow_jumps(df)
+    late = (df["agent_id"] == 2)
+    df.loc[late, "time_pc_sec_abs"] += T_OVERFLOW  # チャンク全体が未来に飛んだ
+    df = pd.concat([df, df[df["agent_id"] == 1].assign(chunk_id="c")], ignore_index=True)
+
+    starts, codes = chunk_start_times(df)
+    mask = future_chunk_mask(starts.to_numpy(), 4000.0)
+    fixed = df.copy()
+    fixed.loc[np.isin(codes, np.flatnonzero(mask)), "time_pc_sec_abs"] -= T_OVERFLOW
+    expected = _loop_chunk_starts(df)
+    assert mask.sum() == 1
+    assert np.allclose(fixed["time_pc_sec_abs"], expected["time_pc_sec_abs"], rtol=0, atol=1e-6)